@@ -0,0 +1,63 @@
+"""共享 Dify API Key 的限速：按 key 的令牌桶
+
+所有访客共用同一个 app key，上游按 key 限流；一阵突发请求同时打上去，
+大家都会收到 429。RateLimiter 给每个 key 一个令牌桶 (ratelimit.TokenBucket，与批量生成共用；
+平均每分钟 rate 次、最多攒 burst 次)，JobManager 只有拿到令牌才让排队的任务开始，
+拿不到就留在队里等，不占线程，也不打到上游。
+
+RateLimiter 应通过 st.cache_resource (或随 JobManager) 在进程内共享。
+"""
+import hashlib
+import os
+import threading
+import time
+
+from ratelimit import TokenBucket
+
+DIFY_RATE_PER_MINUTE = float(os.environ.get("DIFY_RATE_PER_MINUTE", "30"))  # 0 = 不限速
+DIFY_RATE_BURST = int(os.environ.get("DIFY_RATE_BURST", "5"))
+
+
+class RateLimiter:
+    """按 key 的令牌桶集合 (线程安全)"""
+
+    def __init__(self, per_minute=DIFY_RATE_PER_MINUTE, burst=DIFY_RATE_BURST, clock=time.monotonic):
+        self.per_minute = per_minute
+        self.burst = max(1, burst)
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+        # 统计
+        self.granted = 0
+        self.throttled = 0
+
+    @property
+    def enabled(self):
+        return self.per_minute > 0
+
+    def try_acquire(self, key):
+        """给 key 拿一个令牌；成功返回 0，否则返回还要等多少秒"""
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.per_minute / 60, self.burst, self.clock)
+            wait = bucket.reserve()
+            if wait:
+                self.throttled += 1
+            else:
+                self.granted += 1
+            return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "per_minute": self.per_minute,
+                "burst": self.burst,
+                "granted": self.granted,
+                "throttled": self.throttled,
+                # key 本身是密钥，只显示摘要
+                "tokens": {hashlib.sha256(key.encode("utf-8")).hexdigest()[:8]: round(bucket.tokens, 2)
+                           for key, bucket in self._buckets.items()},
+            }
@@ -1,9 +1,11 @@
 import streamlit as st
 import streamlit.components.v1 as components
-import requests
-import json
-import re
 import time
+import uuid
+from dify_client import DifyClient, DifyError, StreamDropped, StreamStalled, extract_audio_links
+from dify_http import PooledSession
+from speculative_upload import SpeculativeUploader, prefetch_upload
+from sse import ANSWER_EVENTS
 
 # --- 1. 页面配置 ---
 st.set_page_config(
@@ -31,9 +33,24 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# --- 共享 HTTP 连接池 ---
+@st.cache_resource
+def get_http_session():
+    """进程级共享的 HTTP 连接池 (跨 rerun、跨会话复用连接)"""
+    return PooledSession()
+
+@st.cache_resource
+def get_uploader():
+    """进程级共享的后台上传 (选好图片就开始上传，点击生成时复用)"""
+    return SpeculativeUploader(session=get_http_session())
+
 st.title("🎹 Maestro：你的AI写歌助手")
 st.caption("模式: Advanced Chat | 机制: Streaming | 自动去重")
 
+# --- 每个会话一个 Dify user (上游按 user 统计用量，不再所有人共用一个) ---
+if "dify_user" not in st.session_state:
+    st.session_state.dify_user = f"maestro-{uuid.uuid4().hex[:12]}"
+
 # --- 2. 侧边栏 (自动配置) ---
 with st.sidebar:
     st.header("API 设置")
@@ -42,32 +59,20 @@ with st.sidebar:
     
     base_url_input = st.text_input("Dify Base URL", value="https://api.dify.ai/v1")
     DIFY_BASE_URL = base_url_input.rstrip("/")
+    dify = DifyClient(DIFY_BASE_URL, DIFY_API_KEY, session=get_http_session(), user=st.session_state.dify_user)
     st.info("已自动配置 API Key。")
 
 # --- 3. 核心函数 ---
 
-def upload_file(file_obj, user_id="user-123"):
-    """上传文件"""
-    url = f"{DIFY_BASE_URL}/files/upload"
-    headers = {"Authorization": f"Bearer {DIFY_API_KEY}"}
-    files = {'file': (file_obj.name, file_obj, file_obj.type)}
-    data = {'user': user_id}
-    
+def upload_file(file_obj):
+    """上传文件 (原样上传，不做预处理；优先复用选图时就开始的后台上传)"""
     try:
-        response = requests.post(url, headers=headers, files=files, data=data)
-        response.raise_for_status()
-        return response.json().get('id')
-    except Exception as e:
-        st.error(f"❌ 图片上传失败: {e}")
+        file_id, _, _ = get_uploader().upload(dify, file_obj.getvalue(), file_obj.name, file_obj.type, prepare=False)
+        return file_id
+    except DifyError as e:
+        st.error(f"❌ {e}")
         return None
 
-def extract_audio_links(text):
-    """提取链接并去重 (保留前2个)"""
-    if not isinstance(text, str): return []
-    links = re.findall(r'(https?://[^\s)]+\.mp3)', text)
-    unique_links = list(dict.fromkeys(links))
-    return unique_links[:2]
-
 # --- 4. 简约风格小游戏 (HTML/JS) ---
 def render_game():
     game_html = """
@@ -182,6 +187,9 @@ def render_game():
 # 这样能保证字体绝对够大，和“生成结果”完全一致
 st.markdown("### 📸 上传一张图片")
 uploaded_file = st.file_uploader("label_hidden", label_visibility="collapsed", type=['png', 'jpg', 'jpeg', 'webp'])
+# 选好图片就开始在后台上传，用户输入提示词的时候多半已经传完了
+prefetch_upload(st.session_state, get_uploader(), uploaded_file, DIFY_BASE_URL, DIFY_API_KEY,
+                user=st.session_state.dify_user, prepare=False)
 
 st.markdown("### ✍️ 额外提示词 (可选)")
 user_prompt = st.text_input("label_hidden", label_visibility="collapsed", placeholder="例如：生成古典风格...")
@@ -205,56 +213,43 @@ if st.button("🚀 开始生成音乐", type="primary"):
     if file_id:
         status_text.markdown("### 🤖 正在连接 Maestro 大脑...")
         
-        # 准备请求
-        url = f"{DIFY_BASE_URL}/chat-messages"
-        headers = {"Authorization": f"Bearer {DIFY_API_KEY}", "Content-Type": "application/json"}
-        
-        image_payload = {"type": "image", "transfer_method": "local_file", "upload_file_id": file_id}
-        inputs = {"pic": [image_payload]} 
-        
-        payload = {
-            "inputs": inputs,
-            "query": user_prompt if user_prompt else "生成音乐",
-            "response_mode": "streaming", 
-            "conversation_id": "",
-            "user": "user-123",
-            "files": [image_payload]
-        }
-        
         full_response = ""
         start_time = time.time()
         
         try:
-            # 开启流式请求
-            response = requests.post(url, headers=headers, json=payload, stream=True)
-            response.raise_for_status()
+            # 开启流式请求 (增量 SSE 解析，只解码回答事件)
+            stream = dify.open_chat(file_id, user_prompt, events=ANSWER_EVENTS)
             
-            # --- 核心循环 ---
-            for line in response.iter_lines():
-                if line:
-                    # 更新时间
-                    elapsed = int(time.time() - start_time)
-                    
-                    # 1. 计时器显示
-                    timer_text.info(f"⏱️ **预计运行时间约 3 分钟** | 已运行: **{elapsed} 秒**")
-                    
-                    # 2. 进度条逻辑 (160秒跑满)
-                    current_progress = min(elapsed / 160.0, 0.99)
-                    progress_bar.progress(current_progress)
+            # --- 核心循环：每收到一块数据 (包括 ping) 都刷新计时 ---
+            try:
+                with stream:
+                    for events in stream.batches():
+                        # 更新时间
+                        elapsed = int(time.time() - start_time)
+                        
+                        # 1. 计时器显示
+                        timer_text.info(f"⏱️ **预计运行时间约 3 分钟** | 已运行: **{elapsed} 秒**")
+                        
+                        # 2. 进度条逻辑 (160秒跑满)
+                        current_progress = min(elapsed / 160.0, 0.99)
+                        progress_bar.progress(current_progress)
 
-                    # 解析数据
-                    decoded_line = line.decode('utf-8')
-                    if decoded_line.startswith("data: "):
-                        try:
-                            json_str = decoded_line[6:]
-                            data = json.loads(json_str)
-                            event = data.get('event')
-                            
-                            if event in ['message', 'agent_message', 'text_chunk']:
-                                chunk = data.get('answer', '')
-                                full_response += chunk
-                        except:
-                            pass
+                        # 累加回答文本
+                        for event in events:
+                            chunk = event.payload.get('answer', '')
+                            full_response += chunk
+            except StreamStalled:
+                # 连接还在但上游卡住了：停掉 Dify 上的任务
+                if stream.task_id:
+                    dify.stop(stream.task_id)
+                raise
+            except StreamDropped as e:
+                if not stream.resumable:
+                    raise
+                # 工作流还在 Dify 上跑：等它跑完后查回完整回答，不用从头再生成
+                status_text.markdown("### 🔄 连接中断，正在取回结果...")
+                message = dify.recover(stream)
+                full_response = message.get("answer") or full_response
             
             # --- 完成 ---
             progress_bar.progress(1.0)
@@ -265,7 +260,7 @@ if st.button("🚀 开始生成音乐", type="primary"):
             st.divider()
             st.markdown("### 🎧 生成结果")
             
-            links = extract_audio_links(full_response)
+            links = extract_audio_links(full_response, limit=2)
             
             if links:
                 for i, link in enumerate(links):
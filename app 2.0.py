@@ -1,11 +1,24 @@
 import streamlit as st
 import streamlit.components.v1 as components
-import requests
-import json
+import os
 import re
 import time
+import uuid
 from datetime import datetime
-from PIL import Image # 引入 PIL 用于处理图片保存
+from urllib.parse import urlsplit
+from admission import RateLimiter
+from audio_cache import AudioCache
+from dify_client import IDLE_TIMEOUT, NODE_IDLE_TIMEOUTS
+from dify_http import PooledSession
+from history_db import HISTORY_PAGE_SIZE, HistoryDB, history_owner, new_history_token
+from history_store import HistoryStore
+from jobs import DONE, FAILED, CANCELLED, QUEUED, JobManager, QueueFullError
+from pipeline import CompletionPolicy, GenerationRequest, run_generation
+from progress_model import ProgressModel
+from result_cache import ResultCache, result_cache_key
+from speculative_upload import SpeculativeUploader, prefetch_upload
+from upload_cache import UploadCache
+from workflow_trace import WORKFLOW_TRACE_STATS_RUNS, TraceStore, waterfall_spec
 
 # --- 1. 页面配置 ---
 st.set_page_config(
@@ -15,12 +28,21 @@ st.set_page_config(
     initial_sidebar_state="expanded" # 默认展开侧边栏以便看到历史
 )
 
-# --- 初始化 Session State (用于存储历史记录) ---
-if "history" not in st.session_state:
-    st.session_state.history = []
+# --- 初始化 Session State (历史记录的归属用户 / 调用 Dify 时的 user) ---
+if "history_user" not in st.session_state:
+    # 历史记录持久化在服务端，按 URL 中的 uid (随机凭据，不可猜) 找回，刷新页面后仍然可见；
+    # 库里只存凭据的哈希。没有 uid 或不是合法凭据 (例如手写的名字) 时发一个新的
+    history_token = st.query_params.get("uid")
+    if history_owner(history_token) is None:
+        history_token = new_history_token()
+        st.query_params["uid"] = history_token
+    st.session_state.history_user = history_owner(history_token)
+if "dify_user" not in st.session_state:
+    # 调用 Dify 的 user，也是公平排队 (每人同时跑几个任务) 的 owner；每个会话一个，和历史凭据无关
+    st.session_state.dify_user = f"maestro-{uuid.uuid4().hex[:12]}"
 
 # --- CSS 样式优化 ---
-st.markdown("""
+PAGE_CSS = """
     <style>
         .block-container { padding-top: 2rem !important; }
         
@@ -57,130 +79,251 @@ st.markdown("""
             background-color: #f9f9f9;
         }
     </style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_resource
+def page_style():
+    """页面 CSS，进程内压缩一次 (去掉注释和空白)：每次整页 rerun 都要重新发送"""
+    css = re.sub(r"/\*.*?\*/", "", PAGE_CSS, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};])\s*", r"\1", css).strip()
+
+st.markdown(page_style(), unsafe_allow_html=True)
 
 st.title("🎹 Maestro：你的AI写歌助手")
 st.caption("© 2025 ZHAO Xinyi, HE Jingjing, ZHAO Zhenran. All Rights Reserved.")
 
-# --- 2. 侧边栏 (API 设置 + 历史记录) ---
-with st.sidebar:
-    st.header("⚙️ API 设置")
-    default_key = "app-QbS2Fs0LQ0klcni6nCfjchOS"
-    DIFY_API_KEY = st.text_input("Dify API Key", value=default_key, type="password", disabled=True)
-    base_url_input = st.text_input("Dify Base URL", value="https://api.dify.ai/v1")
-    DIFY_BASE_URL = base_url_input.rstrip("/")
-    
-    st.divider() # 分割线
-    
-    # 【新增功能 3】：侧边栏历史记录
+# --- 共享 HTTP 连接池 ---
+@st.cache_resource
+def get_http_session():
+    """进程级共享的 HTTP 连接池 (跨 rerun、跨会话复用连接)"""
+    return PooledSession()
+
+@st.cache_resource
+def get_upload_cache():
+    """进程级共享的上传缓存 (相同图片复用 Dify 的 file_id)"""
+    return UploadCache(path=os.environ.get("DIFY_UPLOAD_CACHE_PATH"))
+
+@st.cache_resource
+def get_result_cache():
+    """进程级共享的生成结果缓存 (相同图片 + 提示词直接返回上次结果)"""
+    return ResultCache()
+
+@st.cache_resource
+def get_history_store():
+    """进程级共享的历史图片存储 (缩略图有全局内存预算，原图放磁盘)"""
+    return HistoryStore()
+
+@st.cache_resource
+def get_history_db():
+    """进程级共享的历史记录库 (SQLite，跨会话、跨重启保留)"""
+    return HistoryDB()
+
+@st.cache_resource
+def get_trace_store():
+    """进程级共享的工作流执行记录库 (各节点耗时，用来找瓶颈节点、估算进度)"""
+    return TraceStore()
+
+@st.cache_resource
+def get_progress_model():
+    """进程级共享的进度模型 (按执行记录里的历史节点耗时估算剩余时间)"""
+    return ProgressModel(get_trace_store())
+
+@st.cache_resource
+def get_uploader():
+    """进程级共享的后台上传 (选好图片就开始上传，点击生成时复用)"""
+    return SpeculativeUploader(session=get_http_session(), upload_cache=get_upload_cache())
+
+@st.cache_resource
+def get_audio_cache():
+    """进程级共享的音频缓存 (MP3 预取到 static/audio/，由静态文件服务播放)"""
+    return AudioCache(serve=st.get_option("server.enableStaticServing"))
+
+@st.cache_resource
+def get_job_manager():
+    """进程级共享的后台任务池 (生成任务不随 rerun 中断；按会话公平排队、按 API Key 限速)"""
+    return JobManager(limiter=RateLimiter())
+
+def site_root():
+    """站点根的绝对地址 (静态文件从这里拼)；拿不到页面地址时返回 None"""
+    page_url = st.context.url
+    if not page_url:
+        return None
+    parts = urlsplit(page_url)
+    base_path = st.get_option("server.baseUrlPath").strip("/")
+    return f"{parts.scheme}://{parts.netloc}/{base_path}"
+
+def audio_src(link):
+    """播放地址：已缓存到本地的音轨走本站的静态文件服务，否则用原链接"""
+    root = site_root()
+    if not root:
+        return link
+    return get_audio_cache().url_for(link, root)
+
+# --- 后台任务：重新挂上 + 完成后保存历史 ---
+if "job_id" not in st.session_state:
+    # 刷新页面后 session 是新的，按 URL 中的 job id 重新挂上还在跑的任务
+    st.session_state.job_id = st.query_params.get("job")
+if "saved_jobs" not in st.session_state:
+    st.session_state.saved_jobs = set()
+
+current_job = get_job_manager().get(st.session_state.job_id)
+
+# 【新增功能 3 保存逻辑】：任务成功后保存到历史记录库 (在渲染侧边栏之前，新记录立即可见)
+if current_job is not None and current_job.status == DONE and current_job.id not in st.session_state.saved_jobs:
+    st.session_state.saved_jobs.add(current_job.id)
+    try:
+        # 图片存到磁盘 (缩略图在内存)，库里只记 blob id；同一个任务只记一次
+        blob_id = get_history_store().save_image(current_job.meta["image"], digest=current_job.meta.get("digest"))
+        get_history_db().add(
+            current_job.meta.get("user", st.session_state.history_user),
+            current_job.meta["prompt"] or "默认提示词", current_job.links,
+            blob=blob_id, job_id=current_job.id, created_at=current_job.finished_at,
+        )
+    except Exception as e:
+        print(f"历史记录保存失败: {e}")
+
+STATS_PANELS = (
+    ("🔌 连接池状态", lambda: get_http_session().pool_stats()),
+    ("🗂️ 上传缓存", lambda: get_upload_cache().stats()),
+    ("⏫ 后台上传", lambda: get_uploader().stats()),
+    ("⚡ 结果缓存", lambda: get_result_cache().stats()),
+    ("🖼️ 历史图片存储", lambda: get_history_store().stats()),
+    ("📚 历史记录库", lambda: get_history_db().stats()),
+    ("🎧 音频缓存", lambda: get_audio_cache().stats()),
+    ("📈 进度模型", lambda: get_progress_model().stats()),
+    ("🧵 后台任务", lambda: get_job_manager().stats()),
+)
+
+@st.fragment
+def stats_panel():
+    """各组件的运行统计；展开时才计算 (有的要扫描磁盘)，展开、收起只重跑这一块"""
+    for i, (title, stats) in enumerate(STATS_PANELS):
+        expander = st.expander(title, key=f"stats_{i}", on_change="rerun")
+        if expander.open:
+            with expander:
+                st.json(stats())
+    expander = st.expander("🧭 工作流节点耗时", key="stats_trace", on_change="rerun")
+    if expander.open:
+        with expander:
+            trace_overview()
+
+def trace_overview():
+    """最近几次生成里各节点的耗时汇总 (最慢的在前) + 任选一次的瀑布图"""
+    trace_store = get_trace_store()
+    node_stats = trace_store.node_stats()
+    if not node_stats:
+        st.caption("还没有执行记录")
+        return
+    st.caption(f"最近 {WORKFLOW_TRACE_STATS_RUNS} 次生成，按 p95 耗时从慢到快")
+    st.dataframe(node_stats, hide_index=True, use_container_width=True)
+    runs = trace_store.recent()
+    run = st.selectbox("查看某一次", runs, key="trace_run",
+                       format_func=lambda r: f"{datetime.fromtimestamp(r['recorded_at']).strftime('%m-%d %H:%M')}"
+                                             f" · {r['status']} · {r['total']:.0f} 秒")
+    trace = trace_store.get(run["run_id"]) if run else None
+    if trace:
+        st.vega_lite_chart(waterfall_spec(trace), use_container_width=True)
+
+def render_trace(job):
+    """这次生成的节点瀑布图 (展开时才画)"""
+    trace_id = job.info.get("trace_id")
+    if not trace_id:
+        return
+    expander = st.expander("⏱️ 各节点耗时", key=f"trace_{trace_id}", on_change="rerun")
+    if not expander.open:
+        return
+    trace = get_trace_store().get(trace_id)
+    if trace is None:
+        expander.caption("执行记录已被清理")
+        return
+    with expander:
+        st.vega_lite_chart(waterfall_spec(trace), use_container_width=True)
+        if trace.get("usage"):
+            st.caption(f"共用 {trace['usage'].get('total_tokens', 0)} tokens")
+
+# 【新增功能 3】：侧边栏历史记录 (独立刷新的片段：翻页、展开记录、查看原图只重跑这一块)
+@st.fragment
+def history_panel():
+    """当前用户的历史记录 (分页，展开时才加载图片和播放器)"""
     st.header("📜 生成历史")
-    if not st.session_state.history:
+    history_db = get_history_db()
+    history_user = st.session_state.history_user
+    total = history_db.count(history_user)
+    if not total:
         st.caption("暂无历史记录，快去生成一首吧！")
     else:
-        # 倒序遍历，最新的显示在最上面
-        for idx, item in enumerate(reversed(st.session_state.history)):
-            with st.expander(f"🎵 {item['time']} - {item['prompt'][:10]}..."):
-                st.image(item['image'], caption="参考图片", use_container_width=True)
+        # 只查询并渲染当前页，最新的显示在最上面
+        pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        page = st.number_input("页码", min_value=1, max_value=pages, value=1, step=1) if pages > 1 else 1
+        st.caption(f"共 {total} 条，第 {page} / {pages} 页")
+        for row in history_db.page(history_user, page):
+            time_text = datetime.fromtimestamp(row['created_at']).strftime("%m-%d %H:%M")
+            # 展开时才查询完整记录并渲染图片和播放器
+            expander = st.expander(f"🎵 {time_text} - {row['prompt'][:10]}...",
+                                   key=f"history_{row['id']}", on_change="rerun")
+            if not expander.open:
+                continue
+            item = history_db.get(row['id'], history_user)
+            if item is None:
+                continue
+            with expander:
+                thumb = get_history_store().thumbnail(item['blob'])
+                if thumb:
+                    st.image(thumb, caption="参考图片", use_container_width=True)
+                # 原图只在打开开关时才从磁盘读取
+                if st.toggle("🔍 查看原图", key=f"full_image_{item['id']}"):
+                    full_image = get_history_store().full_image(item['blob'])
+                    if full_image:
+                        st.image(full_image, use_container_width=True)
+                    else:
+                        st.caption("原图已被清理")
                 st.caption(f"提示词: {item['prompt']}")
                 if item['links']:
+                    # 已缓存的音轨从本地播放，不依赖远程链接是否还有效
                     for link in item['links']:
-                        st.audio(link, format="audio/mp3")
+                        st.audio(audio_src(link), format="audio/mp3")
                 else:
                     st.warning("无音频链接")
 
-# --- 3. 核心函数 ---
-
-def upload_file(file_obj, user_id="user-123"):
-    """上传文件"""
-    # 这一步很关键：因为 file_obj 可能被读取过，上传前要重置指针
-    file_obj.seek(0) 
+# --- 2. 侧边栏 (API 设置 + 历史记录) ---
+with st.sidebar:
+    st.header("⚙️ API 设置")
+    default_key = "app-QbS2Fs0LQ0klcni6nCfjchOS"
+    DIFY_API_KEY = st.text_input("Dify API Key", value=default_key, type="password", disabled=True)
+    base_url_input = st.text_input("Dify Base URL", value="https://api.dify.ai/v1")
+    DIFY_BASE_URL = base_url_input.rstrip("/")
+    stats_panel()
     
-    url = f"{DIFY_BASE_URL}/files/upload"
-    headers = {"Authorization": f"Bearer {DIFY_API_KEY}"}
-    files = {'file': (file_obj.name, file_obj, file_obj.type)}
-    data = {'user': user_id}
+    st.divider() # 分割线
     
-    try:
-        response = requests.post(url, headers=headers, files=files, data=data)
-        response.raise_for_status()
-        return response.json().get('id')
-    except Exception as e:
-        st.error(f"❌ 图片上传失败: {e}")
-        return None
+    history_panel()
+
+# --- 3. 小游戏组件 (static/game.html) ---
+GAME_HTML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "game.html")
 
-def extract_audio_links(text):
-    """提取链接并去重"""
-    if not isinstance(text, str): return []
-    links = re.findall(r'(https?://[^\s)]+\.mp3)', text)
-    unique_links = list(dict.fromkeys(links))
-    return unique_links[:2]
+@st.cache_resource
+def game_html():
+    """小游戏页面，进程内只读一次"""
+    with open(GAME_HTML_PATH, encoding="utf-8") as f:
+        return f.read()
 
-# --- 4. 小游戏组件 (代码保持不变) ---
 def render_game():
-    game_html = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-    <style>
-        body { margin: 0; overflow: hidden; font-family: 'Segoe UI', sans-serif; }
-        .game-container {
-            width: 100%; height: 270px; background-color: #F9FAFB; 
-            border: 2px solid #E5E7EB; border-radius: 12px; position: relative; 
-            overflow: hidden; text-align: center; box-sizing: border-box;
-        }
-        h4 { margin-top: 20px; color: #1F2937; font-size: 16px; font-weight: 500; letter-spacing: 0.5px; }
-        #score { font-size: 28px; font-weight: 800; color: #000000; margin-bottom: 5px; }
-        .note {
-            position: absolute; font-size: 38px; cursor: pointer; user-select: none;
-            opacity: 1 !important; filter: drop-shadow(0px 2px 2px rgba(0,0,0,0.1));
-            animation: floatUp 5s linear infinite; z-index: 10;
-        }
-        .note:active { transform: scale(0.9); }
-        .popped { display: none; }
-        @keyframes floatUp {
-            0% { transform: translateY(280px) rotate(0deg); }
-            100% { transform: translateY(-60px) rotate(360deg); }
-        }
-    </style>
-    </head>
-    <body>
-    <div class="game-container">
-        <h4>🎵 等待太枯燥？来捕捉灵感音符！</h4>
-        <div id="score">收集灵感: 0</div>
-        <div id="game-area"></div>
-    </div>
-    <script>
-        let score = 0;
-        const area = document.getElementById('game-area');
-        const scoreDisplay = document.getElementById('score');
-        const notes = ['♪', '♫', '♬', '♩', '♭', '♮', '♯'];
-        const colors = ['#E74C3C', '#2ECC71', '#3498DB', '#9B59B6', '#F1C40F', '#E67E22', '#16A085'];
-        function createNote() {
-            let note = document.createElement('div');
-            note.className = 'note';
-            note.innerText = notes[Math.floor(Math.random() * notes.length)];
-            note.style.color = colors[Math.floor(Math.random() * colors.length)];
-            note.style.left = (5 + Math.random() * 85) + '%'; 
-            note.style.animationDuration = (3.5 + Math.random() * 3) + 's'; 
-            note.onclick = function() {
-                score++; scoreDisplay.innerText = '收集灵感: ' + score;
-                this.classList.add('popped');
-                setTimeout(createNote, 200); setTimeout(() => { note.remove(); }, 200);
-            };
-            note.addEventListener('animationend', () => { note.remove(); createNote(); });
-            area.appendChild(note);
-        }
-        for(let i=0; i<8; i++) { setTimeout(createNote, i * 600); }
-    </script>
-    </body>
-    </html>
-    """
-    components.html(game_html, height=280)
+    """开了静态文件服务时用 iframe 加载 static/game.html (每次 rerun 只发一个地址，浏览器还能缓存)，
+    否则内嵌整段 HTML"""
+    root = site_root()
+    if root and st.get_option("server.enableStaticServing"):
+        components.iframe(f"{root.rstrip('/')}/app/static/game.html", height=280)
+    else:
+        components.html(game_html(), height=280)
 
 # --- 主界面逻辑 ---
 
 st.markdown("### 📸 上传一张图片")
 uploaded_file = st.file_uploader("label_hidden", label_visibility="collapsed", type=['png', 'jpg', 'jpeg', 'webp'])
+# 选好图片就开始在后台上传，用户输入提示词的时候多半已经传完了
+prefetch_upload(st.session_state, get_uploader(), uploaded_file, DIFY_BASE_URL, DIFY_API_KEY,
+                user=st.session_state.dify_user)
 
 # 【新增功能 1】：图片上传后立即预览
 if uploaded_file is not None:
@@ -192,107 +335,156 @@ st.caption("提示：提示词中请不要包含人名")
 
 user_prompt = st.text_input("label_hidden", label_visibility="collapsed", placeholder="例如：生成古典风格...")
 
+use_result_cache = st.checkbox("⚡ 相同图片和提示词直接使用上次的结果", value=False)
+force_regenerate = use_result_cache and st.checkbox("🔁 强制重新生成 (忽略缓存)", value=False)
+
 if st.button("🚀 开始生成音乐", type="primary"):
     if not DIFY_API_KEY or not uploaded_file:
         st.warning("⚠️ 请确保上传了图片")
         st.stop()
+    if current_job is not None and not current_job.finished:
+        st.warning("⏳ 上一首还在生成中，请稍候")
+        st.stop()
+
+    request = GenerationRequest(
+        DIFY_BASE_URL, DIFY_API_KEY, uploaded_file.getvalue(), uploaded_file.name, uploaded_file.type,
+        prompt=user_prompt, user=st.session_state.dify_user, force=force_regenerate,
+    )
+    # 同一张图 + 同样的提示词已经有人在生成时直接共享那一次 (强制重新生成的除外)；
+    # 图片只哈希一次 (request.image_digest)，合并、缓存、上传、历史都用它
+    flight_key = None if force_regenerate else result_cache_key(
+        request.image_digest, request.prompt, DIFY_BASE_URL, DIFY_API_KEY)
+    try:
+        current_job = get_job_manager().submit(
+            run_generation, get_http_session(), request, get_upload_cache(),
+            result_cache=get_result_cache() if use_result_cache else None,
+            policy=CompletionPolicy(),  # 由 DIFY_STOP_AFTER_LINKS / DIFY_STOP_AFTER_NODE 配置
+            audio_cache=get_audio_cache(),
+            uploader=get_uploader(),
+            trace_store=get_trace_store(),
+            meta={"prompt": user_prompt, "image": request.image_bytes, "digest": request.image_digest,
+                  "user": st.session_state.history_user},
+            key=flight_key, owner=st.session_state.dify_user, rate_key=DIFY_API_KEY,
+        )
+    except QueueFullError as e:
+        st.error(f"😵 当前排队的人太多了，请稍后再试 ({e})")
+        st.stop()
+    st.session_state.job_id = current_job.id
+    st.query_params["job"] = current_job.id
+
+# --- 4. 任务状态 (独立刷新的片段，不会重跑整个页面) ---
+
+PHASE_TEXT = {
+    QUEUED: "### ⏳ 排队中...",
+    "cache": "### ⚡ 正在查找缓存结果...",
+    "upload": "### 📤 正在上传图片...",
+    "connect": "### 🤖 正在连接 Maestro 大脑...",
+    "stream": "### 🤖 正在连接 Maestro 大脑...",
+    "resume": "### 🔄 连接中断，正在向 Maestro 取回结果 (不会重新生成)...",
+}
+STALL_HINT_SECONDS = 15  # 这么久没有新进展就提示一下 (看门狗到 IDLE_TIMEOUT 才放弃)
 
-    # 1. 游戏区域
-    render_game()
+def render_tracks(links, live=False):
+    """每个音轨一个播放器；live 为生成过程中的试听 (固定用原链接，
+    避免下载完成后换成本地地址，打断正在播放的音轨)"""
+    for i, link in enumerate(links):
+        col1, col2 = st.columns([1, 4])
+        with col1: st.markdown(f"**Track {i+1}**")
+        with col2: st.audio(link if live else audio_src(link), format="audio/mp3")
 
-    # 2. 状态显示区域
+@st.fragment(run_every=1)
+def job_status_panel(job_id):
+    """每秒轮询一次后台任务；结束后触发整页 rerun 显示结果"""
+    job = get_job_manager().get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+    
     status_text = st.empty()
     timer_text = st.empty()
     progress_bar = st.progress(0)
     
-    status_text.markdown("### 📤 正在上传图片...")
-    file_id = upload_file(uploaded_file)
+    if job.phase == QUEUED:
+        position = get_job_manager().queue_position(job.id)
+        status_text.markdown(f"{PHASE_TEXT[QUEUED]} 前面还有 {position} 个任务")
+        if job.info.get("rate_wait"):
+            timer_text.info(f"⏳ API 调用频率已达上限，约 {job.info['rate_wait']:.0f} 秒后开始")
+        return
     
-    if file_id:
-        status_text.markdown("### 🤖 正在连接 Maestro 大脑...")
-        
-        # 准备 API 请求
-        url = f"{DIFY_BASE_URL}/chat-messages"
-        headers = {"Authorization": f"Bearer {DIFY_API_KEY}", "Content-Type": "application/json"}
-        
-        image_payload = {"type": "image", "transfer_method": "local_file", "upload_file_id": file_id}
-        inputs = {"pic": [image_payload]} 
-        
-        payload = {
-            "inputs": inputs,
-            "query": user_prompt if user_prompt else "生成音乐",
-            "response_mode": "streaming", 
-            "conversation_id": "",
-            "user": "user-123",
-            "files": [image_payload]
-        }
-        
-        full_response = ""
-        start_time = time.time()
-        
-        try:
-            response = requests.post(url, headers=headers, json=payload, stream=True)
-            response.raise_for_status()
-            
-            for line in response.iter_lines():
-                if line:
-                    elapsed = int(time.time() - start_time)
-                    timer_text.info(f"⏱️ **预计运行时间约 3 分钟** | 已运行: **{elapsed} 秒**")
-                    current_progress = min(elapsed / 160.0, 0.99)
-                    progress_bar.progress(current_progress)
-
-                    decoded_line = line.decode('utf-8')
-                    if decoded_line.startswith("data: "):
-                        try:
-                            json_str = decoded_line[6:]
-                            data = json.loads(json_str)
-                            event = data.get('event')
-                            if event in ['message', 'agent_message', 'text_chunk']:
-                                chunk = data.get('answer', '')
-                                full_response += chunk
-                        except:
-                            pass
-            
-            # --- 完成 ---
-            progress_bar.progress(1.0)
-            status_text.empty()
-            timer_text.success(f"✅ 生成完成！总耗时: {int(time.time() - start_time)} 秒")
-            
-            # --- 结果解析与展示 ---
-            st.divider()
-            st.markdown("### 🎧 生成结果")
-            
-            links = extract_audio_links(full_response)
-            
-            # 显示音频
-            if links:
-                for i, link in enumerate(links):
-                    col1, col2 = st.columns([1, 4])
-                    with col1: st.markdown(f"**Track {i+1}**")
-                    with col2: st.audio(link, format="audio/mp3")
-            else:
-                if not full_response:
-                    st.warning("⚠️ 流程结束但无文本返回。")
-                else:
-                    with st.expander("查看生成报告"):
-                        st.markdown(full_response)
-                    st.info("提示：未提取到音频链接，请查看上方报告。")
-
-            # 【新增功能 3 保存逻辑】：成功后保存到 Session State 历史记录
-            # 注意：必须将图片转换为 PIL Image 对象保存，因为 uploaded_file 指针在下一轮可能会失效
-            try:
-                uploaded_file.seek(0) # 重置指针以读取图片
-                img_data = Image.open(uploaded_file)
-                
-                st.session_state.history.append({
-                    "time": datetime.now().strftime("%H:%M"),
-                    "prompt": user_prompt if user_prompt else "默认提示词",
-                    "image": img_data,
-                    "links": links
-                })
-                # 强制刷新一下侧边栏显示新历史（可选，Steamlit通常会自动更新UI）
-            except Exception as e:
-                print(f"历史记录保存失败: {e}")
-
-        except Exception as e:
-            st.error(f"❌ 连接中断: {e}")
\ No newline at end of file
+    status_text.markdown(PHASE_TEXT.get(job.phase, PHASE_TEXT["stream"]))
+    elapsed = int(job.elapsed())
+    # 每秒按已开始的节点和历史耗时重新估算，不依赖是否有新事件到达
+    estimate = get_progress_model().estimate(list(job.node_log), job.started_at)
+    if estimate.learned:
+        timer_text.info(f"⏱️ **预计还需约 {estimate.remaining:.0f} 秒** (慢的话 {estimate.remaining_p90:.0f} 秒)"
+                        f" | 已运行: **{elapsed} 秒**")
+    else:
+        timer_text.info(f"⏱️ **预计运行时间约 3 分钟** | 已运行: **{elapsed} 秒**")
+    progress_bar.progress(estimate.progress)
+    if job.node:
+        st.caption(f"🔄 正在执行: {job.node}")
+    idle = time.time() - job.updated_at
+    if job.phase == "stream" and idle >= STALL_HINT_SECONDS:
+        limit = NODE_IDLE_TIMEOUTS.get(job.node, IDLE_TIMEOUT)
+        st.caption(f"💤 已有 {idle:.0f} 秒没有新进展" + (f" (超过 {limit:.0f} 秒会自动放弃)" if limit > 0 else ""))
+    if job.shared:
+        st.caption(f"🤝 还有 {job.subscribers - 1} 位用户在等同样的歌，大家共用这一次生成")
+    # 链接一出现就可以先听，不必等工作流全部结束
+    links = job.links
+    if links:
+        st.markdown("#### 🎧 已生成的音轨 (可先试听)")
+        render_tracks(links, live=True)
+    if st.button("⏹️ 取消生成"):
+        job.cancel()
+
+@st.fragment
+def result_panel(job_id):
+    """展示已结束任务的结果 (独立的片段，里面的交互不会重跑整个页面)"""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return
+    if job.status == CANCELLED:
+        st.info("已取消生成。")
+        return
+    if job.status == FAILED:
+        st.error(f"❌ {job.error}")
+        render_trace(job)
+        return
+    
+    if job.info.get("result_cache") == "hit":
+        st.success("⚡ 命中缓存，直接返回上次的生成结果！(勾选「强制重新生成」可重新跑一次)")
+    else:
+        st.success(f"✅ 生成完成！总耗时: {int(job.elapsed())} 秒")
+        if job.info.get("upload_hidden_seconds"):
+            st.caption(f"⏫ 图片在选中时已开始上传，等待时间少了 {job.info['upload_hidden_seconds']:.1f} 秒")
+        if "first_link_seconds" in job.info:
+            st.caption(f"🎵 第一首音轨在 {job.info['first_link_seconds']:.0f} 秒时就绪")
+        if "early_stop" in job.info:
+            st.caption(f"⏩ 提前结束: {job.info['early_stop']}")
+        render_trace(job)
+    
+    # --- 结果解析与展示 ---
+    st.divider()
+    st.markdown("### 🎧 生成结果")
+    
+    links = job.links
+    full_response = job.text
+    
+    # 显示音频
+    if links:
+        render_tracks(links)
+    else:
+        if not full_response:
+            st.warning("⚠️ 流程结束但无文本返回。")
+        else:
+            with st.expander("查看生成报告"):
+                st.markdown(full_response)
+            st.info("提示：未提取到音频链接，请查看上方报告。")
+
+if current_job is not None:
+    if current_job.finished:
+        result_panel(current_job.id)
+    else:
+        # 1. 游戏区域
+        render_game()
+        # 2. 状态显示区域
+        job_status_panel(current_job.id)
\ No newline at end of file
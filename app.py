@@ -1,46 +1,118 @@
 import streamlit as st
-import requests
-import json
-import re
+import os
+import time
+import uuid
+from dify_client import AudioLinkScanner, DifyClient, DifyError, StreamDropped, StreamStalled, answer_remainder
+from dify_http import PooledSession
+from metrics import start_run
+from render_buffer import StreamRenderBuffer
+from speculative_upload import SpeculativeUploader, prefetch_upload
+from sse import ANSWER_EVENTS
+from upload_cache import UploadCache
+from workflow_trace import TraceStore, WorkflowTrace, waterfall_spec
 
 # --- 页面设置 ---
 st.set_page_config(page_title="Suno 音乐生成器", page_icon="🎵", layout="centered")
 st.title("🎵 AI 音乐生成器 (流式抗超时版)")
 st.caption("模式: Advanced Chat | 机制: Streaming (解决 504 超时)")
 
+# --- 共享 HTTP 连接池 ---
+@st.cache_resource
+def get_http_session():
+    """进程级共享的 HTTP 连接池 (跨 rerun、跨会话复用连接)"""
+    return PooledSession()
+
+@st.cache_resource
+def get_upload_cache():
+    """进程级共享的上传缓存 (相同图片复用 Dify 的 file_id)"""
+    return UploadCache(path=os.environ.get("DIFY_UPLOAD_CACHE_PATH"))
+
+@st.cache_resource
+def get_trace_store():
+    """进程级共享的工作流执行记录库 (各节点耗时)"""
+    return TraceStore()
+
+@st.cache_resource
+def get_uploader():
+    """进程级共享的后台上传 (选好图片就开始上传，点击生成时复用)"""
+    return SpeculativeUploader(session=get_http_session(), upload_cache=get_upload_cache())
+
+# --- 每个会话一个 Dify user (上游按 user 统计用量，不再所有人共用一个) ---
+if "dify_user" not in st.session_state:
+    st.session_state.dify_user = f"maestro-{uuid.uuid4().hex[:12]}"
+
 # --- 侧边栏配置 ---
 with st.sidebar:
     st.header("API 设置")
     DIFY_API_KEY = st.text_input("Dify API Key", type="password", help="请使用 master-5.0 应用的 API Key")
     base_url_input = st.text_input("Dify Base URL", value="https://api.dify.ai/v1")
     DIFY_BASE_URL = base_url_input.rstrip("/")
+    # 客户端很轻，每次 rerun 新建；连接池和上传缓存是进程级共享的
+    dify = DifyClient(DIFY_BASE_URL, DIFY_API_KEY, session=get_http_session(), upload_cache=get_upload_cache(),
+                      user=st.session_state.dify_user)
     st.info("💡 此版本使用流式传输，可以长时间运行而不会断连。")
+    with st.expander("🔌 连接池状态"):
+        st.json(get_http_session().pool_stats())
+    with st.expander("🗂️ 上传缓存"):
+        st.json(get_upload_cache().stats())
+    with st.expander("⏫ 后台上传"):
+        st.json(get_uploader().stats())
+    # 汇总要读最近几十条记录，展开时才算，平时的 rerun 不碰数据库
+    trace_expander = st.expander("🧭 工作流节点耗时", key="stats_trace", on_change="rerun")
+    if trace_expander.open:
+        with trace_expander:
+            node_stats = get_trace_store().node_stats()
+            if node_stats:
+                st.dataframe(node_stats, hide_index=True)
+            else:
+                st.caption("还没有执行记录")
 
 # --- 核心函数 ---
 
-def upload_file(file_obj, user_id="user-123"):
-    """步骤 1: 上传文件"""
-    url = f"{DIFY_BASE_URL}/files/upload"
-    headers = {"Authorization": f"Bearer {DIFY_API_KEY}"}
-    files = {'file': (file_obj.name, file_obj, file_obj.type)}
-    data = {'user': user_id}
-    
+# 需要处理的流式事件，其余事件在 JSON 解码前就被丢弃
+APP_EVENTS = ANSWER_EVENTS | {"node_started", "error"}
+# 开启耗时统计时还要解码 node_finished，统计每个节点的耗时
+TRACE_EVENTS = APP_EVENTS | {"node_finished"}
+
+def upload_file(file_obj):
+    """步骤 1: 上传文件 (优先复用选图时就开始的后台上传；相同图片直接复用缓存的 file_id；
+    否则先缩放、去元数据再上传)"""
     try:
-        response = requests.post(url, headers=headers, files=files, data=data)
-        response.raise_for_status()
-        return response.json().get('id')
-    except Exception as e:
-        st.error(f"❌ 图片上传失败: {e}")
+        file_id, report, hidden = get_uploader().upload(dify, file_obj.getvalue(), file_obj.name, file_obj.type)
+    except DifyError as e:
+        st.error(f"❌ {e}")
         return None
+    st.session_state.last_image_prep = report
+    st.session_state.last_upload_hidden = hidden
+    return file_id
 
-def extract_audio_links(text):
-    """提取 MP3 链接"""
-    if not isinstance(text, str): return []
-    return re.findall(r'(https?://[^\s)]+\.mp3)', text)
+def save_trace(workflow, status, error=None):
+    """保存这次生成的节点执行记录并返回；没跑到工作流时返回 None"""
+    if not workflow.seen:
+        return None
+    record = workflow.finish(status, error=error)
+    try:
+        get_trace_store().record(record)
+    except Exception as e:
+        print(f"执行记录保存失败: {e}")
+    return record
+
+def show_new_tracks(area, scanner, new_links):
+    """链接一完整就在结果区加一个播放器"""
+    with area:
+        if len(scanner.links) == len(new_links):
+            st.divider()
+            st.subheader("🎧 生成结果")
+        for link in new_links:
+            st.markdown(f"**Track {scanner.links.index(link) + 1}**")
+            st.audio(link, format="audio/mp3")
 
 # --- 主界面 ---
 
 uploaded_file = st.file_uploader("📸 上传图片", type=['png', 'jpg', 'jpeg', 'webp'])
+# 选好图片就开始在后台上传，用户输入提示词的时候多半已经传完了
+prefetch_upload(st.session_state, get_uploader(), uploaded_file, DIFY_BASE_URL, DIFY_API_KEY,
+                user=st.session_state.dify_user)
 user_prompt = st.text_input("✍️ 提示词", placeholder="例如：古典风格...")
 
 if st.button("🚀 开始生成", type="primary"):
@@ -48,90 +120,133 @@ if st.button("🚀 开始生成", type="primary"):
         st.warning("⚠️ 请完善 API Key 和图片")
         st.stop()
 
+    request_start = time.monotonic() # 用于统计首个音轨的用时
+    trace = start_run() # 分阶段耗时 (DIFY_METRICS=1 时才记录)
+    workflow = WorkflowTrace() # 各节点的执行记录
+    
     # 进度显示容器
     status_container = st.status("🤖 正在连接 AI...", expanded=True)
     
     with status_container:
         st.write("📤 上传图片中...")
+        trace.start("upload")
         file_id = upload_file(uploaded_file)
+        trace.end("upload")
+        if not file_id:
+            trace.finish("failed", error_phase="upload")
         
         if file_id:
+            image_prep = st.session_state.get("last_image_prep")
+            if image_prep and not image_prep["skipped"]:
+                st.write(f"🗜️ 图片已压缩: {image_prep['original_bytes'] // 1024} KB → {image_prep['bytes'] // 1024} KB"
+                         f" (耗时 {image_prep['elapsed_ms']:.0f} ms)")
+            if st.session_state.get("last_upload_hidden"):
+                st.write(f"⏫ 图片在选中时已开始上传，等待时间少了 {st.session_state.last_upload_hidden:.1f} 秒")
             st.write("✅ 图片上传成功，开始执行工作流...")
             st.write("⏳ 正在生成音乐（由于是流式传输，请耐心观察下方输出变化）...")
             
-            # --- 核心修改：流式请求逻辑 ---
-            url = f"{DIFY_BASE_URL}/chat-messages"
-            headers = {"Authorization": f"Bearer {DIFY_API_KEY}", "Content-Type": "application/json"}
-            
-            image_payload = {"type": "image", "transfer_method": "local_file", "upload_file_id": file_id}
-            inputs = {"pic": [image_payload]} # 必须传 pic 变量
-            
-            payload = {
-                "inputs": inputs,
-                "query": user_prompt if user_prompt else "生成音乐",
-                "response_mode": "streaming", # ⚠️ 关键：改为流式模式
-                "conversation_id": "",
-                "user": "user-123",
-                "files": [image_payload]
-            }
-            
-            # 创建一个空占位符，用于实时打字机效果
+            # 创建一个空占位符，用于实时打字机效果 (按时间/字节数合并刷新)
             message_placeholder = st.empty()
+            render_buffer = StreamRenderBuffer(message_placeholder)
             full_response = ""
+            # 音轨区：流式过程中提取到链接就立即显示播放器
+            tracks_area = st.container()
+            link_scanner = AudioLinkScanner()
             
             try:
-                # 开启流式请求 (stream=True)
-                response = requests.post(url, headers=headers, json=payload, stream=True)
-                response.raise_for_status()
+                # 开启流式请求，增量解析 SSE 事件 (只解码关心的事件)
+                trace.start("connect")
+                stream_events = (TRACE_EVENTS if trace.enabled else APP_EVENTS) | workflow.events
+                stream = dify.open_chat(file_id, user_prompt, events=stream_events)
+                trace.end("connect")
+                trace.start("first_event")
+                trace.start("stream")
                 
-                # 逐行读取数据
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data: "):
-                            try:
-                                json_str = decoded_line[6:] # 去掉 'data: ' 前缀
-                                data = json.loads(json_str)
-                                event = data.get('event')
-                                
+                try:
+                    with stream:
+                        for events in stream.batches():
+                            for event in events:
+                                data = event.payload
+                                trace.end("first_event")
+                                workflow.feed(event)
+                    
                                 # 处理不同类型的事件
-                                if event == 'message' or event == 'agent_message' or event == 'text_chunk':
-                                    # 累加回复内容
-                                    chunk = data.get('answer', '')
-                                    full_response += chunk
-                                    # 实时刷新界面
-                                    message_placeholder.markdown(full_response + "▌")
-                                
-                                elif event == 'node_started':
+                                if event.name in ANSWER_EVENTS:
+                                    # 累加回复内容，到时间再刷新界面
+                                    answer = data.get('answer', '')
+                                    render_buffer.append(answer)
+                                    new_links = link_scanner.feed(answer)
+                                    if new_links:
+                                        show_new_tracks(tracks_area, link_scanner, new_links)
+                    
+                                elif event.name == 'node_started':
                                     # 可选：显示正在运行的节点（让你知道它没死机）
                                     node_title = data.get('data', {}).get('title', '未知节点')
                                     st.write(f"🔄 正在执行: {node_title}...")
-                                    
-                                elif event == 'error':
+                                    trace.node_started(data.get('data', {}).get('node_id'), node_title)
+                    
+                                elif event.name == 'node_finished':
+                                    trace.node_finished(data.get('data', {}).get('node_id'))
+                        
+                                elif event.name == 'error':
                                     st.error(f"流式错误: {data}")
-                                    
-                            except Exception:
-                                pass # 忽略解析错误的行
+                            # 每收到一块数据 (包括只有 ping 的) 都检查一次：
+                            # 节流期间积压的片段到时间就刷出去，不必等下一个回答片段
+                            render_buffer.maybe_flush()
+                except StreamStalled:
+                    # 连接还在但上游卡住了：停掉 Dify 上的任务，按失败结束
+                    if stream.task_id:
+                        dify.stop(stream.task_id)
+                    raise
+                except StreamDropped as e:
+                    if not stream.resumable:
+                        raise
+                    # 工作流还在 Dify 上跑：等它跑完后查回完整回答，不用从头再生成
+                    st.write(f"⚠️ {e}，正在向 Dify 取回结果...")
+                    trace.start("resume")
+                    message = dify.recover(stream)
+                    trace.end("resume")
+                    answer = message.get("answer") or ""
+                    rest = answer_remainder(render_buffer.text, answer)
+                    if rest is None:
+                        render_buffer = StreamRenderBuffer(message_placeholder)
+                        rest = answer
+                    render_buffer.append(rest)
+                    new_links = link_scanner.feed(rest)
+                    if new_links:
+                        show_new_tracks(tracks_area, link_scanner, new_links)
                 
                 # 循环结束，任务完成
-                message_placeholder.markdown(full_response) # 去掉光标
+                trace.end("stream")
+                full_response = render_buffer.finish() # 最终刷新并去掉光标
+                new_links = link_scanner.close()
+                if new_links:
+                    show_new_tracks(tracks_area, link_scanner, new_links)
+                render_stats = render_buffer.stats()
+                st.caption(f"渲染: {render_stats['flushes']} 次刷新 / {render_stats['chunks']} 个片段，"
+                           f"合并掉 {render_stats['dropped_frames']} 帧，推送 {render_stats['bytes_sent']} 字节")
                 status_container.update(label="✅ 生成完成！", state="complete", expanded=False)
+                trace.finish("done", links=len(link_scanner.links))
+                workflow_record = save_trace(workflow, "done")
+                if workflow_record:
+                    st.caption("⏱️ 各节点耗时")
+                    st.vega_lite_chart(waterfall_spec(workflow_record), use_container_width=True)
                 
-                # 提取并播放
-                st.divider()
-                st.subheader("🎧 生成结果")
-                links = extract_audio_links(full_response)
-                
-                if links:
-                    for i, link in enumerate(links):
-                        st.markdown(f"**Track {i+1}**")
-                        st.audio(link, format="audio/mp3")
+                if link_scanner.links:
+                    first_link_seconds = link_scanner.first_link_at - request_start
+                    st.caption(f"🎵 第一首音轨在 {first_link_seconds:.0f} 秒时就绪")
                 else:
+                    st.divider()
+                    st.subheader("🎧 生成结果")
                     if not full_response:
                         st.warning("⚠️ 流程跑完了，但没有返回任何文字。请检查工作流的输出节点。")
                     else:
                         st.info("提示：未提取到音频链接，请阅读上方生成的文本报告。")
 
             except Exception as e:
-                status_container.update(label="❌ 连接中断", state="error")
-                st.error(f"请求发生错误: {e}")
\ No newline at end of file
+                # Dify 不认 file_id (400/404) 时 DifyClient 已清掉上传缓存，下次会重新上传
+                stalled = isinstance(e, StreamStalled)
+                status_container.update(label="❌ 上游卡住" if stalled else "❌ 连接中断", state="error")
+                st.error(f"请求发生错误: {e}")
+                trace.finish("failed", error_phase="stall" if stalled else "chat")
+                save_trace(workflow, "failed", error=str(e))
\ No newline at end of file
@@ -0,0 +1,306 @@
+"""生成的 MP3 的本地缓存
+
+st.audio(远程链接) 会让浏览器每次都直接去 CDN 拉文件，链接过期或 CDN 慢时
+历史记录里的旧音轨就放不了。AudioCache 在链接一出现时就在后台把 MP3 下载到磁盘，
+之后页面改用本地地址播放：
+- 文件放在 static/audio/ 下，由 Streamlit 的静态文件服务 (server.enableStaticServing，
+  见 .streamlit/config.toml) 直接从磁盘流式返回，支持 HTTP Range，不会整个读进内存
+- 下载先写隐藏的临时文件，完整后再原子改名，不会播放到半截文件
+- 总大小超过上限时按最近使用时间 (mtime) 淘汰
+- 链接来自大模型的回答，不可信：只下载 AUDIO_CACHE_ALLOWED_HOSTS 里的 CDN 域名，
+  域名解析到内网 / 回环 / 链路本地地址的不下载，重定向逐跳检查 (防 SSRF)；
+  地址在建立连接时检查，并且直接连检查过的那个 IP，防止第二次解析换成内网地址 (DNS rebinding)
+- 还没下载好 (或没开静态文件服务、不知道站点地址) 时 url_for 返回原链接
+
+st.audio 只把 http(s) 开头的字符串当成链接 (否则当本地文件整个读进内存)，
+所以 url_for 需要站点根地址 (页面里由 st.context.url 得到) 来拼出绝对地址。
+
+AudioCache 应通过 st.cache_resource 在进程内共享。
+"""
+import hashlib
+import ipaddress
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from dify_http import CONNECT_TIMEOUT, READ_TIMEOUT
+
+AUDIO_CACHE_DIR = os.environ.get(
+    "AUDIO_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "audio"))
+AUDIO_CACHE_URL = os.environ.get("AUDIO_CACHE_URL", "app/static/audio")   # 相对站点根的访问路径
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get("AUDIO_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+AUDIO_MAX_FILE_BYTES = int(os.environ.get("AUDIO_MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+AUDIO_PREFETCH_WORKERS = int(os.environ.get("AUDIO_PREFETCH_WORKERS", "2"))
+# 允许预取的域名，逗号分隔；以 . 开头的表示该域名的所有子域名
+AUDIO_ALLOWED_HOSTS = tuple(
+    host.strip().lower() for host in
+    os.environ.get("AUDIO_CACHE_ALLOWED_HOSTS", "cdn1.suno.ai,cdn2.suno.ai,audiopipe.suno.ai").split(",")
+    if host.strip())
+AUDIO_ALLOW_PRIVATE = os.environ.get("AUDIO_CACHE_ALLOW_PRIVATE", "0") == "1"   # 仅供本地测试 (mock 在 127.0.0.1)
+AUDIO_MAX_REDIRECTS = 3
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def audio_cache_key(url):
+    """远程链接 -> 本地文件名"""
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:32] + ".mp3"
+
+
+def host_allowed(host, allowed_hosts):
+    """host 是否在白名单里 (".example.com" 匹配所有子域名)"""
+    host = (host or "").lower().rstrip(".")
+    return any(host == allowed or (allowed.startswith(".") and host.endswith(allowed)) for allowed in allowed_hosts)
+
+
+def _is_public(address):
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def public_address(host, port):
+    """解析 host：所有地址都是公网地址时返回其中第一个，否则 (或解析失败) 抛 ValueError"""
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (OSError, UnicodeError):
+        infos = []
+    if not infos or not all(_is_public(info[4][0]) for info in infos):
+        raise ValueError(f"域名解析到内网地址或解析失败: {host}")
+    return infos[0][4][0]
+
+
+class _PublicAddressMixin:
+    """建立连接时解析一次域名并检查，然后直接连这个地址
+
+    Host 头、TLS 的 SNI 和证书校验仍然用原来的域名 (self.host)，只有连接的地址 (_dns_host) 被换掉。
+    """
+
+    def _new_conn(self):
+        self._dns_host = public_address(self.host, self.port)
+        return super()._new_conn()
+
+
+class _PublicHTTPConnection(_PublicAddressMixin, HTTPConnection):
+    pass
+
+
+class _PublicHTTPSConnection(_PublicAddressMixin, HTTPSConnection):
+    pass
+
+
+class _PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _PublicHTTPConnection
+
+
+class _PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _PublicHTTPSConnection
+
+
+class _PublicAddressAdapter(HTTPAdapter):
+    """只连接公网地址的 HTTPAdapter"""
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _PublicHTTPConnectionPool,
+            "https": _PublicHTTPSConnectionPool,
+        }
+
+
+def _download_session(allow_private):
+    """下载音频用的会话：不和 Dify 的共用 (Dify 可能就部署在本机或内网)"""
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504), raise_on_status=False)
+    if allow_private:
+        adapter = HTTPAdapter(max_retries=retry)
+    else:
+        adapter = _PublicAddressAdapter(max_retries=retry)
+        session.trust_env = False  # 走代理时域名由代理解析，本地的地址检查就没有意义了
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class AudioCache:
+    """MP3 磁盘缓存 + 后台预取 (线程安全)"""
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, url_prefix=AUDIO_CACHE_URL, max_bytes=AUDIO_CACHE_MAX_BYTES,
+                 max_file_bytes=AUDIO_MAX_FILE_BYTES, workers=AUDIO_PREFETCH_WORKERS, serve=True,
+                 allowed_hosts=AUDIO_ALLOWED_HOSTS, allow_private=AUDIO_ALLOW_PRIVATE):
+        self.directory = directory
+        self.url_prefix = url_prefix.rstrip("/")
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.session = _download_session(allow_private)
+        self.serve = serve  # 没开静态文件服务时本地文件无法访问，只用原链接
+        self.allowed_hosts = allowed_hosts
+        self.allow_private = allow_private
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="audio-prefetch")
+        self._pending = {}  # 文件名 -> Future
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.download_bytes = 0
+        self.failures = 0
+        self.evictions = 0
+        self.rejected = 0   # 不在白名单里、或指向内网地址的链接
+
+    def allowed(self, url):
+        """链接是否可以预取：http(s) 且域名在白名单里 (不做 DNS 解析)"""
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            return False
+        return parts.scheme in ("http", "https") and host_allowed(parts.hostname, self.allowed_hosts)
+
+    def prefetch(self, url):
+        """后台下载 (已缓存或正在下载时什么都不做)；返回 Future 或 None"""
+        if not self.serve:
+            return None
+        if not self.allowed(url):
+            with self._lock:
+                self.rejected += 1
+            return None
+        key = audio_cache_key(url)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            if os.path.exists(self._path(key)):
+                return None
+            future = self._pending[key] = self._executor.submit(self._download, url, key)
+        return future
+
+    def url_for(self, url, site_root=None):
+        """播放用的地址：已缓存返回本站地址 (并记一次使用)，否则开始预取并返回原链接
+
+        site_root 为站点根的绝对地址，例如 http://localhost:8501/；为空时只能用原链接。
+        """
+        if not self.serve or not site_root:
+            return url
+        key = audio_cache_key(url)
+        path = self._path(key)
+        try:
+            os.utime(path)  # 更新 mtime，作为 LRU 的"最近使用"
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            self.prefetch(url)
+            return url
+        with self._lock:
+            self.hits += 1
+        return f"{site_root.rstrip('/')}/{self.url_prefix}/{key}"
+
+    def stats(self):
+        files, total = 0, 0
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.startswith("."):
+                    files += 1
+                    total += entry.stat().st_size
+        except OSError:
+            pass
+        with self._lock:
+            return {
+                "files": files,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "downloads": self.downloads,
+                "download_bytes": self.download_bytes,
+                "failures": self.failures,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+                "serving": self.serve,
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _check_target(self, url):
+        """下载 (或跟随重定向) 前检查白名单；地址是不是公网地址在建立连接时检查 (见 _PublicAddressMixin)"""
+        if not self.allowed(url):
+            raise ValueError(f"域名不在白名单内: {urlsplit(url).hostname}")
+
+    def _open(self, url):
+        """GET，不自动跟随重定向：每一跳都重新检查目标"""
+        for _ in range(AUDIO_MAX_REDIRECTS + 1):
+            self._check_target(url)
+            response = self.session.get(url, stream=True, allow_redirects=False,
+                                        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if not response.is_redirect:
+                return response
+            url = urljoin(url, response.headers.get("Location", ""))
+            response.close()
+        raise ValueError("重定向次数过多")
+
+    def _download(self, url, key):
+        tmp_path = os.path.join(self.directory, f".{key}.{threading.get_ident()}.part")
+        size = 0
+        try:
+            with self._open(url) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise ValueError(f"文件超过 {self.max_file_bytes} 字节")
+                        f.write(chunk)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            print(f"音频预取失败 {url}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            with self._lock:
+                self.failures += 1
+            return False
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        with self._lock:
+            self.downloads += 1
+            self.download_bytes += size
+        self._prune()
+        return True
+
+    def _prune(self):
+        """总大小超过上限时，从最久没用到的开始删"""
+        files = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.startswith("."):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            return
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
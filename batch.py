@@ -0,0 +1,218 @@
+"""批量生成 (无界面)
+
+对整批图片 / 提示词跑生成，复用 app 2.0.py 的上传与流式逻辑 (pipeline.run_generation)。
+
+清单 (manifest) 支持 CSV 或 JSONL，每行一个任务：
+    image   图片路径 (必填，相对路径以清单所在目录为准)
+    prompt  额外提示词 (可选)
+    id      任务 id (可选，默认由 image + prompt 生成)
+
+结果逐行追加写入 JSONL (链接、完整文本、各阶段耗时)，同时作为断点：
+重新运行同一条命令时，已成功的任务会被跳过，只跑剩下的和失败的。
+
+用法:
+    python batch.py manifest.csv -o results.jsonl --concurrency 4 --rate 0.2
+    DIFY_API_KEY=app-xxx python batch.py prompts.jsonl -o out.jsonl
+    python batch.py manifest.csv -o out.jsonl --api-key app-a --api-key app-b   # 多个 key 轮流使用，各自限流
+    python batch.py manifest.csv -o out.jsonl --result-cache cache.sqlite3        # 相同图片 + 提示词复用结果
+"""
+import argparse
+import csv
+import itertools
+import json
+import mimetypes
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dify_http import PooledSession
+from jobs import DONE, FAILED, Job
+from pipeline import (STOP_AFTER_LINKS, STOP_AFTER_NODE, CompletionPolicy, GenerationRequest,
+                      run_generation)
+from ratelimit import TokenBucket
+from result_cache import ResultCache
+from upload_cache import UploadCache
+
+DEFAULT_BASE_URL = "https://api.dify.ai/v1"
+
+
+def _field(path, line_no, row, key):
+    """清单里的一个字段 -> 去掉首尾空白的字符串；JSONL 里的数字 (例如 "id": 12) 转成字符串"""
+    value = row.get(key)
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str):
+        raise ValueError(f"{path} 第 {line_no} 条的 {key} 不是字符串或数字: {value!r}")
+    return value.strip()
+
+
+def load_manifest(path):
+    """读取清单，返回任务列表 [{"id", "image", "prompt"}]"""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    items = []
+    seen = {}
+    for line_no, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            raise ValueError(f"{path} 第 {line_no} 条不是 JSON 对象")
+        image = _field(path, line_no, row, "image")
+        if not image:
+            raise ValueError(f"{path} 第 {line_no} 条缺少 image")
+        prompt = _field(path, line_no, row, "prompt")
+        item_id = _field(path, line_no, row, "id")
+        if not item_id:
+            # 同一图片 + 提示词重复出现时 (例如重复采样) 加序号区分
+            item_id = f"{image}|{prompt}"
+            seen[item_id] = seen.get(item_id, 0) + 1
+            if seen[item_id] > 1:
+                item_id = f"{item_id}#{seen[item_id]}"
+        if not os.path.isabs(image):
+            image = os.path.join(base_dir, image)
+        items.append({"id": item_id, "image": image, "prompt": prompt})
+    return items
+
+
+def load_checkpoint(output_path):
+    """已成功的任务 id (从之前写出的结果文件中读取)"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 上次崩溃时可能写了半行
+            if record.get("status") == DONE:
+                done.add(record.get("id"))
+    return done
+
+
+class BatchRunner:
+    """有界并发 + 按 key 限流的批量执行器"""
+
+    def __init__(self, base_url, api_keys, output_path, concurrency=4, rate=0.5, burst=1, user="batch",
+                 result_cache=None, force=False, policy=None):
+        self.base_url = base_url.rstrip("/")
+        self.api_keys = list(api_keys)
+        self.output_path = output_path
+        self.concurrency = concurrency
+        self.user = user
+        self.buckets = {key: TokenBucket(rate, burst) for key in self.api_keys}
+        self.session = PooledSession(pool_maxsize=max(concurrency, 1))
+        self.upload_cache = UploadCache()
+        self.result_cache = result_cache
+        self.force = force
+        self.policy = policy
+        self._keys = itertools.cycle(self.api_keys)
+        self._keys_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _next_key(self):
+        with self._keys_lock:
+            return next(self._keys)
+
+    def run_item(self, item):
+        api_key = self._next_key()
+        job = Job(item["id"])
+        job.set_phase("rate_limit")
+        self.buckets[api_key].acquire()
+        job._start()
+        record = {"id": item["id"], "image": item["image"], "prompt": item["prompt"]}
+        try:
+            with open(item["image"], "rb") as f:
+                image_bytes = f.read()
+            mime = mimetypes.guess_type(item["image"])[0] or "application/octet-stream"
+            request = GenerationRequest(self.base_url, api_key, image_bytes, os.path.basename(item["image"]),
+                                        mime, prompt=item["prompt"], user=self.user, force=self.force)
+            run_generation(job, self.session, request, self.upload_cache, result_cache=self.result_cache,
+                           policy=self.policy)
+            job._finish(DONE)
+        except Exception as e:
+            job._finish(FAILED, error=str(e), error_phase=getattr(e, "phase", job.phase))
+        record.update({
+            "status": job.status,
+            "links": job.links,
+            "text": job.text,
+            "error": job.error,
+            "error_phase": job.error_phase,
+            "timings": {phase: round(seconds, 3) for phase, seconds in job.phase_durations().items()},
+            "total_seconds": round(job.elapsed(), 3),
+            "first_link_seconds": job.info.get("first_link_seconds"),
+            "early_stop": job.info.get("early_stop"),
+            "cache": job.info.get("result_cache"),
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+        })
+        self._write(record)
+        return record
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._write_lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def run(self, items, progress=print):
+        done = load_checkpoint(self.output_path)
+        todo = [item for item in items if item["id"] not in done]
+        progress(f"共 {len(items)} 个任务，已完成 {len(items) - len(todo)} 个，本次运行 {len(todo)} 个")
+        counts = {DONE: 0, FAILED: 0}
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as executor:
+            futures = [executor.submit(self.run_item, item) for item in todo]
+            for n, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                counts[record["status"]] = counts.get(record["status"], 0) + 1
+                detail = f"{len(record['links'])} 个链接" if record["status"] == DONE else record["error"]
+                progress(f"[{n}/{len(todo)}] {record['status']} {record['id']} - {detail}")
+        if self.result_cache is not None:
+            progress(f"结果缓存: {self.result_cache.stats()}")
+        progress(f"完成 {counts[DONE]} 个，失败 {counts[FAILED]} 个，用时 {time.time() - start:.0f} 秒")
+        return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="CSV 或 JSONL 清单")
+    parser.add_argument("-o", "--output", required=True, help="结果 JSONL (同时作为断点文件)")
+    parser.add_argument("--base-url", default=os.environ.get("DIFY_BASE_URL", DEFAULT_BASE_URL))
+    parser.add_argument("--api-key", action="append", help="Dify API Key，可重复；默认读 DIFY_API_KEY")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的生成数")
+    parser.add_argument("--rate", type=float, default=0.5, help="每个 key 每秒最多发起几次生成")
+    parser.add_argument("--burst", type=int, default=1, help="每个 key 允许的突发次数")
+    parser.add_argument("--user", default="batch", help="传给 Dify 的 user 标识")
+    parser.add_argument("--result-cache", metavar="PATH", help="结果缓存 SQLite 文件；相同图片 + 提示词直接复用")
+    parser.add_argument("--force", action="store_true", help="忽略结果缓存，全部重新生成")
+    parser.add_argument("--stop-after-links", type=int, default=STOP_AFTER_LINKS, help="拿到几个链接就提前结束 (0 = 不提前)")
+    parser.add_argument("--stop-after-node", default=STOP_AFTER_NODE, help="该节点跑完后提前结束")
+    args = parser.parse_args(argv)
+
+    api_keys = args.api_key or ([os.environ["DIFY_API_KEY"]] if os.environ.get("DIFY_API_KEY") else [])
+    if not api_keys:
+        parser.error("需要 --api-key 或环境变量 DIFY_API_KEY")
+
+    items = load_manifest(args.manifest)
+    runner = BatchRunner(args.base_url, api_keys, args.output, concurrency=args.concurrency,
+                         rate=args.rate, burst=args.burst, user=args.user,
+                         result_cache=ResultCache(args.result_cache) if args.result_cache else None,
+                         force=args.force,
+                         policy=CompletionPolicy(args.stop_after_links, args.stop_after_node))
+    counts = runner.run(items)
+    return 1 if counts.get(FAILED) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
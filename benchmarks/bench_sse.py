@@ -0,0 +1,140 @@
+"""SSE 解析微基准
+
+对比旧的 iter_lines + decode + json.loads 写法与 sse.py 的增量解析器，
+输出 events/sec 和 MB/s。
+
+用法:
+    python benchmarks/bench_sse.py                    # 合成的大流 (默认 20000 个事件)
+    python benchmarks/bench_sse.py --events 100000
+    python benchmarks/bench_sse.py --file stream.bin  # 录制下来的原始字节流
+    python benchmarks/bench_sse.py --file captures/20250101-120000-ab12cd34.sse.gz  # sse_capture 的录制文件
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sse  # noqa: E402
+from sse_capture import CAPTURE_SUFFIX, read_capture  # noqa: E402
+
+
+def synthetic_stream(n_events):
+    """生成一条接近真实 Dify 输出的流：大量 message 事件夹杂节点事件和 ping"""
+    parts = []
+    ids = {"conversation_id": "c0a8f9c2-2b1e-4f0e-9a55-9d3f1b7f0e11",
+           "message_id": "5ad4cb98-f0c7-4085-b384-88c403be6290",
+           "task_id": "a5e1e0d3-6f1c-4c9b-8a1c-1c9a0f3f2b7e"}
+    for i in range(n_events):
+        if i % 50 == 0:
+            payload = {"event": "node_started", **ids,
+                       "data": {"id": f"node-{i}", "node_id": f"{i}", "title": f"节点 {i // 50}",
+                                "index": i // 50, "inputs": {"pic": [{"type": "image"}]}}}
+        elif i % 50 == 49:
+            payload = {"event": "node_finished", **ids,
+                       "data": {"id": f"node-{i}", "title": f"节点 {i // 50}", "elapsed_time": 1.25,
+                                "outputs": {"text": "x" * 400}, "status": "succeeded"}}
+        else:
+            payload = {"event": "message", **ids, "created_at": 1700000000 + i,
+                       "answer": "旋律在画面中缓缓展开，" if i % 7 else "https://cdn.example.com/a.mp3 "}
+        parts.append(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+        if i % 200 == 0:
+            parts.append(b"event: ping\n\n")
+    return b"".join(parts)
+
+
+def split_chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def legacy_parse(chunks):
+    """原来 app.py 中的写法 (requests.iter_lines 的分行逻辑 + 每行 decode/json.loads)"""
+    count = 0
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        for line in lines:
+            if line:
+                decoded_line = line.decode("utf-8")
+                if decoded_line.startswith("data: "):
+                    try:
+                        data = json.loads(decoded_line[6:])
+                        if data.get("event") in ("message", "agent_message", "text_chunk"):
+                            count += 1
+                    except Exception:
+                        pass
+    return count
+
+
+def decoder_only(chunks):
+    decoder = sse.SSEDecoder()
+    count = 0
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+    return count
+
+
+def dify_parse(chunks, events=None, loads=None):
+    count = 0
+    for _ in sse.iter_dify_events(chunks, events=events, loads=loads):
+        count += 1
+    return count
+
+
+def bench(name, func, chunks, total_bytes, repeat):
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = func(chunks)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<38} {count:>8} ev  {count / best:>12,.0f} ev/s  {total_bytes / best / 1e6:>8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=20000, help="合成流的事件数")
+    parser.add_argument("--file", help="录制的原始 SSE 字节流文件 (或 .sse.gz 录制文件)")
+    parser.add_argument("--chunk-sizes", default="512,4096,65536", help="模拟网络分块大小，逗号分隔")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.file and args.file.endswith(CAPTURE_SUFFIX):
+        data = b"".join(chunk for _, chunk in read_capture(args.file)[1])
+    elif args.file:
+        with open(args.file, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic_stream(args.events)
+    print(f"stream: {len(data) / 1e6:.1f} MB, JSON backend: {sse.JSON_BACKEND}")
+
+    cases = [
+        ("legacy iter_lines + json", legacy_parse),
+        ("SSEDecoder (framing only)", decoder_only),
+        ("iter_dify_events json", lambda c: dify_parse(c, loads=sse.stdlib_loads)),
+        ("iter_dify_events json + filter", lambda c: dify_parse(c, sse.ANSWER_EVENTS, sse.stdlib_loads)),
+    ]
+    if sse.orjson is not None:
+        cases += [
+            ("iter_dify_events orjson", lambda c: dify_parse(c, loads=sse.orjson.loads)),
+            ("iter_dify_events orjson + filter", lambda c: dify_parse(c, sse.ANSWER_EVENTS, sse.orjson.loads)),
+        ]
+
+    for size in (int(s) for s in args.chunk_sizes.split(",")):
+        chunks = split_chunks(data, size)
+        print(f"\n--- chunk size {size} ---")
+        for name, func in cases:
+            bench(name, func, chunks, len(data), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""前端压测：N 个并发会话跑完整的生成流程
+
+每个会话是一个 Streamlit AppTest 实例 (真实执行页面脚本：上传图片、点击生成、
+等结果出来)。AppTest 依赖进程级的 Runtime 单例，同一进程里不能并发跑多个，
+所以每个会话放在独立的子进程里，同时开始；Dify 由 mock_dify.py 在另一个子进程中模拟，
+也可以用 --base-url 指向已有服务。
+
+输出端到端延迟 p50 / p95、成功率，以及每个会话在"服务端"(页面脚本 + 后台任务)
+消耗的 CPU 时间和内存增量 (不含 Streamlit 本身的导入开销)，用来估算每个副本能承载多少并发。
+
+用法:
+    python benchmarks/load_test.py --sessions 8
+    python benchmarks/load_test.py --app app.py --sessions 4 --token-rate 100
+    python benchmarks/load_test.py --sessions 16 --fail-rate 0.05 --drop-rate 0.05
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_dify  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+
+def _rss_mb():
+    """当前常驻内存 (MB)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        # 非 Linux：只能拿到峰值
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def make_image(seed, size=640):
+    """每个会话一张不同的图 (避免上传缓存让结果失真)"""
+    from PIL import Image
+    rng = random.Random(seed)
+    img = Image.new("RGB", (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    for _ in range(200):
+        x, y = rng.randrange(size), rng.randrange(size)
+        img.putpixel((x, y), tuple(rng.randrange(256) for _ in range(3)))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+def start_mock(args):
+    """在子进程启动 mock_dify.py，返回 (进程, base_url)"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_dify.py"),
+               "--port", "0"]
+    for name in ("nodes", "tokens", "token_rate", "links", "link_at", "upload_latency",
+                 "first_event_latency", "node_latency", "ping_interval", "fail_rate", "drop_rate",
+                 "error_rate", "stall_rate", "stall_seconds", "seed"):
+        value = getattr(args, name)
+        if value is not None:
+            command += ["--" + name.replace("_", "-"), str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    return process, line.rsplit(" ", 1)[-1].strip()
+
+
+class Session:
+    """一个用户会话：驱动页面脚本跑一次生成"""
+
+    def __init__(self, app_path, base_url, image, index, timeout):
+        from streamlit.testing.v1 import AppTest
+        self.at = AppTest.from_file(app_path, default_timeout=timeout)
+        self.base_url = base_url
+        self.image = image
+        self.index = index
+        self.timeout = timeout
+        self.latency = None
+        self.outcome = None
+        self.cpu = 0.0
+        self.rss_delta = 0.0
+
+    def run(self, start_event=None):
+        at = self.at
+        at.run()
+        inputs = {w.label: w for w in at.sidebar.text_input}
+        inputs["Dify Base URL"].set_value(self.base_url)
+        if not inputs["Dify API Key"].disabled:
+            inputs["Dify API Key"].set_value("app-load-test")
+        at.file_uploader[0].set_value((f"load-{self.index}.png", self.image, "image/png"))
+        at.run()  # 和浏览器一样，选好图片就 rerun 一次
+        inputs = {w.label: w for w in at.sidebar.text_input}
+        prompt = next(w for w in at.text_input if w.label not in inputs)
+        prompt.set_value(f"压测 {self.index}")
+        if start_event is not None:
+            start_event.wait()  # 所有会话就绪后同时点击
+        rss_before = _rss_mb()
+        cpu_before = time.process_time()
+        start = time.perf_counter()
+        at.button[0].click()
+        at.run()
+        # app 2.0 在后台跑任务，需要像浏览器一样反复刷新直到出结果
+        deadline = start + self.timeout
+        while not self._finished() and time.perf_counter() < deadline:
+            time.sleep(0.25)
+            at.run()
+        self.latency = time.perf_counter() - start
+        self.cpu = time.process_time() - cpu_before
+        self.rss_delta = _rss_mb() - rss_before
+        self.outcome = self._outcome()
+
+    def _finished(self):
+        at = self.at
+        return bool(at.exception or at.error or at.success
+                    or any(s.state in ("complete", "error") for s in at.status))
+
+    def _outcome(self):
+        at = self.at
+        if at.exception:
+            return "exception"
+        if at.error or any(s.state == "error" for s in at.status):
+            return "failed"
+        if at.success or any(s.state == "complete" for s in at.status):
+            return "ok"
+        return "timeout"
+
+
+def _session_worker(app_path, base_url, index, timeout, start_event, results):
+    """子进程：跑一个会话，把结果放进队列"""
+    try:
+        session = Session(app_path, base_url, make_image(index), index, timeout)
+        session.run(start_event)
+        results.put((index, session.outcome, session.latency, session.cpu, session.rss_delta))
+    except Exception as e:
+        print(f"会话 {index} 异常: {e}")
+        results.put((index, "exception", None, 0.0, 0.0))
+
+
+def _mock_stats(base_url):
+    """mock_dify 记录的请求计数"""
+    root = base_url.rsplit("/v1", 1)[0]
+    try:
+        with urllib.request.urlopen(f"{root}/stats", timeout=5) as response:
+            return json.loads(response.read())
+    except OSError as e:
+        print(f"读取 mock 统计失败: {e}")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="app 2.0.py", help="要压测的页面脚本")
+    parser.add_argument("--sessions", type=int, default=4, help="并发会话数")
+    parser.add_argument("--timeout", type=float, default=600, help="单个会话的超时 (秒)")
+    parser.add_argument("--warmup", type=float, default=8, help="等待各会话完成首屏渲染的时间 (秒)")
+    parser.add_argument("--base-url", help="使用已有的 Dify (或 mock) 服务，不启动 mock_dify")
+    mock_dify.add_arguments(parser)
+    args = parser.parse_args()
+
+    # 历史、缓存等本地文件放到临时目录，不污染工作区
+    workdir = tempfile.mkdtemp(prefix="maestro-load-")
+    for name, filename in (("HISTORY_DB_PATH", "history.sqlite3"), ("DIFY_RESULT_CACHE_PATH", "result_cache.sqlite3"),
+                           ("HISTORY_BLOB_DIR", "blobs"), ("WORKFLOW_TRACE_DB_PATH", "workflow_traces.sqlite3")):
+        os.environ.setdefault(name, os.path.join(workdir, filename))
+
+    mock_process = None
+    base_url = args.base_url
+    if not base_url:
+        mock_process, base_url = start_mock(args)
+    print(f"app: {args.app} | sessions: {args.sessions} | dify: {base_url}")
+
+    context = multiprocessing.get_context("spawn")
+    start_event = context.Event()
+    results = context.Queue()
+    app_path = os.path.join(ROOT, args.app)
+    workers = [context.Process(target=_session_worker, name=f"session-{i}",
+                               args=(app_path, base_url, i, args.timeout, start_event, results))
+               for i in range(args.sessions)]
+    try:
+        for worker in workers:
+            worker.start()
+        # 等各子进程导入 Streamlit、渲染完首屏再一起开始 (不计入耗时)
+        time.sleep(args.warmup)
+        wall_start = time.perf_counter()
+        start_event.set()
+        rows = [results.get(timeout=args.timeout + args.warmup + 60) for _ in workers]
+        wall = time.perf_counter() - wall_start
+        for worker in workers:
+            worker.join()
+        upstream = _mock_stats(base_url) if mock_process is not None else None
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        if mock_process is not None:
+            mock_process.terminate()
+
+    latencies = sorted(latency for _, outcome, latency, _, _ in rows if outcome == "ok")
+    outcomes = {}
+    for _, outcome, _, _, _ in rows:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    n = len(rows)
+    cpu = sorted(row[3] for row in rows)
+    rss = [row[4] for row in rows]
+    print(f"结果: {outcomes}")
+    print(f"端到端延迟 (成功的会话): p50 {percentile(latencies, 0.5):.2f}s"
+          f" | p95 {percentile(latencies, 0.95):.2f}s | max {max(latencies, default=0):.2f}s")
+    print(f"总耗时 {wall:.1f}s | 吞吐 {n / wall * 60:.1f} 次/分钟")
+    print(f"每会话 CPU: 平均 {sum(cpu) / n:.3f}s | p95 {percentile(cpu, 0.95):.3f}s")
+    print(f"每会话内存增量: 平均 {sum(rss) / n:.1f} MB | max {max(rss, default=0):.1f} MB")
+    if upstream is not None:
+        print(f"上游调用: 上传 {upstream.get('upload', 0)} 次 | 对话 {upstream.get('chat', 0)} 次")
+    return 0 if outcomes.get("ok") == n else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,373 @@
+"""本地模拟的 Dify 服务 (压测 / 回归测试用，不消耗真实额度)
+
+实现前端用到的接口：
+    POST /v1/files/upload                 返回 {"id": ...}
+    POST /v1/chat-messages                SSE 流：workflow_started -> 各节点 node_started /
+                                          message / node_finished -> message_end -> workflow_finished
+    POST /v1/chat-messages/{task_id}/stop 停止对应的流
+    GET  /v1/messages?conversation_id=    会话里的消息；工作流跑完前 answer 为空
+    GET  /v1/conversations?user=          用户最近的会话
+    GET  /v1/audio/{name}.mp3             假的音频文件 (流里给出的链接指向这里)
+    GET  /stats                           请求计数
+
+节点数、吐字速度、链接出现的位置、各种延迟和故障注入都可配置。
+和真实的 Dify 一样，流断开 (--drop-rate 或客户端断线) 后工作流在"服务端"继续跑，
+按预计的完成时间把回答写进消息，可用来测试断线恢复。
+
+用法:
+    python benchmarks/mock_dify.py --port 8765 --nodes 6 --token-rate 40 --link-at 0.5
+    python benchmarks/mock_dify.py --fail-rate 0.1 --drop-rate 0.05   # 故障注入
+然后把前端的 Dify Base URL 设为 http://127.0.0.1:8765/v1
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+_STOP_RE = re.compile(r"^(?:/v1)?/chat-messages/([^/]+)/stop$")
+_AUDIO_RE = re.compile(r"^(?:/v1)?/audio/([\w.-]+\.mp3)$")
+
+FAKE_MP3 = b"ID3\x03\x00\x00\x00\x00\x00\x0f" + bytes(range(256)) * 64
+
+
+class MockConfig:
+    """模拟服务的行为参数"""
+
+    def __init__(self, nodes=5, tokens=200, token_rate=50.0, links=2, link_at=0.9,
+                 upload_latency=0.05, first_event_latency=0.5, node_latency=0.2, ping_interval=10.0,
+                 fail_rate=0.0, drop_rate=0.0, error_rate=0.0, stall_rate=0.0, stall_seconds=600.0, seed=None):
+        self.nodes = nodes                              # 工作流节点数
+        self.tokens = tokens                            # 回答的 message 事件数
+        self.token_rate = token_rate                    # 每秒几个 message 事件 (<=0 不限速)
+        self.links = links                              # 回答里的 MP3 链接数
+        self.link_at = link_at                          # 链接出现在回答的什么位置 (0 ~ 1)
+        self.upload_latency = upload_latency            # 上传接口延迟 (秒)
+        self.first_event_latency = first_event_latency  # 响应头之后多久发第一个事件
+        self.node_latency = node_latency                # 每个节点开始时额外停顿
+        self.ping_interval = ping_interval              # 空闲多久发一次 ping
+        self.fail_rate = fail_rate                      # 直接返回 HTTP 500 的比例 (上传和对话)
+        self.drop_rate = drop_rate                      # 流中途断开连接的比例
+        self.error_rate = error_rate                    # 流中途发 error 事件的比例
+        self.stall_rate = stall_rate                    # 流中途卡住 (只发 ping) 的比例
+        self.stall_seconds = stall_seconds              # 卡住多久 (任务被停止时提前结束)
+        self.random = random.Random(seed)
+
+
+class MockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def inc(self, key, value=1):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockDify/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    # --- 通用 ---
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _should(self, rate):
+        with self.server.random_lock:
+            return rate > 0 and self.config.random.random() < rate
+
+    # --- 路由 ---
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if path == "/stats":
+            self._send_json(200, self.server.stats.snapshot())
+            return
+        if path.endswith("/messages"):
+            self.server.stats.inc("messages")
+            self._send_json(200, {"data": self.server.list_messages(query.get("conversation_id", ""),
+                                                                    query.get("user", "")),
+                                  "has_more": False, "limit": 20})
+            return
+        if path.endswith("/conversations"):
+            self.server.stats.inc("conversations")
+            self._send_json(200, {"data": self.server.list_conversations(query.get("user", "")),
+                                  "has_more": False, "limit": 20})
+            return
+        match = _AUDIO_RE.match(path)
+        if match:
+            self.server.stats.inc("audio")
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Content-Length", str(len(FAKE_MP3)))
+            self.end_headers()
+            self.wfile.write(FAKE_MP3)
+            return
+        self._send_json(404, {"code": "not_found", "message": path})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self._read_body()
+        if path.endswith("/files/upload"):
+            self._upload()
+        elif path.endswith("/chat-messages"):
+            self._chat(body)
+        elif _STOP_RE.match(path):
+            task_id = _STOP_RE.match(path).group(1)
+            self.server.stopped.add(task_id)
+            self.server.stats.inc("stop")
+            self._send_json(200, {"result": "success"})
+        else:
+            self._send_json(404, {"code": "not_found", "message": path})
+
+    def _upload(self):
+        self.server.stats.inc("upload")
+        time.sleep(self.config.upload_latency)
+        if self._should(self.config.fail_rate):
+            self.server.stats.inc("upload_failed")
+            self._send_json(500, {"code": "internal_server_error", "message": "injected failure"})
+            return
+        self._send_json(201, {"id": str(uuid.uuid4()), "name": "image.jpg", "mime_type": "image/jpeg"})
+
+    def _chat(self, body):
+        self.server.stats.inc("chat")
+        if self._should(self.config.fail_rate):
+            self.server.stats.inc("chat_failed")
+            self._send_json(500, {"code": "internal_server_error", "message": "injected failure"})
+            return
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            request = {}
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.server.stats.inc("streams_active")
+        try:
+            self._stream(request.get("user", ""), request.get("query", ""))
+        except OSError:
+            self.server.stats.inc("client_disconnected")
+        finally:
+            self.server.stats.inc("streams_active", -1)
+
+    # --- SSE ---
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, user, query):
+        config = self.config
+        ids = {"task_id": str(uuid.uuid4()), "message_id": str(uuid.uuid4()),
+               "conversation_id": str(uuid.uuid4())}
+        host = self.headers.get("Host", "127.0.0.1")
+        links = [f"http://{host}/v1/audio/{ids['message_id']}-{i + 1}.mp3" for i in range(config.links)]
+        link_index = int(config.link_at * config.tokens)
+        answers = [f"第{token}段旋律 " + (" ".join(links) + " " if token == link_index else "")
+                   for token in range(config.tokens)]
+        if link_index >= config.tokens:
+            answers.append(" ".join(links) + " ")
+        # 工作流在"服务端"的预计完成时间：流断开后到这个时间点回答才可查
+        expected = (config.first_event_latency + config.nodes * config.node_latency
+                    + (config.tokens / config.token_rate if config.token_rate > 0 else 0))
+        message = self.server.add_message(ids, user, query, "".join(answers), time.time() + expected)
+        drop_at = config.random.randrange(config.tokens + 1) if self._should(config.drop_rate) else None
+        error_at = config.random.randrange(config.tokens + 1) if self._should(config.error_rate) else None
+        stall_at = config.random.randrange(config.tokens + 1) if self._should(config.stall_rate) else None
+        tokens_per_node = max(1, config.tokens // max(config.nodes, 1))
+        last_write = [time.monotonic()]
+
+        def send(payload, event=None):
+            payload = {**payload, **ids, "created_at": int(time.time())}
+            frame = b""
+            if event:
+                frame += b"event: " + event.encode() + b"\n"
+            frame += b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n"
+            self._write_chunk(frame)
+            last_write[0] = time.monotonic()
+
+        def pause(seconds):
+            """等待，期间按 ping_interval 发 ping；任务被停止时提前返回"""
+            deadline = time.monotonic() + seconds
+            while True:
+                now = time.monotonic()
+                if now >= deadline or ids["task_id"] in self.server.stopped:
+                    return
+                if config.ping_interval and now - last_write[0] >= config.ping_interval:
+                    self._write_chunk(b"event: ping\n\n")
+                    last_write[0] = now
+                time.sleep(min(deadline - now, config.ping_interval or 1.0, 0.5))
+
+        pause(config.first_event_latency)
+        send({"event": "workflow_started", "data": {"id": ids["task_id"], "workflow_id": "mock"}})
+        token = 0
+        for node in range(config.nodes):
+            node_id = f"node-{node + 1}"
+            title = f"节点 {node + 1}"
+            started = time.monotonic()
+            send({"event": "node_started", "data": {"id": node_id, "node_id": node_id, "node_type": "llm",
+                                                     "title": title, "index": node + 1}})
+            pause(config.node_latency)
+            budget = tokens_per_node if node < config.nodes - 1 else config.tokens - token
+            for _ in range(max(budget, 0)):
+                if token == stall_at:
+                    self.server.stats.inc("stalled")
+                    stall_at = None
+                    pause(config.stall_seconds)
+                if ids["task_id"] in self.server.stopped:
+                    self.server.stats.inc("stopped")
+                    message.update(answer="".join(answers[:token]), ready_at=time.time())
+                    self.wfile.write(b"0\r\n\r\n")
+                    return
+                if token == drop_at:
+                    self.server.stats.inc("dropped")
+                    self.close_connection = True
+                    return  # 不发结束块，直接断开
+                if token == error_at:
+                    self.server.stats.inc("error_event")
+                    send({"event": "error", "status": 500, "code": "injected", "message": "injected stream error"})
+                    message.update(status="error", error="injected stream error", answer="", ready_at=time.time())
+                    self.wfile.write(b"0\r\n\r\n")
+                    return
+                send({"event": "message", "answer": answers[token]})
+                token += 1
+                if config.token_rate > 0:
+                    pause(1.0 / config.token_rate)
+            send({"event": "node_finished", "data": {"id": node_id, "node_id": node_id, "node_type": "llm",
+                                                      "title": title, "index": node + 1, "status": "succeeded",
+                                                      "elapsed_time": round(time.monotonic() - started, 3),
+                                                      "execution_metadata": {"total_tokens": max(budget, 0)},
+                                                      "outputs": {"text": "x" * 200}}})
+        if link_index >= config.tokens:
+            send({"event": "message", "answer": answers[-1]})
+        message["ready_at"] = time.time()
+        send({"event": "message_end", "metadata": {"usage": {"total_tokens": config.tokens}}})
+        send({"event": "workflow_finished", "data": {"status": "succeeded"}})
+        self.wfile.write(b"0\r\n\r\n")
+        self.server.stats.inc("completed")
+
+
+class MockDifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, _Handler)
+        self.config = config
+        self.stats = MockStats()
+        self.stopped = set()
+        self.random_lock = threading.Lock()
+        self.messages = {}          # message_id -> 消息 (含内部字段 user / ready_at)
+        self._messages_lock = threading.Lock()
+
+    def add_message(self, ids, user, query, answer, ready_at):
+        message = {"id": ids["message_id"], "conversation_id": ids["conversation_id"], "query": query,
+                   "answer": answer, "status": "normal", "error": None, "created_at": int(time.time()),
+                   "user": user, "ready_at": ready_at}
+        with self._messages_lock:
+            self.messages[message["id"]] = message
+        return message
+
+    def list_messages(self, conversation_id, user):
+        """接口返回的消息：工作流还没跑完时 answer 为空"""
+        now = time.time()
+        with self._messages_lock:
+            found = [dict(m) for m in self.messages.values()
+                     if m["conversation_id"] == conversation_id and m["user"] == user]
+        for message in found:
+            if now < message.pop("ready_at"):
+                message["answer"] = ""
+            message.pop("user")
+        return found
+
+    def list_conversations(self, user):
+        with self._messages_lock:
+            found = [m for m in self.messages.values() if m["user"] == user]
+        found.sort(key=lambda m: m["created_at"], reverse=True)
+        return [{"id": m["conversation_id"], "name": m["query"] or "新会话", "status": "normal",
+                 "created_at": m["created_at"]} for m in found[:20]]
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start(config=None, host="127.0.0.1", port=0):
+    """在后台线程启动，返回 server (server.base_url 为接口地址)"""
+    server = MockDifyServer((host, port), config or MockConfig())
+    threading.Thread(target=server.serve_forever, name="mock-dify", daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    """把 MockConfig 的参数加到 argparse (load_test.py 复用)"""
+    group = parser.add_argument_group("模拟 Dify")
+    group.add_argument("--nodes", type=int, default=5, help="工作流节点数")
+    group.add_argument("--tokens", type=int, default=200, help="回答的 message 事件数")
+    group.add_argument("--token-rate", type=float, default=50.0, help="每秒 message 事件数 (<=0 不限速)")
+    group.add_argument("--links", type=int, default=2, help="MP3 链接数")
+    group.add_argument("--link-at", type=float, default=0.9, help="链接出现的位置 (0 ~ 1)")
+    group.add_argument("--upload-latency", type=float, default=0.05)
+    group.add_argument("--first-event-latency", type=float, default=0.5)
+    group.add_argument("--node-latency", type=float, default=0.2)
+    group.add_argument("--ping-interval", type=float, default=10.0)
+    group.add_argument("--fail-rate", type=float, default=0.0, help="HTTP 500 比例")
+    group.add_argument("--drop-rate", type=float, default=0.0, help="流中途断开比例")
+    group.add_argument("--error-rate", type=float, default=0.0, help="流中途 error 事件比例")
+    group.add_argument("--stall-rate", type=float, default=0.0, help="流中途卡住 (只发 ping) 比例")
+    group.add_argument("--stall-seconds", type=float, default=600.0, help="卡住多久")
+    group.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args):
+    return MockConfig(
+        nodes=args.nodes, tokens=args.tokens, token_rate=args.token_rate, links=args.links,
+        link_at=args.link_at, upload_latency=args.upload_latency,
+        first_event_latency=args.first_event_latency, node_latency=args.node_latency,
+        ping_interval=args.ping_interval, fail_rate=args.fail_rate, drop_rate=args.drop_rate,
+        error_rate=args.error_rate, stall_rate=args.stall_rate, stall_seconds=args.stall_seconds, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = MockDifyServer((args.host, args.port), config_from_args(args))
+    print(f"mock Dify listening on {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
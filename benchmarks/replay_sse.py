@@ -0,0 +1,147 @@
+"""回放录制的 SSE 流，测客户端的解析 / 链接提取 / 渲染开销
+
+录制文件由 DIFY_SSE_CAPTURE_DIR 打开的录制功能产生 (见 sse_capture.py)，也可以用
+--record 从 mock_dify.py 录几条。回放时每一块字节按录制时的到达时间 (或加速、或不等待)
+交给 ChatStream，走和页面完全一样的代码：DifyEventParser 解析、AudioLinkScanner 提取链接、
+StreamRenderBuffer 合并刷新 (占位符换成只计数的空对象，不含 Streamlit 前端的开销)。
+
+输出每个录制文件回放 --repeat 次的 CPU 时间、墙钟时间、首个事件 / 首个链接的时间
+(相对回放开始)，以及解析和渲染的统计；--speed 0 时墙钟时间基本就是 CPU 开销，
+适合做可重复的回归基准。
+
+用法:
+    python benchmarks/replay_sse.py captures/                         # 目录下所有录制文件，尽快回放
+    python benchmarks/replay_sse.py captures/a.sse.gz --speed 1       # 按原速
+    python benchmarks/replay_sse.py captures/ --speed 10 --repeat 3   # 10 倍速
+    python benchmarks/replay_sse.py --record captures/ --count 5 --tokens 2000   # 先从 mock 录 5 条
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_dify  # noqa: E402
+from dify_client import (TRACKED_EVENTS, AudioLinkScanner, ChatStream, DifyClient, StreamDropped,  # noqa: E402
+                         StreamWatchdog)
+from dify_http import PooledSession  # noqa: E402
+from load_test import start_mock  # noqa: E402
+from metrics import percentile  # noqa: E402
+from pipeline import PIPELINE_EVENTS  # noqa: E402
+from render_buffer import StreamRenderBuffer  # noqa: E402
+from sse import ANSWER_EVENTS, DifyEventParser  # noqa: E402
+from sse_capture import ReplayResponse, capture_files, read_capture, start_capture  # noqa: E402
+
+
+class NullPlaceholder:
+    """代替 st.empty()：只记录刷新次数和字节数"""
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    def markdown(self, body):
+        self.calls += 1
+        self.bytes += len(body.encode("utf-8"))
+
+
+def replay_once(frames, speed, events=PIPELINE_EVENTS):
+    """回放一次，返回各项耗时和统计"""
+    stream = ChatStream(ReplayResponse(frames, speed), DifyEventParser(events=events | TRACKED_EVENTS), events)
+    render_buffer = StreamRenderBuffer(NullPlaceholder())
+    scanner = AudioLinkScanner()
+    first_event = first_link = None
+    completed = True
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        with stream:
+            for events in stream.batches():
+                for event in events:
+                    if first_event is None:
+                        first_event = time.perf_counter() - wall_start
+                    if event.name in ANSWER_EVENTS:
+                        answer = event.payload.get("answer", "")
+                        render_buffer.append(answer)
+                        if scanner.feed(answer) and first_link is None:
+                            first_link = time.perf_counter() - wall_start
+                render_buffer.maybe_flush()   # 同 app.py：每批数据都检查一次，刷出积压的片段
+    except StreamDropped:
+        completed = False   # 录制的流本来就没有正常结束 (断线、提前收工)
+    render_buffer.finish()
+    if scanner.close() and first_link is None:
+        first_link = time.perf_counter() - wall_start
+    return {
+        "cpu": time.process_time() - cpu_start,
+        "wall": time.perf_counter() - wall_start,
+        "first_event": first_event,
+        "first_link": first_link,
+        "links": len(scanner.links),
+        "completed": completed,
+        "parser": stream.parser.stats(),
+        "render": render_buffer.stats(),
+    }
+
+
+def record(args):
+    """从 mock_dify 录几条流到 args.record 目录"""
+    mock_process, base_url = start_mock(args)
+    try:
+        client = DifyClient(base_url, "app-replay-benchmark-key", session=PooledSession(), user="replay-bench")
+        for i in range(args.count):
+            file_id, _ = client.upload(b"replay", f"{i}.png", "image/png", prepare=False)
+            stream = client.open_chat(file_id, "回放基准", events=PIPELINE_EVENTS,
+                                      watchdog=StreamWatchdog(first_event_timeout=0, idle_timeout=0))
+            stream.capture = start_capture(base_url, secrets=(client.api_key, file_id, client.user),
+                                           directory=args.record, rate=1)
+            with stream:
+                for _ in stream:
+                    pass
+            print(f"录制 {stream.capture.path}")
+    finally:
+        mock_process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="*", help="录制文件或目录")
+    parser.add_argument("--speed", type=float, default=0.0, help="回放速度: 1 原速, N 倍速, 0 不等待")
+    parser.add_argument("--repeat", type=int, default=5, help="每个录制文件回放几次")
+    parser.add_argument("--record", metavar="DIR", help="先从 mock_dify 录制到该目录 (之后回放这个目录)")
+    parser.add_argument("--count", type=int, default=3, help="--record 时录几条")
+    mock_dify.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.record:
+        record(args)
+        args.captures = args.captures or [args.record]
+    files = capture_files(args.captures)
+    if not files:
+        parser.error("没有找到录制文件")
+
+    print(f"速度: {'不等待' if args.speed <= 0 else f'{args.speed:g}x'} | 每个文件 {args.repeat} 次")
+    for path in files:
+        header, frames = read_capture(path)
+        runs = [replay_once(frames, args.speed) for _ in range(args.repeat)]
+        cpu = sorted(run["cpu"] for run in runs)
+        wall = sorted(run["wall"] for run in runs)
+        last = runs[-1]
+        mb = header["bytes"] / 1e6
+        print(f"\n{os.path.basename(path)}: {header['chunks']} 块 / {header['bytes']} 字节，"
+              f"录制时长 {header['duration']:.2f}s，{'完整' if last['completed'] else '未正常结束'}")
+        print(f"  CPU    p50 {percentile(cpu, 0.5) * 1000:.1f} ms | 最小 {min(cpu) * 1000:.1f} ms"
+              f" | {mb / max(min(cpu), 1e-9):.1f} MB/s")
+        print(f"  墙钟   p50 {percentile(wall, 0.5):.3f}s")
+        if last["first_event"] is not None:
+            print(f"  首个事件 {last['first_event']:.3f}s"
+                  + (f" | 首个链接 {last['first_link']:.3f}s" if last["first_link"] is not None else "")
+                  + f" | 链接 {last['links']} 个")
+        print(f"  解析   {last['parser']}")
+        print(f"  渲染   {last['render']}")
+
+
+if __name__ == "__main__":
+    main()
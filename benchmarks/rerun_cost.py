@@ -0,0 +1,310 @@
+"""页面 rerun 的开销：每次 rerun 的耗时和推给浏览器的字节数
+
+真实启动 streamlit run (子进程)，像浏览器一样通过 WebSocket (/_stcore/stream) 发 rerun，
+统计从发出请求到 script_finished 的耗时，以及期间收到的 ForwardMsg 字节数。
+页面上的每个片段 (st.fragment) 也单独 rerun 一遍，对比整页 rerun 的代价。场景：
+- idle        没有任务时：整页 rerun (任何片段外的交互) / 各片段单独 rerun
+- generating  生成中：整页 rerun / 状态片段的每秒刷新
+- done        生成结束后：整页 rerun / 结果片段
+Dify 由 mock_dify.py 模拟 (默认流 20 秒左右，足够测完 generating)；历史记录预先写入 --history 条。
+
+同一个脚本的两个版本可以分别跑一遍比较，例如改动前:
+    git show HEAD~1:"app 2.0.py" > "app 2.0 before.py"
+    python benchmarks/rerun_cost.py --app "app 2.0 before.py"
+
+用法:
+    python benchmarks/rerun_cost.py
+    python benchmarks/rerun_cost.py --repeat 20 --history 30
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_dify  # noqa: E402
+from load_test import ROOT, make_image, start_mock  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+from streamlit.proto.BackMsg_pb2 import BackMsg  # noqa: E402
+from streamlit.proto.Common_pb2 import FileUploaderState, UploadedFileInfo  # noqa: E402
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg  # noqa: E402
+from streamlit.proto.WidgetStates_pb2 import WidgetState  # noqa: E402
+
+HISTORY_TOKEN = "rerun-bench-" + "x" * 31   # 页面 URL 里的 uid (格式同 history_db.new_history_token)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _describe(delta):
+    """元素的简短描述 (用来给片段起名、找控件)"""
+    if delta.HasField("add_block"):
+        block = delta.add_block
+        return block.expandable.label if block.HasField("expandable") else ""
+    element = delta.new_element
+    kind = element.WhichOneof("type")
+    if kind is None:
+        return ""
+    value = getattr(element, kind)
+    return getattr(value, "body", "") or getattr(value, "label", "")
+
+
+class RunCost:
+    """一次 rerun 的开销和输出"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.bytes = 0
+        self.messages = 0
+        self.texts = []
+        self.widgets = {}    # (类型, 标签) -> 控件 id
+        self.fragments = {}  # 片段 id -> 片段里第一个有文字的元素
+
+
+class PageClient:
+    """一个浏览器会话：保存控件状态，每次 rerun 都带上 (和前端一样)"""
+
+    def __init__(self, http_url):
+        self.http_url = http_url.rstrip("/")
+        self.ws = None
+        self.session_id = None
+        self.widget_states = {}   # 控件 id -> WidgetState
+        self.cached_hashes = set()
+
+    async def connect(self):
+        ws_url = self.http_url.replace("http", "ws", 1) + "/_stcore/stream"
+        self.ws = await websockets.connect(ws_url, subprotocols=["streamlit"], max_size=None)
+
+    async def close(self):
+        await self.ws.close()
+
+    async def rerun(self, fragment_id="", triggers=()):
+        msg = BackMsg()
+        state = msg.rerun_script
+        state.query_string = f"uid={HISTORY_TOKEN}"
+        state.page_script_hash = ""
+        if fragment_id:
+            state.fragment_id = fragment_id
+            state.is_auto_rerun = True
+        state.cached_message_hashes.extend(sorted(self.cached_hashes))
+        state.widget_states.widgets.extend(self.widget_states.values())
+        for widget_id in triggers:
+            state.widget_states.widgets.add(id=widget_id, trigger_value=True)
+        cost = RunCost()
+        start = time.perf_counter()
+        await self.ws.send(msg.SerializeToString())
+        while True:
+            raw = await self.ws.recv()
+            cost.bytes += len(raw)
+            cost.messages += 1
+            forward = ForwardMsg()
+            forward.ParseFromString(raw)
+            kind = forward.WhichOneof("type")
+            if forward.metadata.cacheable:
+                self.cached_hashes.add(forward.hash)
+            if kind == "new_session":
+                self.session_id = forward.new_session.initialize.session_id
+            elif kind == "delta":
+                self._collect(cost, forward.delta)
+            elif kind == "script_finished":
+                break
+        cost.seconds = time.perf_counter() - start
+        await self._drain()
+        return cost
+
+    async def upload(self, uploader_id, name, data, mime):
+        """和前端一样：先要上传地址，PUT 文件，再把文件信息放进控件状态"""
+        msg = BackMsg()
+        msg.file_urls_request.request_id = "bench"
+        msg.file_urls_request.file_names.append(name)
+        msg.file_urls_request.session_id = self.session_id
+        await self.ws.send(msg.SerializeToString())
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(await self.ws.recv())
+            if forward.WhichOneof("type") == "file_urls_response":
+                urls = forward.file_urls_response.file_urls[0]
+                break
+        upload_url = urls.upload_url if urls.upload_url.startswith("http") else self.http_url + urls.upload_url
+        response = await asyncio.to_thread(requests.put, upload_url, files={"file": (name, data, mime)})
+        response.raise_for_status()
+        info = UploadedFileInfo(name=name, size=len(data), file_id=urls.file_id, file_urls=urls)
+        self.widget_states[uploader_id] = WidgetState(
+            id=uploader_id, file_uploader_state_value=FileUploaderState(uploaded_file_info=[info]))
+
+    def set_text(self, widget_id, value):
+        self.widget_states[widget_id] = WidgetState(id=widget_id, string_value=value)
+
+    async def _drain(self):
+        """片段里 st.rerun() 之类会紧接着再跑一次，读掉这些消息"""
+        while True:
+            try:
+                await asyncio.wait_for(self.ws.recv(), timeout=0.05)
+            except asyncio.TimeoutError:
+                return
+
+    @staticmethod
+    def _collect(cost, delta):
+        text = _describe(delta)
+        if text:
+            cost.texts.append(text)
+        if delta.fragment_id and text:
+            cost.fragments.setdefault(delta.fragment_id, text)
+        if delta.HasField("new_element"):
+            element = delta.new_element
+            kind = element.WhichOneof("type")
+            widget = getattr(element, kind) if kind else None
+            widget_id = getattr(widget, "id", "")
+            if widget_id:
+                cost.widgets[(kind, getattr(widget, "label", ""))] = widget_id
+
+
+class Report:
+    """按场景汇总的开销"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, name, cost):
+        self.rows.setdefault(name, []).append(cost)
+
+    def print(self):
+        print(f"{'场景':<36} {'次数':>4} {'p50 ms':>8} {'p95 ms':>8} {'平均 KB':>8} {'消息数':>6}")
+        for name, costs in self.rows.items():
+            ms = sorted(c.seconds * 1000 for c in costs)
+            kb = sum(c.bytes for c in costs) / len(costs) / 1024
+            messages = sum(c.messages for c in costs) / len(costs)
+            print(f"{name:<36} {len(costs):>4} {percentile(ms, 0.5):>8.1f} {percentile(ms, 0.95):>8.1f}"
+                  f" {kb:>8.1f} {messages:>6.0f}")
+
+
+async def measure(report, name, client, repeat, fragment_id="", interval=0.0):
+    for _ in range(repeat):
+        report.add(name, await client.rerun(fragment_id))
+        if interval:
+            await asyncio.sleep(interval)
+
+
+async def measure_fragments(report, scenario, client, cost, repeat, skip=()):
+    for fragment_id, title in cost.fragments.items():
+        if title not in skip:
+            await measure(report, f"{scenario} 片段「{title[:12]}」", client, repeat, fragment_id)
+
+
+async def run(http_url, args):
+    report = Report()
+    client = PageClient(http_url)
+    await client.connect()
+    try:
+        first = await client.rerun()
+        report.add("首屏", first)
+        await measure(report, "idle 整页", client, args.repeat)
+        idle = report.rows["idle 整页"][-1]
+        await measure_fragments(report, "idle", client, idle, args.repeat)
+
+        # 选图片、填提示词、点生成
+        uploader = next(wid for (kind, _), wid in idle.widgets.items() if kind == "file_uploader")
+        await client.upload(uploader, "bench.png", make_image(0), "image/png")
+        cost = await client.rerun()
+        prompt = next(wid for (kind, label), wid in cost.widgets.items()
+                      if kind == "text_input" and label not in ("Dify API Key", "Dify Base URL"))
+        base_url = next(wid for (kind, label), wid in cost.widgets.items() if label == "Dify Base URL")
+        client.set_text(base_url, args.dify_url)
+        client.set_text(prompt, "rerun 压测")
+        await client.rerun()
+        button = next(wid for (kind, label), wid in cost.widgets.items() if kind == "button" and "生成" in label)
+        started = await client.rerun(triggers=[button])
+        if not started.fragments:
+            print("没有看到生成中的状态片段，跳过 generating / done 场景")
+            return report
+
+        await measure(report, "generating 整页", client, args.repeat, interval=0.1)
+        generating = report.rows["generating 整页"][-1]
+        await measure_fragments(report, "generating", client, generating, args.repeat,
+                                skip=set(idle.fragments.values()))
+
+        # 像 run_every 一样每秒刷新状态片段，直到任务结束触发整页 rerun
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            cost = await client.rerun()
+            if any("生成完成" in text or "命中缓存" in text for text in cost.texts):
+                break
+            await asyncio.sleep(1)
+        else:
+            print("等待生成结束超时，跳过 done 场景")
+            return report
+        await measure(report, "done 整页", client, args.repeat)
+        done = report.rows["done 整页"][-1]
+        await measure_fragments(report, "done", client, done, args.repeat, skip=set(idle.fragments.values()))
+    finally:
+        await client.close()
+    return report
+
+
+def start_app(app_path, port, env):
+    command = [sys.executable, "-m", "streamlit", "run", app_path, "--server.headless", "true",
+               "--server.port", str(port), "--server.enableXsrfProtection", "false",
+               "--browser.gatherUsageStats", "false"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               text=True)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/_stcore/health", timeout=1).ok:
+                return process, url
+        except requests.RequestException:
+            time.sleep(0.3)
+    process.terminate()
+    raise RuntimeError(f"streamlit 没有启动: {process.stderr.read()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="app 2.0.py", help="要测的页面脚本")
+    parser.add_argument("--repeat", type=int, default=10, help="每个场景 rerun 几次")
+    parser.add_argument("--history", type=int, default=20, help="预先写入的历史记录条数")
+    parser.add_argument("--timeout", type=float, default=120, help="等待生成结束的时间 (秒)")
+    mock_dify.add_arguments(parser)
+    parser.set_defaults(tokens=400, token_rate=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="maestro-rerun-")
+    env = dict(os.environ)
+    for name, filename in (("HISTORY_DB_PATH", "history.sqlite3"), ("DIFY_RESULT_CACHE_PATH", "result_cache.sqlite3"),
+                           ("HISTORY_BLOB_DIR", "blobs"), ("WORKFLOW_TRACE_DB_PATH", "workflow_traces.sqlite3")):
+        env.setdefault(name, os.path.join(workdir, filename))
+    sys.path.insert(0, ROOT)
+    from history_db import HistoryDB, history_owner
+    history = HistoryDB(env["HISTORY_DB_PATH"])
+    for i in range(args.history):
+        history.add(history_owner(HISTORY_TOKEN), f"历史提示词 {i}", [f"https://example.com/{i}.mp3"])
+
+    mock_process, args.dify_url = start_mock(args)
+    app_process = None
+    try:
+        app_process, http_url = start_app(os.path.join(ROOT, args.app), _free_port(), env)
+        print(f"app: {args.app} | dify: {args.dify_url} | 历史 {args.history} 条")
+        report = asyncio.run(run(http_url, args))
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+        mock_process.terminate()
+    report.print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,770 @@
+"""Dify 接口的基础调用 (与 Streamlit 无关，可在后台线程中使用)
+
+- DifyClient: 同步客户端 (requests)，三个页面和 pipeline 都通过它调用 Dify
+- AsyncDifyClient: asyncio 客户端 (aiohttp)，一个事件循环里同时跑几十个流式对话，
+  不必每个流占一个线程
+- upload_image: 上传图片 (/files/upload)，可选走上传缓存和图片预处理
+- chat_payload: 构造 /chat-messages 请求体 (pic 变量 + files)
+- open_chat_stream: 发起流式对话，返回已检查状态码的响应
+- stop_chat_task: 请 Dify 停止还在跑的流式任务
+- fetch_message / find_conversation: 流断开后按 message_id 查回完整回答 (见 DifyClient.recover)
+- StreamWatchdog: 流还连着但上游卡住 (只有 ping、没有新事件) 时及早放弃
+- 设置 DIFY_SSE_CAPTURE_DIR 时把流的原始字节录制下来 (见 sse_capture.py)
+- extract_audio_links: 从回答文本中提取 MP3 链接 (去重)
+- AudioLinkScanner: 流式过程中逐块提取 MP3 链接，链接一完整就能拿到
+
+同步用法:
+    client = DifyClient(base_url, api_key, session=PooledSession())
+    file_id, _ = client.upload(data, "a.png", "image/png")
+    for event in client.stream_chat(file_id, "古典风格"):
+        ...
+
+异步用法 (需要安装 aiohttp):
+    async with AsyncDifyClient(base_url, api_key) as client:
+        file_id, _ = await client.upload(data, "a.png", "image/png")
+        async for event in client.stream_chat(file_id, "古典风格"):
+            ...
+"""
+import asyncio
+import os
+import re
+import time
+
+from dify_http import CONNECT_TIMEOUT, READ_TIMEOUT, PooledSession
+from image_prep import normalize_image
+from sse import DifyEventParser
+from sse_capture import start_capture
+from upload_cache import content_hash, upload_cache_key
+
+try:
+    import aiohttp
+except ImportError:  # 可选依赖，只有 AsyncDifyClient 需要
+    aiohttp = None
+
+DEFAULT_USER = "user-123"
+DEFAULT_QUERY = "生成音乐"
+
+# 异步客户端的连接上限 (流式对话会长时间占着连接)
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("DIFY_ASYNC_MAX_CONNECTIONS", "100"))
+
+# 流断开后轮询结果：间隔从 RESUME_FIRST_DELAY 起翻倍，最长 RESUME_MAX_DELAY；
+# 总共最多等 RESUME_MAX_WAIT 秒，连续 RESUME_MAX_ERRORS 次请求失败就放弃
+RESUME_MAX_WAIT = float(os.environ.get("DIFY_RESUME_MAX_WAIT", "300"))
+RESUME_FIRST_DELAY = float(os.environ.get("DIFY_RESUME_FIRST_DELAY", "2"))
+RESUME_MAX_DELAY = float(os.environ.get("DIFY_RESUME_MAX_DELAY", "15"))
+RESUME_MAX_ERRORS = int(os.environ.get("DIFY_RESUME_MAX_ERRORS", "5"))
+
+# 卡住检测 (见 StreamWatchdog)。Dify 空闲时会定时发 ping，ping 只说明连接还活着，不算进展：
+# - STREAM_READ_TIMEOUT: 连 ping 都收不到，连接多半已经断了 (按断线处理，走 recover)
+# - FIRST_EVENT_TIMEOUT: 连上后迟迟没有第一个事件
+# - IDLE_TIMEOUT: 两个事件之间隔太久；NODE_IDLE_TIMEOUTS 按节点标题单独设置，格式 "节点标题=秒,..."
+# 超时设为 0 表示不检查
+STREAM_READ_TIMEOUT = float(os.environ.get("DIFY_STREAM_READ_TIMEOUT", "45"))
+FIRST_EVENT_TIMEOUT = float(os.environ.get("DIFY_FIRST_EVENT_TIMEOUT", "60"))
+IDLE_TIMEOUT = float(os.environ.get("DIFY_IDLE_TIMEOUT", "300"))
+NODE_IDLE_TIMEOUTS = {
+    title.strip(): float(seconds)
+    for title, _, seconds in (item.rpartition("=") for item in os.environ.get("DIFY_NODE_IDLE_TIMEOUTS", "").split(","))
+    if title.strip()
+}
+
+# 流里这些事件总会解码 (很小)，用来记下 task_id / message_id / conversation_id、当前节点和判断流是否正常结束
+TRACKED_EVENTS = frozenset({"workflow_started", "node_started", "message_end"})
+
+AUDIO_LINK_RE = re.compile(r'(https?://[^\s)]+\.mp3)')
+# 链接里不会出现的字符 (空白或右括号)：最后一个这样的字符之前的文本不会再影响匹配结果
+_LINK_BOUNDARY_RE = re.compile(r'[\s)](?=[^\s)]*\Z)')
+
+
+class DifyError(Exception):
+    """调用 Dify 失败；phase 标明是哪一步 (upload / chat / resume / stall)"""
+
+    def __init__(self, phase, message, status_code=None):
+        super().__init__(message)
+        self.phase = phase
+        self.status_code = status_code
+
+
+class StreamDropped(DifyError):
+    """流式连接中途断开：上游工作流可能还在跑，可以用 recover() 查回结果
+
+    reason: closed (连接断开或提前结束) / read_timeout (连 ping 都收不到)
+    """
+
+    def __init__(self, message, reason="closed"):
+        super().__init__("chat", message)
+        self.reason = reason
+
+
+class StreamStalled(DifyError):
+    """流还连着 (ping 照常)，但太久没有新事件：上游卡住了，不值得再等，也不要 recover
+
+    reason: first_event (连上后迟迟没有第一个事件) / idle (两个事件之间隔太久)；
+    node 为卡住时正在跑的节点标题。
+    """
+
+    def __init__(self, reason, message, node=None):
+        super().__init__("stall", message)
+        self.reason = reason
+        self.node = node
+
+
+class StreamWatchdog:
+    """流的看门狗：记下最后一次收到数据和最后一次收到事件 (ping 不算) 的时间
+
+    每收到一块数据调用 feed()，超时抛 StreamStalled。Dify 空闲时定时发 ping，
+    所以上游卡住时 feed() 仍会被定期调用；连 ping 都没有的情况交给连接的读超时。
+    """
+
+    def __init__(self, first_event_timeout=None, idle_timeout=None, node_timeouts=None, clock=time.monotonic):
+        self.first_event_timeout = FIRST_EVENT_TIMEOUT if first_event_timeout is None else first_event_timeout
+        self.idle_timeout = IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.node_timeouts = NODE_IDLE_TIMEOUTS if node_timeouts is None else node_timeouts
+        self.clock = clock
+        self.started_at = clock()
+        self.last_byte_at = None
+        self.last_event_at = None
+        self.node = None            # 当前节点标题 (最近一个 node_started)
+
+    def feed(self, progressed, node=None):
+        """收到一块数据；progressed 表示其中有 ping 以外的事件"""
+        now = self.clock()
+        self.last_byte_at = now
+        if progressed:
+            self.last_event_at = now
+        if node is not None:
+            self.node = node
+        self.check(now)
+
+    def remaining(self, now=None):
+        """离超时还有几秒 (不检查时为 inf)"""
+        now = self.clock() if now is None else now
+        if self.last_event_at is None:
+            limit, since = self.first_event_timeout, self.started_at
+        else:
+            limit, since = self.node_timeouts.get(self.node, self.idle_timeout), self.last_event_at
+        if not limit or limit <= 0:
+            return float("inf")
+        return since + limit - now
+
+    def check(self, now=None):
+        now = self.clock() if now is None else now
+        if self.remaining(now) > 0:
+            return
+        if self.last_event_at is None:
+            raise StreamStalled("first_event", f"上游卡住: 连上后 {now - self.started_at:.0f} 秒还没有收到任何事件")
+        where = f" (节点「{self.node}」)" if self.node else ""
+        raise StreamStalled("idle", f"上游卡住: {now - self.last_event_at:.0f} 秒没有新事件{where}", self.node)
+
+
+def _auth(api_key):
+    return {"Authorization": f"Bearer {api_key}"}
+
+
+def _status_of(e):
+    """从 requests / aiohttp 的异常里取 HTTP 状态码"""
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is None and aiohttp is not None and isinstance(e, aiohttp.ClientResponseError):
+        status = e.status
+    return status
+
+
+def _error_text(e):
+    """aiohttp 的超时异常没有消息文本，用类型名代替"""
+    return str(e) or type(e).__name__
+
+
+def _prepare_upload(data, name, mime, prepare):
+    """返回 (name, mime, 要上传的字节, 预处理报告)"""
+    if not prepare:
+        return name, mime, data, None
+    prepared = normalize_image(data, name, mime)
+    return prepared.name, prepared.mime, prepared.data, prepared.report()
+
+
+def upload_image(session, base_url, api_key, data, name, mime, user=DEFAULT_USER, cache=None, prepare=True,
+                 digest=None):
+    """上传图片，返回 (file_id, 预处理报告)；命中缓存时报告为 None
+
+    digest 为调用方已算好的 content_hash(data)，不传且有缓存时才现算。
+    """
+    cache_key = upload_cache_key(digest or data, base_url, api_key) if cache is not None else None
+    if cache is not None:
+        cached_id = cache.get(cache_key)
+        if cached_id:
+            return cached_id, None
+
+    name, mime, body, report = _prepare_upload(data, name, mime, prepare)
+    try:
+        response = session.post(f"{base_url}/files/upload", headers=_auth(api_key),
+                                files={'file': (name, body, mime)}, data={'user': user})
+        response.raise_for_status()
+        file_id = response.json().get('id')
+    except Exception as e:
+        raise DifyError("upload", f"图片上传失败: {e}", _status_of(e)) from e
+    if not file_id:
+        raise DifyError("upload", "图片上传失败: 响应中没有文件 id")
+    if cache is not None:
+        cache.put(cache_key, file_id, size=len(data))
+    return file_id, report
+
+
+def chat_payload(file_id, prompt, user=DEFAULT_USER, conversation_id=""):
+    """构造 /chat-messages 请求体；工作流必须拿到 pic 变量"""
+    image_payload = {"type": "image", "transfer_method": "local_file", "upload_file_id": file_id}
+    return {
+        "inputs": {"pic": [image_payload]},
+        "query": prompt if prompt else DEFAULT_QUERY,
+        "response_mode": "streaming",
+        "conversation_id": conversation_id,
+        "user": user,
+        "files": [image_payload],
+    }
+
+
+def open_chat_stream(session, base_url, api_key, payload, read_timeout=STREAM_READ_TIMEOUT):
+    """发起流式对话；返回 stream=True 的响应，调用方负责 close()
+
+    read_timeout 为两次收到数据之间的最长间隔：Dify 空闲时也会定时发 ping，
+    比 ping 间隔长得多还没有数据就是连接断了，不必等到会话级的 READ_TIMEOUT。
+    """
+    headers = {**_auth(api_key), "Content-Type": "application/json"}
+    try:
+        response = session.post(f"{base_url}/chat-messages", headers=headers, json=payload, stream=True,
+                                timeout=(CONNECT_TIMEOUT, read_timeout or READ_TIMEOUT))
+        response.raise_for_status()
+    except Exception as e:
+        raise DifyError("chat", f"连接中断: {e}", _status_of(e)) from e
+    return response
+
+
+def stop_chat_task(session, base_url, api_key, task_id, user=DEFAULT_USER, timeout=5):
+    """POST /chat-messages/{task_id}/stop；尽力而为，失败只打印，返回是否成功"""
+    headers = {**_auth(api_key), "Content-Type": "application/json"}
+    try:
+        response = session.post(f"{base_url}/chat-messages/{task_id}/stop", headers=headers,
+                                json={"user": user}, timeout=timeout)
+        response.raise_for_status()
+        return True
+    except Exception as e:
+        print(f"停止任务 {task_id} 失败: {e}")
+        return False
+
+
+def fetch_message(session, base_url, api_key, conversation_id, message_id, user=DEFAULT_USER, timeout=10):
+    """GET /messages，在会话最近的消息里找 message_id；找不到返回 None"""
+    try:
+        response = session.get(f"{base_url}/messages", headers=_auth(api_key), timeout=timeout,
+                               params={"conversation_id": conversation_id, "user": user, "limit": 20})
+        response.raise_for_status()
+        messages = response.json().get("data") or []
+    except Exception as e:
+        raise DifyError("resume", f"查询结果失败: {e}", _status_of(e)) from e
+    return next((message for message in messages if message.get("id") == message_id), None)
+
+
+def find_conversation(session, base_url, api_key, message_id, user=DEFAULT_USER, timeout=10):
+    """流里没拿到 conversation_id 时：GET /conversations 列出最近的会话，找包含 message_id 的那个"""
+    try:
+        response = session.get(f"{base_url}/conversations", headers=_auth(api_key), timeout=timeout,
+                               params={"user": user, "limit": 20})
+        response.raise_for_status()
+        conversations = response.json().get("data") or []
+    except Exception as e:
+        raise DifyError("resume", f"查询会话失败: {e}", _status_of(e)) from e
+    for conversation in conversations:
+        if fetch_message(session, base_url, api_key, conversation.get("id"), message_id, user, timeout):
+            return conversation.get("id")
+    return None
+
+
+def _resume_delays(max_wait=None):
+    """断线后每次轮询前的等待时间：指数退避，总和不超过 max_wait"""
+    max_wait = RESUME_MAX_WAIT if max_wait is None else max_wait
+    delay, waited = RESUME_FIRST_DELAY, 0.0
+    while waited + delay <= max_wait:
+        yield delay
+        waited += delay
+        delay = min(delay * 2, RESUME_MAX_DELAY)
+
+
+def _message_done(message):
+    """工作流跑完后 Dify 才写入回答；失败的消息 status 为 error"""
+    if message is None:
+        return False
+    if message.get("status") == "error":
+        raise DifyError("resume", f"工作流执行失败: {message.get('error') or '未知错误'}")
+    return bool(message.get("answer"))
+
+
+def answer_remainder(shown, answer):
+    """断线前已显示 shown，查回的完整回答为 answer：返回还要补上的部分；
+    shown 不是 answer 的前缀 (对不上) 时返回 None，调用方应整体替换"""
+    if answer.startswith(shown):
+        return answer[len(shown):]
+    return None
+
+
+def extract_audio_links(text, limit=None):
+    """提取 MP3 链接并去重 (保持出现顺序)"""
+    if not isinstance(text, str):
+        return []
+    unique_links = list(dict.fromkeys(AUDIO_LINK_RE.findall(text)))
+    return unique_links[:limit] if limit else unique_links
+
+
+class AudioLinkScanner:
+    """增量提取 MP3 链接，结果与对完整文本调用 extract_audio_links 相同
+
+    链接可能被切在两个片段之间；只有后面已经出现空白或右括号时才确定它
+    完整 (否则后续片段可能把它接长)，流结束时调用 close() 处理最后一段。
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.links = []
+        self.first_link_at = None   # 第一个链接完整时的 clock() 值
+        self._seen = set()
+        self._tail = ""
+
+    def feed(self, text):
+        """喂入一段回答文本，返回本次新确定的链接 (已去重)"""
+        if not text:
+            return []
+        buffer = self._tail + text
+        boundary = _LINK_BOUNDARY_RE.search(buffer)
+        if boundary is None:
+            self._tail = buffer
+            return []
+        self._tail = buffer[boundary.end():]
+        return self._scan(buffer[:boundary.end()])
+
+    def close(self):
+        """流结束：处理剩下的文本"""
+        tail, self._tail = self._tail, ""
+        return self._scan(tail)
+
+    def _scan(self, text):
+        found = []
+        if ".mp3" not in text:
+            return found
+        for link in AUDIO_LINK_RE.findall(text):
+            if link not in self._seen:
+                self._seen.add(link)
+                self.links.append(link)
+                found.append(link)
+        if found and self.first_link_at is None:
+            self.first_link_at = self.clock()
+        return found
+
+
+def _with_tracked(events):
+    return None if events is None else frozenset(events) | TRACKED_EVENTS
+
+
+def _is_read_timeout(e):
+    """requests 把读超时包在 ConnectionError 里，aiohttp 的 sock_read 超时是 TimeoutError 的子类"""
+    while e is not None:
+        if isinstance(e, (TimeoutError, asyncio.TimeoutError)) or "ReadTimeout" in type(e).__name__:
+            return True
+        e = e.args[0] if e.args and isinstance(e.args[0], BaseException) else e.__cause__
+    return False
+
+
+def _dropped(e):
+    if _is_read_timeout(e):
+        return StreamDropped("连接中断: 太久没有收到任何数据 (连 ping 都没有)", reason="read_timeout")
+    return StreamDropped(f"连接中断: {_error_text(e)}")
+
+
+class _ChatStreamBase:
+    """流式对话响应的公共部分
+
+    记下 task_id (停止任务用) 和 message_id / conversation_id (断线后查回结果用)；
+    流没收到 message_end 就结束也算断开，抛 StreamDropped；
+    有 watchdog 时每收到一块数据检查一次，上游卡住抛 StreamStalled；
+    有 capture (SSECapture) 时录下每一块原始字节，关闭流时写盘。
+    """
+
+    def __init__(self, response, parser, events=None, watchdog=None, capture=None):
+        self.response = response
+        self.parser = parser
+        self.events = events        # 调用方要的事件；TRACKED_EVENTS 中其余的不交给调用方
+        self.watchdog = watchdog
+        self.capture = capture
+        self.task_id = None
+        self.message_id = None
+        self.conversation_id = None
+        self.completed = False      # 收到了 message_end
+
+    @property
+    def resumable(self):
+        return bool(self.message_id)
+
+    def _feed(self, chunk):
+        if self.capture is not None:
+            self.capture.record(chunk)
+        progress = self.parser.progress
+        events = self.parser.feed(chunk)
+        if self.watchdog is not None:
+            node = None
+            for event in events:
+                if event.name == "node_started":
+                    node = event.payload.get("data", {}).get("title")
+            self.watchdog.feed(self.parser.progress != progress, node)
+        return self._track(events)
+
+    def _track(self, events):
+        for event in events:
+            if self.message_id is None or self.task_id is None:
+                data = event.payload
+                self.task_id = self.task_id or data.get("task_id")
+                self.message_id = self.message_id or data.get("message_id")
+                self.conversation_id = self.conversation_id or data.get("conversation_id")
+            if event.name == "message_end":
+                self.completed = True
+        if self.events is None:
+            return events
+        return [event for event in events if event.name in self.events]
+
+    def _check_completed(self):
+        if not self.completed:
+            raise StreamDropped("连接中断: 流在回答结束前关闭")
+
+
+class ChatStream(_ChatStreamBase):
+    """一次同步流式对话
+
+    迭代得到已解码的 Dify 事件；batches() 则按网络分块产出事件列表 (可能为空，
+    例如只收到 ping)，调用方可以借每次收到数据的机会刷新计时、检查取消。
+    网络错误统一抛 DifyError("chat")。用完 (或提前结束) 要 close()。
+    """
+
+    def batches(self):
+        try:
+            for chunk in self.response.iter_content(chunk_size=None):
+                yield self._feed(chunk)
+            yield self._track(self.parser.close())
+        except StreamStalled:
+            raise
+        except Exception as e:
+            raise _dropped(e) from e
+        self._check_completed()
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def close(self):
+        self.response.close()
+        if self.capture is not None:
+            self.capture.close(completed=self.completed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncChatStream(_ChatStreamBase):
+    """一次异步流式对话，接口同 ChatStream (async for / aclose)
+
+    有 watchdog 时读每一块数据都以它剩下的时间为上限，连 ping 都没有也能按时放弃。
+    """
+
+    async def batches(self):
+        chunks = self.response.content.iter_any().__aiter__()
+        try:
+            while True:
+                timeout = self.watchdog.remaining() if self.watchdog is not None else float("inf")
+                try:
+                    if timeout == float("inf"):
+                        chunk = await chunks.__anext__()
+                    else:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), max(timeout, 0))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    if self.watchdog is not None:
+                        self.watchdog.check()   # 看门狗到时间了：抛 StreamStalled
+                    raise
+                yield self._feed(chunk)
+            yield self._track(self.parser.close())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise _dropped(e) from e
+        self._check_completed()
+
+    async def _events(self):
+        async for batch in self.batches():
+            for event in batch:
+                yield event
+
+    def __aiter__(self):
+        return self._events()
+
+    async def aclose(self):
+        self.response.close()
+        if self.capture is not None:
+            await asyncio.to_thread(self.capture.close, completed=self.completed)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class DifyClient:
+    """同步 Dify 客户端：上传图片、流式对话、停止任务
+
+    session 一般传进程级共享的 PooledSession；upload_cache 可选。
+    对话时 Dify 不认 file_id (400/404，例如文件已被清理) 会自动清掉对应的上传缓存。
+    """
+
+    def __init__(self, base_url, api_key, session=None, user=DEFAULT_USER, upload_cache=None):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.session = session if session is not None else PooledSession()
+        self.user = user
+        self.upload_cache = upload_cache
+        self._uploads = {}  # file_id -> 上传缓存键
+
+    def upload(self, data, name, mime, prepare=True, digest=None):
+        """上传图片，返回 (file_id, 预处理报告)；命中上传缓存时报告为 None
+
+        digest 为已算好的 content_hash(data)；没有上传缓存时不用哈希。
+        """
+        if self.upload_cache is None:
+            return upload_image(self.session, self.base_url, self.api_key, data, name, mime,
+                                user=self.user, prepare=prepare)
+        digest = digest or content_hash(data)
+        file_id, report = upload_image(self.session, self.base_url, self.api_key, data, name, mime,
+                                       user=self.user, cache=self.upload_cache, prepare=prepare, digest=digest)
+        self.track_upload(file_id, upload_cache_key(digest, self.base_url, self.api_key))
+        return file_id, report
+
+    def track_upload(self, file_id, cache_key):
+        """记下 file_id 对应的上传缓存键 (在别处上传好的 file_id 也要登记，失效时才能清缓存)"""
+        if self.upload_cache is not None:
+            self._uploads[file_id] = cache_key
+
+    def open_chat(self, file_id, prompt="", events=None, conversation_id="", watchdog=None):
+        """发起流式对话，返回 ChatStream；events 为需要解码的事件名集合 (None 为全部)
+
+        watchdog 不传时按默认超时新建一个 StreamWatchdog。
+        """
+        payload = chat_payload(file_id, prompt, user=self.user, conversation_id=conversation_id)
+        try:
+            response = open_chat_stream(self.session, self.base_url, self.api_key, payload)
+        except DifyError as e:
+            self._forget_upload(file_id, e.status_code)
+            raise
+        return ChatStream(response, DifyEventParser(events=_with_tracked(events)), events,
+                          watchdog if watchdog is not None else StreamWatchdog(),
+                          start_capture(self.base_url, secrets=(self.api_key, file_id, self.user)))
+
+    def stream_chat(self, file_id, prompt="", events=None, conversation_id=""):
+        """逐个产出 Dify 事件，结束或中途退出时自动关闭连接"""
+        with self.open_chat(file_id, prompt, events, conversation_id) as stream:
+            yield from stream
+
+    def stop(self, task_id):
+        """请 Dify 停止任务；尽力而为，返回是否成功"""
+        return stop_chat_task(self.session, self.base_url, self.api_key, task_id, user=self.user)
+
+    def recover(self, stream, sleep=time.sleep, should_stop=None, max_wait=None):
+        """流断开 (StreamDropped) 后查回结果，返回 Dify 的消息 (dict，answer 为完整回答)
+
+        Dify 的流断了不能重新接上，但工作流会在服务端继续跑完并保存回答，
+        所以按 message_id 退避轮询消息接口，不必从头再跑一遍工作流。
+        等满 max_wait 秒或连续多次请求失败时抛 DifyError("resume")。
+        sleep 可换成能被取消打断的等待；should_stop 每轮调用一次，可抛异常中止。
+        """
+        if not stream.resumable:
+            raise DifyError("resume", "流在拿到消息 id 之前就断开了，无法恢复")
+        conversation_id = stream.conversation_id
+        errors = 0
+        for delay in _resume_delays(max_wait):
+            sleep(delay)
+            if should_stop is not None:
+                should_stop()
+            try:
+                if not conversation_id:
+                    conversation_id = find_conversation(self.session, self.base_url, self.api_key,
+                                                        stream.message_id, user=self.user)
+                message = conversation_id and fetch_message(self.session, self.base_url, self.api_key,
+                                                            conversation_id, stream.message_id, user=self.user)
+            except DifyError as e:
+                errors += 1
+                print(f"查询结果失败 ({errors}/{RESUME_MAX_ERRORS}): {e}")
+                if errors >= RESUME_MAX_ERRORS:
+                    raise
+                continue
+            errors = 0
+            if _message_done(message):
+                return message
+        raise DifyError("resume", "连接中断后等待结果超时")
+
+    def _forget_upload(self, file_id, status_code):
+        if status_code in (400, 404) and file_id in self._uploads:
+            self.upload_cache.invalidate(self._uploads.pop(file_id))
+
+
+class AsyncDifyClient:
+    """asyncio 版 DifyClient (aiohttp)
+
+    每个流式对话只是事件循环里的一个协程，一个进程可以同时挂几十个 3 分钟的长流。
+    图片预处理和上传缓存读写是同步的，放到线程里跑，不阻塞事件循环。
+    session 不传时在首次请求时创建，由 close() / async with 负责关闭。
+    """
+
+    def __init__(self, base_url, api_key, session=None, user=DEFAULT_USER, upload_cache=None,
+                 max_connections=ASYNC_MAX_CONNECTIONS):
+        if aiohttp is None:
+            raise RuntimeError("AsyncDifyClient 需要安装 aiohttp (pip install aiohttp)")
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.session = session
+        self.user = user
+        self.upload_cache = upload_cache
+        self.max_connections = max_connections
+        self._owns_session = session is None
+        self._uploads = {}
+
+    def _session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                # 不设总超时：一次生成要好几分钟，只限制连接和两次收到数据之间的间隔
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+            )
+        return self.session
+
+    async def upload(self, data, name, mime, prepare=True, digest=None):
+        """上传图片，返回 (file_id, 预处理报告)；命中上传缓存时报告为 None
+
+        digest 为已算好的 content_hash(data)；没有上传缓存时不用哈希。
+        """
+        cache = self.upload_cache
+        cache_key = upload_cache_key(digest or data, self.base_url, self.api_key) if cache is not None else None
+        if cache is not None:
+            cached_id = await asyncio.to_thread(cache.get, cache_key)
+            if cached_id:
+                self._uploads[cached_id] = cache_key
+                return cached_id, None
+
+        name, mime, body, report = await asyncio.to_thread(_prepare_upload, data, name, mime, prepare)
+        form = aiohttp.FormData()
+        form.add_field("user", self.user)
+        form.add_field("file", body, filename=name, content_type=mime)
+        try:
+            async with self._session().post(f"{self.base_url}/files/upload", data=form,
+                                            headers=_auth(self.api_key)) as response:
+                response.raise_for_status()
+                file_id = (await response.json(content_type=None)).get("id")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise DifyError("upload", f"图片上传失败: {_error_text(e)}", _status_of(e)) from e
+        if not file_id:
+            raise DifyError("upload", "图片上传失败: 响应中没有文件 id")
+        if cache is not None:
+            await asyncio.to_thread(cache.put, cache_key, file_id, len(data))
+            self._uploads[file_id] = cache_key
+        return file_id, report
+
+    async def open_chat(self, file_id, prompt="", events=None, conversation_id="", watchdog=None):
+        """发起流式对话，返回 AsyncChatStream；watchdog 同 DifyClient.open_chat"""
+        payload = chat_payload(file_id, prompt, user=self.user, conversation_id=conversation_id)
+        headers = {**_auth(self.api_key), "Content-Type": "application/json"}
+        response = None
+        try:
+            response = await self._session().post(
+                f"{self.base_url}/chat-messages", json=payload, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT,
+                                              sock_read=STREAM_READ_TIMEOUT or READ_TIMEOUT))
+            response.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if response is not None:
+                response.close()
+            error = DifyError("chat", f"连接中断: {_error_text(e)}", _status_of(e))
+            if error.status_code in (400, 404) and file_id in self._uploads:
+                await asyncio.to_thread(self.upload_cache.invalidate, self._uploads.pop(file_id))
+            raise error from e
+        return AsyncChatStream(response, DifyEventParser(events=_with_tracked(events)), events,
+                               watchdog if watchdog is not None else StreamWatchdog(),
+                               start_capture(self.base_url, secrets=(self.api_key, file_id, self.user)))
+
+    async def stream_chat(self, file_id, prompt="", events=None, conversation_id=""):
+        """异步迭代 Dify 事件，结束或中途退出时自动关闭连接"""
+        stream = await self.open_chat(file_id, prompt, events, conversation_id)
+        async with stream:
+            async for event in stream:
+                yield event
+
+    async def stop(self, task_id, timeout=5):
+        """请 Dify 停止任务；尽力而为，返回是否成功"""
+        try:
+            async with self._session().post(
+                    f"{self.base_url}/chat-messages/{task_id}/stop", json={"user": self.user},
+                    headers={**_auth(self.api_key), "Content-Type": "application/json"},
+                    timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"停止任务 {task_id} 失败: {_error_text(e)}")
+            return False
+
+    async def recover(self, stream, max_wait=None):
+        """同 DifyClient.recover；取消协程即可中止"""
+        if not stream.resumable:
+            raise DifyError("resume", "流在拿到消息 id 之前就断开了，无法恢复")
+        conversation_id = stream.conversation_id
+        errors = 0
+        for delay in _resume_delays(max_wait):
+            await asyncio.sleep(delay)
+            try:
+                if not conversation_id:
+                    conversation_id = await self._find_conversation(stream.message_id)
+                message = conversation_id and await self._fetch_message(conversation_id, stream.message_id)
+            except DifyError as e:
+                errors += 1
+                print(f"查询结果失败 ({errors}/{RESUME_MAX_ERRORS}): {e}")
+                if errors >= RESUME_MAX_ERRORS:
+                    raise
+                continue
+            errors = 0
+            if _message_done(message):
+                return message
+        raise DifyError("resume", "连接中断后等待结果超时")
+
+    async def _get_json(self, path, params, timeout=10):
+        try:
+            async with self._session().get(f"{self.base_url}{path}", params=params, headers=_auth(self.api_key),
+                                           timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise DifyError("resume", f"查询结果失败: {_error_text(e)}", _status_of(e)) from e
+
+    async def _fetch_message(self, conversation_id, message_id):
+        body = await self._get_json("/messages", {"conversation_id": conversation_id, "user": self.user,
+                                                  "limit": 20})
+        return next((message for message in body.get("data") or [] if message.get("id") == message_id), None)
+
+    async def _find_conversation(self, message_id):
+        body = await self._get_json("/conversations", {"user": self.user, "limit": 20})
+        for conversation in body.get("data") or []:
+            if await self._fetch_message(conversation.get("id"), message_id):
+                return conversation.get("id")
+        return None
+
+    async def close(self):
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,137 @@
+"""Dify 接口共用的 HTTP 连接池
+
+上传图片 (/files/upload) 和流式对话 (/chat-messages) 都走同一个进程级
+requests.Session：复用 TCP+TLS 连接、限制每个主机的连接数、统一超时，
+并且只对幂等请求做读重试（连接失败时请求尚未发出，任何方法都可以安全重试）。
+
+在 Streamlit 中通过 st.cache_resource 缓存，跨 rerun、跨会话共享。
+"""
+import os
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# --- 默认配置 (可用环境变量覆盖) ---
+POOL_CONNECTIONS = int(os.environ.get("DIFY_POOL_CONNECTIONS", "4"))   # 缓存多少个主机的连接池
+POOL_MAXSIZE = int(os.environ.get("DIFY_POOL_MAXSIZE", "16"))          # 每个主机最多保持多少条连接
+MAX_RETRIES = int(os.environ.get("DIFY_MAX_RETRIES", "3"))
+CONNECT_TIMEOUT = float(os.environ.get("DIFY_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.environ.get("DIFY_READ_TIMEOUT", "120"))       # 两次收到数据之间的最长间隔
+KEEP_ALIVE = os.environ.get("DIFY_KEEP_ALIVE", "1") != "0"
+
+
+class PoolCounters:
+    """连接池计数器 (线程安全)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+
+    def add_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def add_connection(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def snapshot(self):
+        with self._lock:
+            requests_ = self.requests
+            opened = self.connections_opened
+        reused = max(requests_ - opened, 0)
+        return {
+            "requests": requests_,
+            "connections_opened": opened,
+            "connections_reused": reused,
+            "hit_rate": reused / requests_ if requests_ else 0.0,
+        }
+
+
+def _counting_pool(base, counters):
+    """生成一个在新建连接时计数的连接池类"""
+
+    class CountingPool(base):
+        def _new_conn(self):
+            counters.add_connection()
+            return super()._new_conn()
+
+    CountingPool.__name__ = f"Counting{base.__name__}"
+    return CountingPool
+
+
+def _keepalive_socket_options():
+    """长时间流式连接需要 TCP keep-alive，避免被中间的 NAT/代理静默断开"""
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class _PooledAdapter(HTTPAdapter):
+    """带默认超时和计数的 HTTPAdapter"""
+
+    def __init__(self, counters, timeout, keep_alive, **kwargs):
+        self.counters = counters
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        if self.keep_alive:
+            from urllib3.connection import HTTPConnection
+            pool_kwargs["socket_options"] = HTTPConnection.default_socket_options + _keepalive_socket_options()
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self.counters),
+            "https": _counting_pool(HTTPSConnectionPool, self.counters),
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        self.counters.add_request()
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class PooledSession(requests.Session):
+    """进程级共享的 Dify HTTP 会话"""
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 max_retries=MAX_RETRIES, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, keep_alive=KEEP_ALIVE):
+        super().__init__()
+        self.counters = PoolCounters()
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,  # 不含 POST：读失败/5xx 只对幂等请求重试
+            raise_on_status=False,
+        )
+        adapter = _PooledAdapter(
+            self.counters,
+            timeout=(connect_timeout, read_timeout),
+            keep_alive=keep_alive,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,  # 连接数达到上限时排队等待，而不是再开新连接
+            max_retries=retry,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+
+    def pool_stats(self):
+        """连接池统计：请求数、新建连接数、复用率"""
+        return self.counters.snapshot()
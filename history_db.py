@@ -0,0 +1,143 @@
+"""生成历史 (SQLite)
+
+历史记录持久化到 SQLite，刷新页面、重启服务都不会丢，按用户 + 时间建索引：
+- page: 只查当前页的轻量字段 (id、时间、提示词)，侧边栏渲染成本与历史总量无关
+- get: 展开某一条时才取完整记录 (音频链接、图片引用)
+
+谁能看到哪些历史，靠浏览器端保存的随机凭据 (new_history_token，32 字节，不可猜)；
+库里的 user 是凭据的哈希 (history_owner)，不存凭据本身。
+每个用户最多保留 HISTORY_MAX_ENTRIES 条，超过 HISTORY_MAX_AGE 秒的记录在写入新记录时清掉。
+
+图片本身不进数据库，只保存 history_store 里的 blob id (原图由 history_store 按磁盘预算清理)。
+HistoryDB 应通过 st.cache_resource 在进程内共享。
+"""
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import uuid
+
+from local_db import connect
+
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", "history.sqlite3")
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "10"))
+HISTORY_MAX_ENTRIES = int(os.environ.get("HISTORY_MAX_ENTRIES", "200"))    # 每个用户最多保留几条
+HISTORY_MAX_AGE = float(os.environ.get("HISTORY_MAX_AGE", str(90 * 24 * 3600)))  # 秒
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{43}")   # secrets.token_urlsafe(32) 的格式
+
+
+def new_history_token():
+    """新的历史记录凭据 (32 字节随机数，URL 安全)"""
+    return secrets.token_urlsafe(32)
+
+
+def history_owner(token):
+    """凭据 -> 库里的 user (凭据的哈希)；不是 new_history_token 生成的格式时返回 None"""
+    if not token or not _TOKEN_RE.fullmatch(token):
+        return None
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+class HistoryDB:
+    """历史记录表 (线程安全)"""
+
+    def __init__(self, path=HISTORY_DB_PATH, max_entries=HISTORY_MAX_ENTRIES, max_age=HISTORY_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = connect(path)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                id TEXT PRIMARY KEY,
+                user TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                prompt TEXT NOT NULL,
+                links TEXT NOT NULL,
+                blob TEXT,
+                job_id TEXT UNIQUE
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS history_user_time ON history (user, created_at DESC)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS history_time ON history (created_at)")
+        # 统计
+        self.queries = 0
+        self.query_ms = 0.0
+        self.pruned = 0
+
+    def add(self, user, prompt, links, blob=None, job_id=None, created_at=None):
+        """写入一条记录；同一个 job_id 只记一次 (刷新后重新挂上的任务不会重复保存)
+
+        顺带清掉该用户超出 max_entries 的旧记录和所有超过 max_age 的记录。
+        """
+        entry_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self._db.execute("BEGIN")
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO history (id, user, created_at, prompt, links, blob, job_id)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (entry_id, user, created_at or time.time(), prompt,
+                 json.dumps(list(links), ensure_ascii=False), blob, job_id),
+            )
+            added = cursor.rowcount
+            pruned = 0
+            if self.max_entries:
+                pruned += self._db.execute(
+                    "DELETE FROM history WHERE user = ? AND rowid NOT IN ("
+                    " SELECT rowid FROM history WHERE user = ? ORDER BY created_at DESC LIMIT ?)",
+                    (user, user, self.max_entries)).rowcount
+            if self.max_age:
+                pruned += self._db.execute("DELETE FROM history WHERE created_at < ?",
+                                           (time.time() - self.max_age,)).rowcount
+            self._db.execute("COMMIT")
+            self.pruned += max(pruned, 0)
+        return entry_id if added else None
+
+    def count(self, user):
+        return self._query("SELECT COUNT(*) FROM history WHERE user = ?", (user,))[0][0]
+
+    def page(self, user, page=1, page_size=HISTORY_PAGE_SIZE):
+        """第 page 页 (从 1 开始，最新的在前)，只含 id / created_at / prompt"""
+        rows = self._query(
+            "SELECT id, created_at, prompt FROM history WHERE user = ?"
+            " ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            (user, page_size, (max(page, 1) - 1) * page_size),
+        )
+        return [{"id": row[0], "created_at": row[1], "prompt": row[2]} for row in rows]
+
+    def get(self, entry_id, user):
+        """完整记录；不存在或不属于该用户返回 None"""
+        rows = self._query(
+            "SELECT id, created_at, prompt, links, blob FROM history WHERE id = ? AND user = ?",
+            (entry_id, user),
+        )
+        if not rows:
+            return None
+        row = rows[0]
+        return {"id": row[0], "created_at": row[1], "prompt": row[2], "links": json.loads(row[3]), "blob": row[4]}
+
+    def stats(self):
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+            return {
+                "entries": total,
+                "max_entries": self.max_entries,
+                "pruned": self.pruned,
+                "queries": self.queries,
+                "avg_query_ms": round(self.query_ms / self.queries, 2) if self.queries else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _query(self, sql, params):
+        start = time.perf_counter()
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            self.queries += 1
+            self.query_ms += (time.perf_counter() - start) * 1000
+        return rows
@@ -0,0 +1,168 @@
+"""生成历史的图片存储
+
+历史记录 (见 history_db.py) 里不保存图片本身：
+- 原图按内容哈希写到磁盘 (blob)，只有展开「查看原图」时才读回来
+- 侧边栏只显示预先编码好的小缩略图 (JPEG 字节)，放在进程级共享的内存里，
+  有全局内存预算，超出后按 LRU 淘汰；被淘汰的缩略图下次用到时从磁盘原图重建
+
+HistoryStore 应通过 st.cache_resource 在进程内共享。
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from history_db import HISTORY_DB_PATH
+from image_prep import normalize_image
+
+HISTORY_MEMORY_BUDGET = int(os.environ.get("HISTORY_MEMORY_BUDGET", str(16 * 1024 * 1024)))  # 所有缩略图合计
+HISTORY_THUMB_EDGE = int(os.environ.get("HISTORY_THUMB_EDGE", "256"))
+# 默认放在历史记录库旁边：临时目录可能被系统清理，多个用户共用时别人也能读
+HISTORY_BLOB_DIR = os.environ.get("HISTORY_BLOB_DIR",
+                                  os.path.join(os.path.dirname(os.path.abspath(HISTORY_DB_PATH)), "history_blobs"))
+HISTORY_BLOB_MAX_BYTES = int(os.environ.get("HISTORY_BLOB_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def make_thumbnail(data, edge=HISTORY_THUMB_EDGE):
+    """缩略图 JPEG 字节；图片解不开时返回 None"""
+    prepared = normalize_image(data, "thumb", None, max_edge=edge, fmt="JPEG", quality=70, skip_bytes=0)
+    if prepared.error:
+        return None
+    return prepared.data
+
+
+class HistoryStore:
+    """缩略图内存缓存 (全局预算 + LRU) + 原图磁盘存储 (线程安全)"""
+
+    def __init__(self, blob_dir=HISTORY_BLOB_DIR, memory_budget=HISTORY_MEMORY_BUDGET,
+                 thumb_edge=HISTORY_THUMB_EDGE,
+                 blob_max_bytes=HISTORY_BLOB_MAX_BYTES):
+        self.blob_dir = blob_dir
+        self.memory_budget = memory_budget
+        self.thumb_edge = thumb_edge
+        self.blob_max_bytes = blob_max_bytes
+        self._thumbs = OrderedDict()  # blob id -> 缩略图字节
+        self._thumb_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(blob_dir, exist_ok=True)
+        # 统计
+        self.thumb_hits = 0
+        self.thumb_rebuilds = 0
+        self.evictions = 0
+        self.blobs_written = 0
+        self.blobs_removed = 0
+        self.full_loads = 0
+
+    def save_image(self, image_bytes, digest=None):
+        """写入原图和缩略图，返回 blob id (供历史记录引用)；digest 为已算好的图片 SHA-256"""
+        blob_id = digest or hashlib.sha256(image_bytes).hexdigest()
+        self._write_blob(blob_id, image_bytes)
+        thumb = make_thumbnail(image_bytes, self.thumb_edge)
+        if thumb is not None:
+            self._put_thumb(blob_id, thumb)
+        return blob_id
+
+    def thumbnail(self, blob_id):
+        """缩略图字节；被淘汰时从磁盘原图重建，原图也没了返回 None"""
+        with self._lock:
+            thumb = self._thumbs.get(blob_id)
+            if thumb is not None:
+                self._thumbs.move_to_end(blob_id)
+                self.thumb_hits += 1
+                return thumb
+        data = self._read_blob(blob_id)
+        if data is None:
+            return None
+        thumb = make_thumbnail(data, self.thumb_edge)
+        if thumb is not None:
+            with self._lock:
+                self.thumb_rebuilds += 1
+            self._put_thumb(blob_id, thumb)
+        return thumb
+
+    def full_image(self, blob_id):
+        """原图字节 (展开时才读)；不存在返回 None"""
+        data = self._read_blob(blob_id)
+        if data is not None:
+            with self._lock:
+                self.full_loads += 1
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                "thumbnails": len(self._thumbs),
+                "thumbnail_bytes": self._thumb_bytes,
+                "memory_budget": self.memory_budget,
+                "thumb_hits": self.thumb_hits,
+                "thumb_rebuilds": self.thumb_rebuilds,
+                "evictions": self.evictions,
+                "full_loads": self.full_loads,
+                "blobs_written": self.blobs_written,
+                "blobs_removed": self.blobs_removed,
+            }
+
+    def _put_thumb(self, blob_id, thumb):
+        with self._lock:
+            old = self._thumbs.pop(blob_id, None)
+            if old is not None:
+                self._thumb_bytes -= len(old)
+            self._thumbs[blob_id] = thumb
+            self._thumb_bytes += len(thumb)
+            while self._thumb_bytes > self.memory_budget and len(self._thumbs) > 1:
+                _, evicted = self._thumbs.popitem(last=False)
+                self._thumb_bytes -= len(evicted)
+                self.evictions += 1
+
+    def _blob_path(self, blob_id):
+        return os.path.join(self.blob_dir, blob_id)
+
+    def _read_blob(self, blob_id):
+        if not blob_id:
+            return None
+        try:
+            with open(self._blob_path(blob_id), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_blob(self, blob_id, data):
+        path = self._blob_path(blob_id)
+        if os.path.exists(path):
+            os.utime(path)  # 标记为最近使用，清理时最后才删
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, prefix=".blob-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"历史图片保存失败: {e}")
+            return
+        with self._lock:
+            self.blobs_written += 1
+        self._prune_blobs()
+
+    def _prune_blobs(self):
+        """磁盘上的原图超过上限时，从最久没写入/用到的开始删"""
+        blobs = []
+        try:
+            for entry in os.scandir(self.blob_dir):
+                if entry.is_file() and not entry.name.startswith("."):
+                    st = entry.stat()
+                    blobs.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            return
+        blobs.sort()
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in blobs:
+            if total <= self.blob_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.blobs_removed += 1
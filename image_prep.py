@@ -0,0 +1,149 @@
+"""上传前的图片预处理
+
+pic 输入只需要一张尺寸合适的图给视觉模型看，没必要把 20MB 的手机原图
+或无损 PNG 原样传给 Dify。normalize_image 用 Pillow：
+- 只解码一次 (JPEG 先用 draft 让解码器直接按比例缩小)
+- 按 EXIF 方向摆正后缩放到最长边不超过 max_edge
+- 带 ICC 配置文件的 (手机的 Display P3 等) 先把颜色转换到 sRGB
+- 重新编码为 JPEG/WebP，不写回 EXIF 等元数据
+- 图片本来就足够小、又不带元数据时直接跳过
+并返回节省的字节数和耗时。
+"""
+import io
+import os
+import time
+
+from PIL import Image, ImageOps
+
+try:
+    from PIL import ImageCms
+except ImportError:  # 可选：Pillow 没带 LittleCMS 时没有，这时保留 RGB 配置文件
+    ImageCms = None
+
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1568"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()   # JPEG 或 WEBP
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+IMAGE_SKIP_BYTES = int(os.environ.get("IMAGE_SKIP_BYTES", str(512 * 1024)))  # 小于这个大小且尺寸合格就不处理
+
+_FORMATS = {
+    "JPEG": (".jpg", "image/jpeg"),
+    "WEBP": (".webp", "image/webp"),
+}
+
+# 原样上传会一起带出去的元数据 (EXIF 里可能有 GPS 位置、设备序列号等)
+_METADATA_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "comment")
+# 这些格式的 EXIF 在文件头里，getexif() 不用解码像素
+_EXIF_HEADER_FORMATS = ("JPEG", "MPO", "TIFF")
+
+_SRGB = ImageCms.createProfile("sRGB") if ImageCms is not None else None
+
+
+class PreparedImage:
+    """预处理结果"""
+
+    def __init__(self, data, name, mime, original_bytes, elapsed_ms, size=None, resized=False, skipped=False, error=None):
+        self.data = data
+        self.name = name
+        self.mime = mime
+        self.original_bytes = original_bytes
+        self.elapsed_ms = elapsed_ms
+        self.size = size            # (宽, 高)
+        self.resized = resized
+        self.skipped = skipped      # 没有重新编码，原样上传
+        self.error = error
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - len(self.data)
+
+    def report(self):
+        return {
+            "original_bytes": self.original_bytes,
+            "bytes": len(self.data),
+            "bytes_saved": self.bytes_saved,
+            "elapsed_ms": round(self.elapsed_ms, 1),
+            "size": self.size,
+            "resized": self.resized,
+            "skipped": self.skipped,
+            "error": self.error,
+        }
+
+
+def _flatten(img, fmt):
+    """转换到目标格式支持的颜色模式；JPEG 没有透明通道，透明部分铺白底"""
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    if fmt == "WEBP":
+        return img.convert("RGBA" if has_alpha else "RGB") if img.mode not in ("RGB", "RGBA") else img
+    if has_alpha:
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB") if img.mode != "RGB" else img
+
+
+def _has_metadata(img):
+    """图片是否带 EXIF / ICC / XMP 等元数据 (只看文件头，不解码像素)"""
+    if any(img.info.get(key) for key in _METADATA_KEYS):
+        return True
+    # PNG / WebP 的 getexif() 要先把整张图读完；它们的 EXIF 在文件头里时已经出现在 info 里了
+    return img.format in _EXIF_HEADER_FORMATS and len(img.getexif()) > 0
+
+
+def _to_srgb(img):
+    """按内嵌的 ICC 配置文件把颜色转换到 sRGB
+
+    返回 (图片, 要写回的 ICC)：转换成功后就不需要配置文件了；转不了时原样返回，
+    RGB 配置文件照样写回，颜色不会被当成 sRGB 看错。
+    """
+    icc = img.info.get("icc_profile")
+    if not icc:
+        return img, None
+    if ImageCms is not None and img.mode in ("RGB", "RGBA", "CMYK", "L"):
+        try:
+            source = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+            return ImageCms.profileToProfile(img, source, _SRGB, outputMode="RGBA" if img.mode == "RGBA" else "RGB"), None
+        except Exception:
+            pass  # 配置文件损坏或和颜色模式对不上
+    # 灰度、CMYK 的配置文件和重新编码后的 RGB 对不上，只能丢掉
+    return img, icc if icc[16:20] == b"RGB " else None
+
+
+def normalize_image(data, name, mime, max_edge=IMAGE_MAX_EDGE, fmt=IMAGE_FORMAT,
+                    quality=IMAGE_QUALITY, skip_bytes=IMAGE_SKIP_BYTES):
+    """缩放、重新编码并去掉元数据；失败时原样返回，不影响上传"""
+    start = time.perf_counter()
+
+    def passthrough(size=None, error=None):
+        elapsed = (time.perf_counter() - start) * 1000
+        return PreparedImage(data, name, mime, len(data), elapsed, size=size, skipped=True, error=error)
+
+    try:
+        img = Image.open(io.BytesIO(data))  # 只读文件头，还没解码像素
+        size = img.size
+        has_metadata = _has_metadata(img)
+        if len(data) <= skip_bytes and max(size) <= max_edge and not has_metadata:
+            return passthrough(size)
+        if fmt not in _FORMATS:
+            fmt = "JPEG"
+        resized = max(size) > max_edge
+        if resized and img.format == "JPEG":
+            img.draft("RGB", (max_edge, max_edge))  # 让 JPEG 解码器直接按 1/2、1/4、1/8 缩小解码
+        img = ImageOps.exif_transpose(img)  # 元数据会被丢掉，先按方向把图摆正
+        if max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=3.0)
+        img, icc_profile = _to_srgb(img)  # 缩小后再转换，像素少
+        img = _flatten(img, fmt)
+
+        out = io.BytesIO()
+        img.save(out, format=fmt, quality=quality, optimize=(fmt == "JPEG"), icc_profile=icc_profile)
+        encoded = out.getvalue()
+    except Exception as e:
+        return passthrough(error=str(e))
+
+    if not resized and not has_metadata and len(encoded) >= len(data):
+        return passthrough(size)  # 重新编码反而更大，原图又不带元数据，不如直接用原图
+    ext, new_mime = _FORMATS[fmt]
+    new_name = os.path.splitext(name or "image")[0] + ext
+    elapsed = (time.perf_counter() - start) * 1000
+    return PreparedImage(encoded, new_name, new_mime, len(data), elapsed, size=img.size, resized=resized)
@@ -0,0 +1,444 @@
+"""后台生成任务
+
+整段 /chat-messages 流要跑 3 分钟左右，不能放在 Streamlit 脚本线程里：
+任何控件交互、刷新页面或 rerun 都会把它打断。JobManager 用一个有界线程池
+在后台跑任务，任务的增量状态 (已生成的文本、当前节点、链接……) 存在 Job 里，
+按 job id 查询；页面只需要轮询或重新挂上 (reattach) 即可。
+
+相同的请求 (提交时给同一个 key，例如图片哈希 + 提示词) 在跑时不再重复调用上游
+(single-flight)：后来的提交只是同一个 Job 的又一个订阅 (Subscription)。
+订阅者各自轮询共享 Job 的状态快照，不经过队列，慢的订阅者不会拖住上游；
+取消只是退订，最后一个订阅者退订时才真正取消任务。
+
+准入控制：线程数即同时打到上游的流数上限；排队按"公平份额"出队 (正在跑的任务
+越少的会话越先)，有 RateLimiter 时还要拿到 API Key 的令牌才开始 (见 admission.py)；
+队列满或同一会话排了太多任务时立即拒绝 (QueueFullError)，不让请求在上游慢慢超时。
+
+JobManager 应通过 st.cache_resource 在进程内共享。
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "4"))
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", "16"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "1800"))  # 结束后保留多久 (秒)，供页面重新挂上
+MAX_JOBS_PER_OWNER = int(os.environ.get("MAX_JOBS_PER_OWNER", "2"))  # 同一会话最多同时运行 + 排队的任务数
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class QueueFullError(Exception):
+    """排队的任务已达上限"""
+
+
+class JobCancelled(Exception):
+    """任务被取消 (由 Job.check_cancelled 抛出)"""
+
+
+class Job:
+    """一个后台任务的增量状态：worker 线程写，页面轮询读"""
+
+    def __init__(self, job_id, meta=None):
+        self.id = job_id
+        self.meta = meta or {}
+        self.status = QUEUED
+        self.phase = QUEUED
+        self.node = None          # 当前执行的工作流节点
+        self.links = []
+        self.info = {}            # 其他附加信息 (图片预处理报告等)
+        self.error = None
+        self.error_phase = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.updated_at = self.created_at
+        self.phase_log = []       # [(阶段, 进入时间)]，用于统计各阶段耗时
+        self.node_log = []        # [(节点, 开始时间)]，用于估算进度
+        self._parts = []
+        self._subscribers = 0     # 还在等结果的订阅数
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+
+    # --- worker 端 ---
+    def append_text(self, chunk):
+        if chunk:
+            with self._lock:
+                self._parts.append(chunk)
+                self.updated_at = time.time()
+
+    def set_text(self, text):
+        """整体替换已生成的文本 (断线恢复时查回的回答与已收到的对不上)"""
+        with self._lock:
+            self._parts = [text] if text else []
+            self.updated_at = time.time()
+
+    def set_phase(self, phase):
+        with self._lock:
+            self.phase = phase
+            self.updated_at = time.time()
+            self.phase_log.append((phase, self.updated_at))
+
+    def set_node(self, title):
+        with self._lock:
+            self.node = title
+            self.updated_at = time.time()
+            self.node_log.append((title, self.updated_at))
+
+    def set_links(self, links):
+        with self._lock:
+            self.links = list(links)
+            self.updated_at = time.time()
+
+    def set_info(self, key, value):
+        with self._lock:
+            self.info[key] = value
+            self.updated_at = time.time()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+
+    def sleep(self, seconds):
+        """等待 seconds 秒，被取消时提前返回"""
+        self._cancel.wait(seconds)
+
+    # --- 页面端 ---
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return self._subscribers
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    @property
+    def text(self):
+        with self._lock:
+            return "".join(self._parts)
+
+    def elapsed(self, now=None):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or now or time.time()) - self.started_at
+
+    def phase_durations(self):
+        """各阶段耗时 (秒)；最后一个阶段算到结束时间 (或现在)"""
+        with self._lock:
+            log = list(self.phase_log)
+            end = self.finished_at or time.time()
+        durations = {}
+        for i, (phase, entered) in enumerate(log):
+            left = log[i + 1][1] if i + 1 < len(log) else end
+            durations[phase] = durations.get(phase, 0.0) + (left - entered)
+        return durations
+
+    def snapshot(self):
+        """当前状态的一致快照 (dict)"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "status": self.status,
+                "phase": self.phase,
+                "node": self.node,
+                "text": "".join(self._parts),
+                "links": list(self.links),
+                "info": dict(self.info),
+                "error": self.error,
+                "error_phase": self.error_phase,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "updated_at": self.updated_at,
+            }
+
+    # --- JobManager 使用 ---
+    def _subscribe(self):
+        with self._lock:
+            self._subscribers += 1
+
+    def _unsubscribe(self):
+        """少一个订阅；没人等了就取消任务"""
+        with self._lock:
+            self._subscribers -= 1
+            orphaned = self._subscribers <= 0
+        if orphaned:
+            self.cancel()
+
+    def _start(self):
+        with self._lock:
+            self.status = RUNNING
+            self.started_at = self.updated_at = time.time()
+
+    def _finish(self, status, error=None, error_phase=None):
+        with self._lock:
+            self.status = status
+            self.error = error
+            self.error_phase = error_phase
+            self.finished_at = self.updated_at = time.time()
+            if status == DONE:
+                self.phase = DONE
+
+
+class Subscription:
+    """一个页面会话对后台任务的订阅：状态都读共享的 Job，id / meta / 取消是自己的"""
+
+    def __init__(self, sub_id, job, meta=None):
+        self.id = sub_id
+        self.job = job
+        self.meta = meta or {}
+        self.created_at = time.time()
+        self.detached_at = None   # 退订时间
+        job._subscribe()
+
+    def __getattr__(self, name):
+        # 文本、节点、链接、耗时等都直接读共享的 Job
+        return getattr(self.job, name)
+
+    @property
+    def status(self):
+        return CANCELLED if self.detached_at is not None else self.job.status
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    @property
+    def finished_at(self):
+        return self.detached_at or self.job.finished_at
+
+    @property
+    def cancelled(self):
+        return self.detached_at is not None or self.job.cancelled
+
+    @property
+    def shared(self):
+        """是否还有别的会话在等同一个结果"""
+        return self.job.subscribers > 1
+
+    def cancel(self):
+        """退订；最后一个订阅者退订时任务才被取消"""
+        if self.detached_at is None and not self.job.finished:
+            self.detached_at = time.time()
+            self.job._unsubscribe()
+
+
+class _Ticket:
+    """排队中的任务及其调度信息"""
+
+    def __init__(self, job, fn, args, kwargs, key, owner, rate_key):
+        self.job = job
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.owner = owner or job.id  # 没有 owner 的任务各算各的
+        self.rate_key = rate_key
+
+
+class JobManager:
+    """有界线程池 + 任务表 + 公平调度 (相同 key 的在跑任务合并)"""
+
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS, max_queue=MAX_QUEUED_JOBS, ttl=JOB_TTL, limiter=None,
+                 max_per_owner=MAX_JOBS_PER_OWNER):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.limiter = limiter    # admission.RateLimiter；为空时不限速
+        self.max_per_owner = max_per_owner
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._jobs = {}           # job id -> Job (真正调用上游的任务)
+        self._subscriptions = {}  # 订阅 id -> Subscription (页面拿到的)
+        self._inflight = {}       # key -> 在跑的 Job
+        self._queue = []          # 排队的 _Ticket (按提交顺序)
+        self._running = {}        # owner -> 正在跑的任务数
+        self._served = {}         # owner -> 上次开始任务的时间 (轮转用)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        # 统计
+        self.submitted = 0
+        self.rejected = 0
+        self.coalesced = 0        # 合并进已有任务的提交 = 省下的上游调用 (上传 + 流式对话)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="job-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, fn, *args, meta=None, key=None, owner=None, rate_key=None, **kwargs):
+        """提交任务 fn(job, *args, **kwargs)，返回 Subscription
+
+        key 相同的任务还在跑时直接订阅它，不再调用 fn。
+        owner (会话 / 用户) 用于公平调度；rate_key (API Key) 用于限速。
+        运行中 + 排队的任务超过上限，或同一 owner 的任务太多时立即抛 QueueFullError。
+        """
+        with self._lock:
+            self._expire_locked()
+            job = self._inflight.get(key) if key is not None else None
+            if job is not None and not job.finished and not job.cancelled:
+                self.coalesced += 1
+                REGISTRY.inc("dify_coalesced_total")
+                return self._subscribe_locked(job, meta)
+            pending = len(self._queue) + sum(self._running.values())
+            if pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(f"当前有 {pending} 个任务在运行或排队")
+            if owner is not None and self.max_per_owner:
+                mine = self._running.get(owner, 0) + sum(1 for t in self._queue if t.owner == owner)
+                if mine >= self.max_per_owner:
+                    self.rejected += 1
+                    raise QueueFullError(f"你已有 {mine} 个任务在运行或排队")
+            job = Job(uuid.uuid4().hex[:12], meta)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._inflight[key] = job
+            self.submitted += 1
+            subscription = self._subscribe_locked(job, meta)
+            self._queue.append(_Ticket(job, fn, args, kwargs, key, owner, rate_key))
+            self._wakeup.notify()
+        return subscription
+
+    def get(self, sub_id):
+        """按订阅 id 取任务；不存在或已过期返回 None"""
+        if not sub_id:
+            return None
+        with self._lock:
+            self._expire_locked()
+            return self._subscriptions.get(sub_id)
+
+    def queue_position(self, sub_id):
+        """按当前调度顺序排在该任务前面的排队任务数；不在排队返回 0"""
+        with self._lock:
+            subscription = self._subscriptions.get(sub_id)
+            if subscription is None or subscription.job.status != QUEUED:
+                return 0
+            for position, ticket in enumerate(self._ordered_locked()):
+                if ticket.job is subscription.job:
+                    return position
+            return 0
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {
+                "running": counts.get(RUNNING, 0),
+                "queued": counts.get(QUEUED, 0),
+                "finished": sum(counts.get(s, 0) for s in FINISHED_STATES),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "coalesced": self.coalesced,
+                "subscribers": sum(1 for sub in self._subscriptions.values() if not sub.finished),
+                "owners_waiting": len({t.owner for t in self._queue}),
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "max_per_owner": self.max_per_owner,
+                "rate_limit": self.limiter.stats() if self.limiter is not None else None,
+            }
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            self._closed = True
+            for job in self._jobs.values():
+                job.cancel()
+            self._wakeup.notify_all()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _subscribe_locked(self, job, meta):
+        subscription = Subscription(uuid.uuid4().hex[:12], job, meta)
+        self._subscriptions[subscription.id] = subscription
+        return subscription
+
+    def _ordered_locked(self):
+        """公平份额：正在跑的任务越少的 owner 越优先，同样多时轮转 (最久没轮到的先)，再先来先跑"""
+        return sorted(self._queue, key=lambda t: (self._running.get(t.owner, 0), self._served.get(t.owner, 0.0)))
+
+    def _dispatch_loop(self):
+        """有空闲线程、且拿到限速令牌时，把排在最前的任务交给线程池"""
+        with self._lock:
+            while not self._closed:
+                ticket, wait = self._next_locked()
+                if ticket is None:
+                    # 取消排队中的任务不会通知这里，最多 1 秒后清理
+                    self._wakeup.wait(min(wait or 1.0, 1.0))
+                    continue
+                self._queue.remove(ticket)
+                self._running[ticket.owner] = self._running.get(ticket.owner, 0) + 1
+                self._served[ticket.owner] = time.monotonic()
+                if len(self._served) > 4 * (self.max_workers + self.max_queue):
+                    waiting = {t.owner for t in self._queue} | set(self._running)
+                    self._served = {owner: at for owner, at in self._served.items() if owner in waiting}
+                if ticket.job.info.get("rate_wait"):
+                    ticket.job.set_info("rate_wait", None)
+                self._executor.submit(self._run, ticket)
+
+    def _next_locked(self):
+        """下一个可以开始的任务；没有时返回 (None, 最多等几秒)"""
+        for ticket in [t for t in self._queue if t.job.cancelled]:
+            self._queue.remove(ticket)
+            ticket.job._finish(CANCELLED)
+            self._release_key_locked(ticket)
+        if not self._queue or sum(self._running.values()) >= self.max_workers:
+            return None, None
+        wait = None
+        for ticket in self._ordered_locked():
+            delay = 0.0
+            if self.limiter is not None and ticket.rate_key is not None:
+                delay = self.limiter.try_acquire(ticket.rate_key)
+            if not delay:
+                return ticket, None
+            # 页面据此提示"等待 API 限额"
+            ticket.job.set_info("rate_wait", round(delay, 1))
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _release_key_locked(self, ticket):
+        if ticket.key is not None and self._inflight.get(ticket.key) is ticket.job:
+            del self._inflight[ticket.key]
+
+    def _run(self, ticket):
+        job = ticket.job
+        try:
+            job._start()
+            try:
+                ticket.fn(job, *ticket.args, **ticket.kwargs)
+            except JobCancelled:
+                job._finish(CANCELLED)
+            except Exception as e:
+                job._finish(FAILED, error=str(e), error_phase=getattr(e, "phase", job.phase))
+            else:
+                job._finish(DONE)
+        finally:
+            with self._lock:
+                self._release_key_locked(ticket)
+                self._running[ticket.owner] -= 1
+                if not self._running[ticket.owner]:
+                    del self._running[ticket.owner]
+                self._wakeup.notify()
+
+    def _expire_locked(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+        expired = [sub_id for sub_id, sub in self._subscriptions.items()
+                   if sub.finished and now - sub.finished_at > self.ttl]
+        for sub_id in expired:
+            del self._subscriptions[sub_id]
@@ -0,0 +1,17 @@
+"""本地 SQLite 库的公共打开方式
+
+历史记录、结果缓存、工作流执行记录都是进程内共享、多个线程访问的小库，统一这样打开：
+自动创建所在目录，开 WAL (读写互不阻塞)，允许跨线程使用 (各个库自己加锁)，
+isolation_level=None，事务由调用方显式 BEGIN / COMMIT。
+"""
+import os
+import sqlite3
+
+
+def connect(path):
+    """打开 (必要时创建) path 处的 SQLite 库；":memory:" 为内存库"""
+    if path != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
@@ -0,0 +1,263 @@
+"""生成流程的分阶段耗时统计
+
+每次生成一个 RunTrace，记录：
+- upload       上传图片
+- connect      发起 /chat-messages 到收到响应头
+- first_event  收到响应头到第一个 SSE 事件
+- stream       收到响应头到流结束
+- total        整次生成
+- 每个工作流节点 node_started -> node_finished 的耗时
+
+结束时汇总进进程内的直方图 / 计数器，并输出一行 JSON 日志。导出方式：
+- DIFY_METRICS_TEXTFILE: 每次生成结束后原子写出 Prometheus 文本格式文件
+  (配合 node_exporter 的 textfile collector)
+- DIFY_METRICS_PORT: 在该端口起一个 /metrics HTTP 接口
+- DIFY_METRICS_LOG: JSON 日志写到该文件 (默认打印到标准输出)
+
+DIFY_METRICS=1 才开启；关闭时 start_run 返回一个什么都不做的对象，开销只是几次空方法调用。
+"""
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.environ.get("DIFY_METRICS", "0") == "1"
+METRICS_TEXTFILE = os.environ.get("DIFY_METRICS_TEXTFILE", "")
+METRICS_PORT = int(os.environ.get("DIFY_METRICS_PORT", "0"))
+METRICS_LOG = os.environ.get("DIFY_METRICS_LOG", "")
+
+# 秒；一次生成大约 3 分钟，所以上限放到 5 分钟
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 180, 300)
+
+_HELP = {
+    "dify_phase_seconds": ("histogram", "各阶段耗时 (秒)"),
+    "dify_node_seconds": ("histogram", "工作流节点耗时 (秒)"),
+    "dify_runs_total": ("counter", "生成次数 (按结果)"),
+    "dify_coalesced_total": ("counter", "合并进已在跑的相同请求、省下的上游调用次数"),
+    "dify_upload_hidden_seconds_total": ("counter", "后台提前上传藏进用户操作时间里的上传耗时 (秒)"),
+    "dify_stream_stalls_total": ("counter", "流还连着但上游卡住、被看门狗放弃的次数 (按原因)"),
+}
+
+
+def percentile(sorted_values, q):
+    """最近秩法求分位数 (sorted_values 须已从小到大排好)；空列表返回 0"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(items, extra=None):
+    pairs = list(items) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Registry:
+    """进程内的直方图和计数器 (线程安全)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}  # name -> {labels: [各桶计数, sum, count]}
+        self._counters = {}    # name -> {labels: value}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                self._header(lines, name, "histogram")
+                for key, (counts, total, count) in sorted(series.items()):
+                    for bound, n in zip(self.buckets, counts):
+                        lines.append(f"{name}_bucket{_labels(key, ('le', bound))} {n}")
+                    lines.append(f"{name}_bucket{_labels(key, ('le', '+Inf'))} {count}")
+                    lines.append(f"{name}_sum{_labels(key)} {total:.6f}")
+                    lines.append(f"{name}_count{_labels(key)} {count}")
+            for name, series in sorted(self._counters.items()):
+                self._header(lines, name, "counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """原子写出，避免采集端读到半个文件"""
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"指标文件写入失败: {e}")
+
+    @staticmethod
+    def _header(lines, name, kind):
+        kind, text = _HELP.get(name, (kind, name))
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+REGISTRY = Registry()
+
+
+class RunTrace:
+    """一次生成的计时"""
+
+    enabled = True
+
+    def __init__(self, registry, run_id=None, clock=time.monotonic):
+        self.registry = registry
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.clock = clock
+        self.started = clock()
+        self.phases = {}    # 阶段 -> 秒
+        self.nodes = []     # [{"node", "seconds"}]
+        self._open = {}     # 进行中的阶段 -> 开始时间
+        self._open_nodes = {}
+
+    def start(self, phase):
+        self._open[phase] = self.clock()
+
+    def end(self, phase):
+        began = self._open.pop(phase, None)
+        if began is not None:
+            self.phases[phase] = self.clock() - began
+
+    def node_started(self, node_id, title):
+        self._open_nodes[node_id] = (title, self.clock())
+
+    def node_finished(self, node_id):
+        opened = self._open_nodes.pop(node_id, None)
+        if opened is not None:
+            self.nodes.append({"node": opened[0], "seconds": round(self.clock() - opened[1], 3)})
+
+    def finish(self, status, **extra):
+        """汇总进 Registry，写 JSON 日志和指标文件"""
+        self.phases["total"] = self.clock() - self.started
+        for phase, seconds in self.phases.items():
+            self.registry.observe("dify_phase_seconds", seconds, phase=phase)
+        for node in self.nodes:
+            self.registry.observe("dify_node_seconds", node["seconds"], node=node["node"])
+        self.registry.inc("dify_runs_total", status=status)
+        record = {
+            "ts": time.time(),
+            "run_id": self.run_id,
+            "status": status,
+            "phases": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+            "nodes": self.nodes,
+            **extra,
+        }
+        _log(record)
+        if METRICS_TEXTFILE:
+            self.registry.write_textfile(METRICS_TEXTFILE)
+        return record
+
+
+class _NullTrace:
+    """未开启统计时使用：所有方法都是空操作"""
+
+    enabled = False
+    run_id = None
+
+    def start(self, phase):
+        pass
+
+    def end(self, phase):
+        pass
+
+    def node_started(self, node_id, title):
+        pass
+
+    def node_finished(self, node_id):
+        pass
+
+    def finish(self, status, **extra):
+        return None
+
+
+NULL_TRACE = _NullTrace()
+
+_log_lock = threading.Lock()
+_server = None
+_server_lock = threading.Lock()
+
+
+def _log(record):
+    line = json.dumps(record, ensure_ascii=False)
+    if not METRICS_LOG:
+        print(line)
+        return
+    with _log_lock:
+        try:
+            with open(METRICS_LOG, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"指标日志写入失败: {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=METRICS_PORT):
+    """在后台线程起 /metrics 接口 (每个进程只起一次)"""
+    global _server
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            except OSError as e:
+                _server = False  # 端口被占用等：不再重试
+                print(f"指标接口启动失败: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    return _server or None
+
+
+def start_run(run_id=None):
+    """开始一次生成的计时；未开启时返回空操作对象"""
+    if not METRICS_ENABLED:
+        return NULL_TRACE
+    if METRICS_PORT and _server is None:
+        serve(METRICS_PORT)
+    return RunTrace(REGISTRY, run_id)
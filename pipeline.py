@@ -0,0 +1,272 @@
+"""一次音乐生成的完整流程：(查结果缓存) -> 上传图片 -> 流式对话 -> 提取链接
+
+流中途断开时不重跑工作流：按流里记下的 message_id 轮询 Dify 的消息接口，
+等上游跑完后取回完整回答 (见 DifyClient.recover)。
+
+run_generation 不依赖 Streamlit，进度写进 Job (见 jobs.py)，
+既可以交给 JobManager 在后台跑，也可以直接同步调用。
+
+CompletionPolicy 决定什么时候可以不等流结束就收工 (拿够 N 个链接 /
+某个节点跑完)：满足后关闭连接，并调用 Dify 的停止接口释放上游任务。
+
+传了 trace_store 时，每次跑了工作流的生成 (成功、提前收工、失败或取消) 都会把
+各节点的执行记录存进去 (见 workflow_trace.py)，进度模型也从这里学习各节点耗时。
+"""
+import os
+
+from dify_client import (DEFAULT_USER, AudioLinkScanner, DifyClient, DifyError, StreamDropped, StreamStalled,
+                         answer_remainder)
+from jobs import JobCancelled
+from metrics import REGISTRY, start_run
+from result_cache import result_cache_key
+from sse import ANSWER_EVENTS
+from upload_cache import content_hash
+from workflow_trace import WorkflowTrace
+
+# 流程中需要处理的事件，其余事件在 JSON 解码前就被丢弃
+PIPELINE_EVENTS = ANSWER_EVENTS | {"node_started", "error"}
+
+STOP_AFTER_LINKS = int(os.environ.get("DIFY_STOP_AFTER_LINKS", "0"))   # 0 = 不按链接数提前结束
+STOP_AFTER_NODE = os.environ.get("DIFY_STOP_AFTER_NODE", "")           # 该节点 (标题) 跑完后结束
+
+
+class CompletionPolicy:
+    """提前结束流的条件；都不设置时读到流结束为止"""
+
+    def __init__(self, max_links=STOP_AFTER_LINKS, after_node=STOP_AFTER_NODE):
+        self.max_links = max_links
+        self.after_node = after_node
+
+    @property
+    def enabled(self):
+        return bool(self.max_links or self.after_node)
+
+    def links_reached(self, links):
+        return bool(self.max_links) and len(links) >= self.max_links
+
+    def node_reached(self, title):
+        return bool(self.after_node) and title == self.after_node
+
+
+class GenerationRequest:
+    """一次生成请求的全部输入"""
+
+    def __init__(self, base_url, api_key, image_bytes, image_name, image_mime, prompt="", user=DEFAULT_USER,
+                 force=False):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.image_bytes = image_bytes
+        self.image_name = image_name
+        self.image_mime = image_mime
+        self.prompt = prompt
+        self.user = user
+        self.force = force  # 跳过结果缓存，强制重新生成 (新结果仍会写回缓存)
+        self._image_digest = None
+
+    @property
+    def image_digest(self):
+        """图片的 content_hash (结果缓存、上传缓存、合并相同请求共用)，第一次用到时才算"""
+        if self._image_digest is None:
+            self._image_digest = content_hash(self.image_bytes)
+        return self._image_digest
+
+
+def run_generation(job, session, request, upload_cache=None, link_limit=2, result_cache=None, policy=None,
+                   audio_cache=None, uploader=None, trace_store=None):
+    """执行一次生成，把增量状态写进 job；失败时抛 DifyError
+
+    传了 audio_cache 时，每个链接一出现就开始在后台预取 MP3；
+    传了 uploader (SpeculativeUploader) 时复用选图时就开始的后台上传；
+    传了 trace_store (TraceStore) 时保存各节点的执行记录，job.info["trace_id"] 为记录的 id。
+    """
+    trace = start_run(job.id)
+    workflow = WorkflowTrace(job.id) if trace_store is not None else None
+    try:
+        _generate(job, session, request, trace, upload_cache, link_limit, result_cache, policy, audio_cache,
+                  uploader, workflow)
+    except JobCancelled:
+        trace.finish("cancelled")
+        _save_trace(job, trace_store, workflow, "cancelled")
+        raise
+    except Exception as e:
+        trace.finish("failed", error_phase=getattr(e, "phase", job.phase))
+        _save_trace(job, trace_store, workflow, "failed", error=str(e))
+        raise
+    trace.finish("done", result_cache=job.info.get("result_cache"), links=len(job.links))
+    # 提前收工的不算完整流程，进度模型不拿它学习
+    _save_trace(job, trace_store, workflow, "stopped" if "early_stop" in job.info else "done")
+
+
+def _save_trace(job, trace_store, workflow, status, error=None):
+    """保存执行记录；没跑工作流 (命中缓存、上传失败) 的不存，存储出错不影响生成结果"""
+    if workflow is None or not workflow.seen:
+        return
+    try:
+        trace_store.record(workflow.finish(status, error=error))
+    except Exception as e:
+        print(f"执行记录保存失败: {e}")
+        return
+    job.set_info("trace_id", workflow.run_id)
+
+
+def _generate(job, session, request, trace, upload_cache, link_limit, result_cache, policy, audio_cache, uploader,
+              workflow):
+    cache_key = None
+    if result_cache is not None:
+        job.set_phase("cache")
+        cache_key = result_cache_key(request.image_digest, request.prompt, request.base_url, request.api_key)
+        cached = None if request.force else result_cache.get(cache_key)
+        if cached is not None:
+            job.append_text(cached.full_response)
+            links = cached.links[:link_limit]
+            if audio_cache is not None:
+                for link in links:
+                    audio_cache.prefetch(link)
+            job.set_links(links)
+            job.set_info("result_cache", "hit")
+            return
+        job.set_info("result_cache", "forced" if request.force else "miss")
+
+    client = DifyClient(request.base_url, request.api_key, session=session, user=request.user,
+                        upload_cache=upload_cache)
+    job.set_phase("upload")
+    trace.start("upload")
+    if uploader is not None:
+        file_id, prep_report, hidden = uploader.upload(client, request.image_bytes, request.image_name,
+                                                       request.image_mime, digest=request.image_digest)
+        if hidden:
+            job.set_info("upload_hidden_seconds", round(hidden, 3))
+    else:
+        file_id, prep_report = client.upload(request.image_bytes, request.image_name, request.image_mime,
+                                             digest=request.image_digest if upload_cache is not None else None)
+    trace.end("upload")
+    if prep_report:
+        job.set_info("image_prep", prep_report)
+    job.check_cancelled()
+
+    job.set_phase("connect")
+    # node_finished 的载荷很大 (带节点输出)，只有按节点结束、统计节点耗时或记录详细执行记录时才解码
+    wanted = PIPELINE_EVENTS
+    if trace.enabled or (policy is not None and policy.after_node):
+        wanted = wanted | {"node_finished"}
+    if workflow is not None:
+        wanted = wanted | workflow.events
+    trace.start("connect")
+    stream = client.open_chat(file_id, request.prompt, events=wanted)
+    trace.end("connect")
+    trace.start("first_event")
+    trace.start("stream")
+
+    job.set_phase("stream")
+    scanner = AudioLinkScanner()
+    seen_event = False
+    stop_reason = None
+    cancelled = False
+    stalled = False
+    dropped = None
+    try:
+        for events in stream.batches():
+            for event in events:
+                data = event.payload
+                if workflow is not None:
+                    workflow.feed(event)
+                if not seen_event:
+                    seen_event = True
+                    trace.end("first_event")
+                if event.name in ANSWER_EVENTS:
+                    answer = data.get('answer', '')
+                    job.append_text(answer)
+                    # 链接一完整就交给页面，不必等整个流结束
+                    if scanner.feed(answer):
+                        _publish_links(job, scanner.links, link_limit, audio_cache)
+                        if policy is not None and policy.links_reached(scanner.links):
+                            stop_reason = f"已拿到 {len(scanner.links)} 个链接"
+                elif event.name == 'node_started':
+                    node = data.get('data', {})
+                    job.set_node(node.get('title', '未知节点'))
+                    trace.node_started(node.get('node_id'), node.get('title', '未知节点'))
+                elif event.name == 'node_finished':
+                    node = data.get('data', {})
+                    trace.node_finished(node.get('node_id'))
+                    title = node.get('title')
+                    if policy is not None and policy.node_reached(title):
+                        stop_reason = f"节点「{title}」已完成"
+                elif event.name == 'error':
+                    raise DifyError("chat", f"流式错误: {data.get('message', data)}", data.get('status'))
+                if stop_reason:
+                    break
+            if stop_reason:
+                break
+            job.check_cancelled()
+    except JobCancelled:
+        cancelled = True
+        raise
+    except StreamDropped as e:
+        if not stream.resumable:
+            raise
+        dropped = e
+    except StreamStalled as e:
+        # 连接还在但上游卡住了：不等也不查回，停掉任务后按失败结束
+        stalled = True
+        job.set_info("stalled", e.reason)
+        REGISTRY.inc("dify_stream_stalls_total", reason=e.reason)
+        raise
+    except DifyError:
+        raise
+    except Exception as e:
+        raise DifyError("chat", f"连接中断: {e}") from e
+    finally:
+        stream.close()
+        trace.end("stream")
+        # 提前收工、被取消或卡住：上游工作流还在跑，请 Dify 停掉，释放额度
+        if (stop_reason or cancelled or stalled) and stream.task_id:
+            job.set_info("stopped_task", client.stop(stream.task_id))
+
+    if stop_reason:
+        job.set_info("early_stop", stop_reason)
+    if dropped is not None:
+        scanner = _resume(job, client, stream, scanner, trace, dropped, link_limit, audio_cache)
+
+    if scanner.close():
+        _publish_links(job, scanner.links, link_limit, audio_cache)
+    # 只缓存拿到了链接的完整结果：空结果下次还会重新生成；提前收工的回答是截断的，
+    # 缓存起来会让之后没要求提前结束的请求也只拿到这一半
+    if cache_key is not None and job.links and not stop_reason:
+        result_cache.put(cache_key, job.text, scanner.links, elapsed=job.elapsed())
+
+
+def _resume(job, client, stream, scanner, trace, dropped, link_limit, audio_cache):
+    """断线后查回完整回答，补进 job；返回用来提取链接的 scanner"""
+    print(f"任务 {job.id} {dropped}，等待 Dify 完成后查回结果 (message {stream.message_id})")
+    job.set_phase("resume")
+    job.set_info("resumed", str(dropped))
+    trace.start("resume")
+    try:
+        message = client.recover(stream, sleep=job.sleep, should_stop=job.check_cancelled)
+    except JobCancelled:
+        if stream.task_id:
+            job.set_info("stopped_task", client.stop(stream.task_id))
+        raise
+    finally:
+        trace.end("resume")
+    answer = message.get("answer") or ""
+    rest = answer_remainder(job.text, answer)
+    if rest is None:
+        job.set_text(answer)
+        scanner = AudioLinkScanner()
+        rest = answer
+    else:
+        job.append_text(rest)
+    if scanner.feed(rest):
+        _publish_links(job, scanner.links, link_limit, audio_cache)
+    return scanner
+
+
+def _publish_links(job, links, link_limit, audio_cache):
+    links = links[:link_limit]
+    if "first_link_seconds" not in job.info:
+        job.set_info("first_link_seconds", round(job.elapsed(), 3))
+    if audio_cache is not None:
+        for link in links:
+            audio_cache.prefetch(link)
+    job.set_links(links)
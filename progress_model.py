@@ -0,0 +1,149 @@
+"""根据历史节点耗时估算进度和剩余时间
+
+历史耗时不单独存一份，直接取工作流执行记录 (TraceStore，见 workflow_trace.py) 里
+最近 PROGRESS_MAX_RUNS 次完整跑完 (status 为 done) 的记录：每个节点的耗时按相邻两个
+节点开始时间的间隔算 (最后一个节点算到结束)，第一个节点开始之前 (上传图片、建立连接)
+作为一个虚拟节点统计。TraceStore 每存一条新记录，下次估算前重新汇总一次。
+估算时按当前跑到的节点在上一次完整流程中的位置，把当前节点剩下的时间和
+后续节点的中位数 (以及 p90) 加起来，得到剩余时间和进度。
+
+没有历史数据时退回原来的固定 160 秒估计。
+ProgressModel 应通过 st.cache_resource 在进程内共享。
+"""
+import os
+import threading
+import time
+
+from metrics import percentile
+
+PROGRESS_MAX_RUNS = int(os.environ.get("PROGRESS_MAX_RUNS", "200"))   # 参与统计的最近完整生成次数
+DEFAULT_TOTAL_SECONDS = 160.0
+
+# 第一个节点开始之前 (上传图片、建立连接) 作为一个虚拟节点统计
+PREPARE_NODE = "__prepare__"
+
+
+def trace_durations(trace):
+    """执行记录 (WorkflowTrace.finish() 的结果) -> [(节点, 秒)]，开头加上 PREPARE_NODE"""
+    nodes = [node for node in trace.get("nodes") or [] if node.get("start") is not None]
+    if not nodes:
+        return []
+    durations = [(PREPARE_NODE, nodes[0]["start"])]
+    for i, node in enumerate(nodes):
+        left = nodes[i + 1]["start"] if i + 1 < len(nodes) else trace["total"]
+        durations.append((node["title"], left - node["start"]))
+    return durations
+
+
+class Estimate:
+    """一次估算结果"""
+
+    __slots__ = ("progress", "remaining", "remaining_p90", "learned")
+
+    def __init__(self, progress, remaining, remaining_p90, learned):
+        self.progress = progress            # 0 ~ 0.99
+        self.remaining = remaining          # 剩余秒数 (中位数估计)
+        self.remaining_p90 = remaining_p90  # 剩余秒数 (偏慢的估计)
+        self.learned = learned              # 是否来自历史数据
+
+
+class ProgressModel:
+    """剩余时间估算 (线程安全)；样本来自 trace_store 里最近的执行记录"""
+
+    def __init__(self, trace_store, max_runs=PROGRESS_MAX_RUNS, default_total=DEFAULT_TOTAL_SECONDS):
+        self.trace_store = trace_store
+        self.max_runs = max_runs
+        self.default_total = default_total
+        self._lock = threading.Lock()
+        # 估算每秒都要做，统计结果放内存，只在执行记录有新增后刷新
+        self._loaded = None     # 汇总时 trace_store.recorded 的值
+        self._runs = 0
+        self._stats = {}
+        self._sequence = []
+        self._total = []
+
+    def estimate(self, node_log, started_at, now=None):
+        """根据已开始的节点 [(节点, 开始时间)] 估算进度；now 默认为当前时间"""
+        now = time.time() if now is None else now
+        elapsed = max(0.0, now - started_at) if started_at is not None else 0.0
+        with self._lock:
+            self._refresh_locked()
+            stats, sequence, totals = self._stats, self._sequence, self._total
+
+        if not sequence:
+            remaining = max(self.default_total - elapsed, 0.0)
+            return Estimate(min(elapsed / self.default_total, 0.99), remaining, remaining, False)
+
+        if node_log:
+            current, entered = node_log[-1]
+            position = self._locate(sequence, current, len(node_log))
+            in_current = max(0.0, now - entered)
+        else:
+            current, position, in_current = PREPARE_NODE, 0, elapsed
+
+        if position is None:
+            # 工作流里出现了没见过的节点：按历史总耗时估计
+            median_total = percentile(totals, 0.5)
+            remaining = max(median_total - elapsed, 0.0)
+            remaining_p90 = max(percentile(totals, 0.9) - elapsed, remaining)
+        else:
+            current_stats = stats.get(current, {"median": 0.0, "p90": 0.0})
+            later = sequence[position + 1:]
+            remaining = max(current_stats["median"] - in_current, 0.0) + sum(
+                stats.get(node, {}).get("median", 0.0) for node in later)
+            remaining_p90 = max(current_stats["p90"] - in_current, 0.0) + sum(
+                stats.get(node, {}).get("p90", 0.0) for node in later)
+        progress = elapsed / (elapsed + remaining) if elapsed + remaining > 0 else 0.0
+        return Estimate(min(progress, 0.99), remaining, max(remaining_p90, remaining), True)
+
+    def node_stats(self):
+        """{节点: {"median", "p90", "count"}}"""
+        with self._lock:
+            self._refresh_locked()
+            return {node: dict(values) for node, values in self._stats.items()}
+
+    def stats(self):
+        with self._lock:
+            self._refresh_locked()
+            return {
+                "nodes": len(self._stats),
+                "runs": self._runs,
+                "sequence": list(self._sequence),
+                "median_total": round(percentile(self._total, 0.5), 1),
+            }
+
+    @staticmethod
+    def _locate(sequence, node, count):
+        """当前节点在流程中的位置：优先按已开始的节点数对齐 (同名节点可能出现多次)"""
+        expected = count  # sequence[0] 是 PREPARE_NODE
+        if expected < len(sequence) and sequence[expected] == node:
+            return expected
+        try:
+            return sequence.index(node, 1)
+        except ValueError:
+            return None
+
+    def _refresh_locked(self):
+        recorded = self.trace_store.recorded
+        if recorded == self._loaded:
+            return
+        self._loaded = recorded
+        samples, sequence, totals = {}, [], []
+        # 最新的在前：第一条有节点的记录就是"上一次完整流程"
+        for trace in self.trace_store.traces(self.max_runs, status="done"):
+            durations = trace_durations(trace)
+            if not durations:
+                continue
+            if not sequence:
+                sequence = [node for node, _ in durations]
+            for node, seconds in durations:
+                samples.setdefault(node, []).append(seconds)
+            totals.append(trace["total"])
+        stats = {}
+        for node, values in samples.items():
+            values.sort()
+            stats[node] = {"median": percentile(values, 0.5), "p90": percentile(values, 0.9), "count": len(values)}
+        self._runs = len(totals)
+        self._stats = stats
+        self._sequence = sequence
+        self._total = sorted(totals)
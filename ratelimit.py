@@ -0,0 +1,73 @@
+"""令牌桶限流
+
+每个 Dify API Key 一个桶：按 rate (次/秒) 补充令牌，最多攒 burst 个。
+批量生成 (batch.py) 阻塞等待 acquire()；交互页面的排队调度 (admission.py)
+不能阻塞，用 reserve() 拿不到时得到还要等多久。
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """线程安全的令牌桶"""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """有令牌就拿走并返回 True，否则立即返回 False"""
+        with self._lock:
+            self._refill(self.clock())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def reserve(self, tokens=1):
+        """有令牌就拿走并返回 0，否则返回还要等多少秒 (检查和拿取在同一把锁里)"""
+        with self._lock:
+            self._refill(self.clock())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate if self.rate > 0 else float("inf")
+
+    @property
+    def tokens(self):
+        """当前剩余的令牌数"""
+        with self._lock:
+            self._refill(self.clock())
+            return self._tokens
+
+    def wait_time(self, tokens=1):
+        """还要等多少秒才有足够的令牌"""
+        with self._lock:
+            self._refill(self.clock())
+            missing = tokens - self._tokens
+            if missing <= 0:
+                return 0.0
+            return missing / self.rate if self.rate > 0 else float("inf")
+
+    def acquire(self, tokens=1, timeout=None):
+        """阻塞直到拿到令牌；超时返回 False"""
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            if self.try_acquire(tokens):
+                return True
+            delay = self.wait_time(tokens)
+            if deadline is not None:
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(min(delay, 1.0) if delay > 0 else 0.001)
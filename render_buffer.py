@@ -0,0 +1,94 @@
+"""流式回答的合并渲染
+
+原来每收到一个 token 就 placeholder.markdown(full_response + "▌")，
+整段回答被反复发送、反复渲染，总开销随回答长度平方增长。
+
+StreamRenderBuffer 先把片段收进列表，每隔 interval_ms 毫秒或攒够
+max_bytes 字节才刷新一次占位符，结束时再做一次最终刷新 (去掉光标)。
+append() 只在新片段到达时检查刷新时机；调用方应在每次收到网络数据 (包括只有 ping 的
+批次，见 ChatStream.batches) 时再调用 maybe_flush()，把节流期间积压的片段刷出去。
+"""
+import time
+
+CURSOR = "▌"
+
+
+class StreamRenderBuffer:
+    """按时间/字节数节流的流式渲染缓冲区"""
+
+    def __init__(self, placeholder, interval_ms=150, max_bytes=4096, cursor=CURSOR, clock=time.monotonic):
+        self.placeholder = placeholder
+        self.interval = interval_ms / 1000.0
+        self.max_bytes = max_bytes
+        self.cursor = cursor
+        self.clock = clock
+        self._parts = []
+        self._text = ""           # 缓存的 "".join(self._parts)
+        self._dirty = False       # _text 是否需要重新拼接
+        self._pending_bytes = 0   # 上次刷新后新收到的字节数
+        self._pending_chunks = 0  # 上次刷新后新收到的片段数
+        self._last_flush = None
+        # 统计
+        self.chunks = 0
+        self.bytes_in = 0
+        self.flushes = 0
+        self.bytes_sent = 0       # 累计推送给前端的字节数
+        self.dropped_frames = 0   # 被合并掉、没有单独渲染的中间帧
+
+    @property
+    def text(self):
+        """目前为止的完整文本"""
+        if self._dirty:
+            self._text = "".join(self._parts)
+            self._dirty = False
+        return self._text
+
+    def append(self, chunk):
+        """追加一个片段，到了刷新时机就刷新"""
+        if not chunk:
+            return
+        size = len(chunk.encode("utf-8"))
+        self._parts.append(chunk)
+        self._dirty = True
+        self.chunks += 1
+        self.bytes_in += size
+        self._pending_bytes += size
+        self._pending_chunks += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        """距上次刷新超过 interval 或积压超过 max_bytes 时刷新；返回是否刷新了"""
+        if not self._pending_chunks:
+            return False
+        now = self.clock()
+        if (self._last_flush is None or now - self._last_flush >= self.interval
+                or self._pending_bytes >= self.max_bytes):
+            self._flush(self.cursor, now)
+            return True
+        return False
+
+    def finish(self):
+        """最终刷新：渲染完整文本并去掉光标，返回完整文本"""
+        self._flush("", self.clock())
+        return self.text
+
+    def stats(self):
+        return {
+            "chunks": self.chunks,
+            "bytes_in": self.bytes_in,
+            "flushes": self.flushes,
+            "bytes_sent": self.bytes_sent,
+            "dropped_frames": self.dropped_frames,
+        }
+
+    def _flush(self, suffix, now):
+        body = self.text + suffix
+        self.placeholder.markdown(body)
+        self.flushes += 1
+        # 已刷新的总字节数 = 当前文本字节数 + 光标
+        self.bytes_sent += self.bytes_in + len(suffix.encode("utf-8"))
+        if self._pending_chunks > 1:
+            self.dropped_frames += self._pending_chunks - 1
+        self._pending_bytes = 0
+        self._pending_chunks = 0
+        self._last_flush = now
@@ -0,0 +1,153 @@
+"""生成结果缓存 (SQLite)
+
+一次生成要跑 3 分钟左右的工作流；同一张图片 + 同样的提示词 (或都为空)
+再次请求时，直接返回上次的完整回答和音频链接，不再调用 /chat-messages。
+
+缓存键 = 图片内容哈希 + 提示词 + Dify 应用 + 工作流版本。工作流改动后
+调高 DIFY_WORKFLOW_VERSION，旧条目自然失效 (并会被按时间淘汰)。
+条目按最长保留时间和总字节数上限淘汰 (最久未使用的先删)。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from dify_client import DEFAULT_QUERY
+from local_db import connect
+from upload_cache import content_hash
+
+WORKFLOW_VERSION = os.environ.get("DIFY_WORKFLOW_VERSION", "1")
+RESULT_CACHE_MAX_AGE = float(os.environ.get("DIFY_RESULT_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("DIFY_RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_PATH = os.environ.get("DIFY_RESULT_CACHE_PATH", "result_cache.sqlite3")
+
+# 缓存键格式本身的版本；改了键的组成方式时调高
+KEY_SCHEMA = "r1"
+
+
+def result_cache_key(image, prompt, base_url, api_key, workflow_version=WORKFLOW_VERSION):
+    """缓存键；image 可以是图片字节或已算好的内容哈希
+
+    空提示词与默认提示词等价 (请求里都会变成 DEFAULT_QUERY)。
+    """
+    digest = image if isinstance(image, str) else content_hash(image)
+    query = (prompt or "").strip() or DEFAULT_QUERY
+    raw = "\n".join([KEY_SCHEMA, str(workflow_version), base_url, api_key, digest, query])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CachedResult:
+    """命中的缓存条目"""
+
+    __slots__ = ("full_response", "links", "created_at", "elapsed")
+
+    def __init__(self, full_response, links, created_at, elapsed):
+        self.full_response = full_response
+        self.links = links
+        self.created_at = created_at
+        self.elapsed = elapsed
+
+
+class ResultCache:
+    """生成结果的持久化缓存 (线程安全，进程内共享一个实例)"""
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_age=RESULT_CACHE_MAX_AGE,
+                 max_bytes=RESULT_CACHE_MAX_BYTES, clock=time.time):
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._db = connect(path)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                full_response TEXT NOT NULL,
+                links TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                elapsed REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)")
+        # 统计 (本进程)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.expired = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+
+    def get(self, key):
+        """命中返回 CachedResult，未命中或已过期返回 None"""
+        now = self.clock()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT full_response, links, created_at, elapsed FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if now - row[2] > self.max_age:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            self.seconds_saved += row[3]
+        return CachedResult(row[0], json.loads(row[1]), row[2], row[3])
+
+    def put(self, key, full_response, links, elapsed=0.0):
+        links_json = json.dumps(list(links), ensure_ascii=False)
+        size = len(full_response.encode("utf-8")) + len(links_json)
+        now = self.clock()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, full_response, links, size, elapsed, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, full_response, links_json, size, float(elapsed), now, now),
+            )
+            self.stores += 1
+            self._evict_locked(now)
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._db.execute("DELETE FROM results WHERE key = ?", (key,)).rowcount > 0
+
+    def stats(self):
+        with self._lock:
+            entries, total_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "seconds_saved": round(self.seconds_saved, 1),
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict_locked(self, now):
+        self.expired += self._db.execute(
+            "DELETE FROM results WHERE created_at < ?", (now - self.max_age,)
+        ).rowcount
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 超出字节上限：从最久未使用的开始删
+        for key, size in self._db.execute("SELECT key, size FROM results ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
@@ -0,0 +1,192 @@
+"""选好图片就在后台上传 (把上传藏进用户输入提示词的时间里)
+
+原来点了"开始生成"才上传图片，上传 (加上缩放、压缩) 整段都在等待路径上，
+而图片往往在那之前很久就选好了。SpeculativeUploader 在文件一选中时就交给
+进程级的线程池上传，按图片内容 + Dify 应用 (与上传缓存同一个键) 去重；
+点击生成时 upload() 等待或直接复用这个 file_id，没有的话再照常上传。
+换了图片时 cancel() 放弃之前的上传 (还没开始的直接取消；已经在传的让它传完，
+结果仍会进上传缓存，换回来时直接命中)。同一张图可能有好几个会话在等，
+每个后台上传记下 start() 它的会话 (holder)，最后一个会话 cancel() 时才真正放弃。
+
+统计"藏起来"的上传时间：后台上传中落在用户点击之前的部分，
+即 min(完成时间, 点击时间) - 开始时间；点击后还要等的部分计为 waited。
+
+SpeculativeUploader 应通过 st.cache_resource 在进程内共享；
+页面里用 prefetch_upload() 在文件选择框变化时开始 / 放弃后台上传。
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from dify_client import DEFAULT_USER, DifyClient
+from dify_http import PooledSession
+from metrics import REGISTRY
+from upload_cache import content_hash, upload_cache_key
+
+UPLOAD_PREFETCH_WORKERS = int(os.environ.get("UPLOAD_PREFETCH_WORKERS", "4"))
+UPLOAD_PREFETCH_TTL = float(os.environ.get("UPLOAD_PREFETCH_TTL", "600"))  # 传完后等多久没人用就丢掉 (秒)
+
+
+class PendingUpload:
+    """一个后台上传"""
+
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self.holders = set()    # start() 了还没 cancel() 的会话
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+
+class SpeculativeUploader:
+    """后台上传 + 等待复用 (线程安全)"""
+
+    def __init__(self, session=None, upload_cache=None, workers=UPLOAD_PREFETCH_WORKERS, ttl=UPLOAD_PREFETCH_TTL):
+        self.session = session if session is not None else PooledSession()
+        self.upload_cache = upload_cache
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-prefetch")
+        self._pending = {}  # 键 -> PendingUpload
+        self._lock = threading.Lock()
+        # 统计
+        self.started = 0
+        self.reused = 0        # 点击时已经传完
+        self.waited = 0        # 点击时还在传，等它传完
+        self.misses = 0        # 没有后台上传 (或失败 / 已取消)，照常上传
+        self.cancelled = 0
+        self.failures = 0
+        self.hidden_seconds = 0.0
+        self.waited_seconds = 0.0
+
+    def start(self, base_url, api_key, data, name, mime, user=DEFAULT_USER, prepare=True, digest=None, holder=None):
+        """开始后台上传 (同一张图已在传时只记下 holder，已缓存时什么都不做)
+
+        holder 为发起的会话 (任意可哈希的值)；返回键，之后用同一个 holder cancel()；
+        没有开始后台上传时返回 None。
+        digest 为已算好的 content_hash(data)，不传时现算；后台上传复用它，不再重复哈希。
+        """
+        if not api_key:
+            return None
+        base_url = base_url.rstrip("/")
+        digest = digest or content_hash(data)
+        key = upload_cache_key(digest, base_url, api_key)
+        with self._lock:
+            self._expire_locked()
+            if key in self._pending:
+                self._pending[key].holders.add(holder)
+                return key
+            if self.upload_cache is not None and self.upload_cache.get(key):
+                return None
+            pending = self._pending[key] = PendingUpload(key)
+            pending.holders.add(holder)
+            self.started += 1
+        client = DifyClient(base_url, api_key, session=self.session, user=user, upload_cache=self.upload_cache)
+        pending.future = self._executor.submit(self._upload, pending, client, data, name, mime, prepare, digest)
+        return key
+
+    def cancel(self, key, holder=None):
+        """holder 不再等这个后台上传；没人等了才放弃：还没开始的直接取消，已经在传的传完后只留在上传缓存里"""
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None or holder not in pending.holders:
+                return  # 不是这个会话开始的 (例如它那次已过期，别的会话又重新开始了一个)
+            pending.holders.discard(holder)
+            if pending.holders:
+                return
+            del self._pending[key]
+        if pending.future is not None and pending.future.cancel():
+            with self._lock:
+                self.cancelled += 1
+
+    def upload(self, client, data, name, mime, prepare=True, digest=None):
+        """点击生成时取 file_id：等待或复用后台上传，没有的话照常上传
+
+        返回 (file_id, 预处理报告, 藏起来的上传秒数)；digest 同 start()。
+        """
+        digest = digest or content_hash(data)
+        key = upload_cache_key(digest, client.base_url, client.api_key)
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None and pending.future is not None:
+            asked = time.monotonic()
+            try:
+                file_id, report = pending.future.result()
+            except Exception as e:
+                # 取消或失败：照常上传一次，真正的错误由它报出来
+                print(f"后台上传不可用，重新上传: {e!r}")
+            else:
+                client.track_upload(file_id, key)
+                hidden = max(0.0, min(pending.finished_at, asked) - pending.started_at)
+                waited = max(0.0, pending.finished_at - asked)
+                with self._lock:
+                    if waited > 0:
+                        self.waited += 1
+                    else:
+                        self.reused += 1
+                    self.hidden_seconds += hidden
+                    self.waited_seconds += waited
+                REGISTRY.inc("dify_upload_hidden_seconds_total", hidden)
+                return file_id, report, hidden
+        with self._lock:
+            self.misses += 1
+        file_id, report = client.upload(data, name, mime, prepare=prepare, digest=digest)
+        return file_id, report, 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": sum(1 for p in self._pending.values() if p.finished_at is None),
+                "started": self.started,
+                "reused": self.reused,
+                "waited": self.waited,
+                "misses": self.misses,
+                "cancelled": self.cancelled,
+                "failures": self.failures,
+                "hidden_seconds": round(self.hidden_seconds, 3),
+                "waited_seconds": round(self.waited_seconds, 3),
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _upload(self, pending, client, data, name, mime, prepare, digest):
+        try:
+            return client.upload(data, name, mime, prepare=prepare, digest=digest)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+                # 失败的不留着，下次选中同一张图时重试
+                if self._pending.get(pending.key) is pending:
+                    del self._pending[pending.key]
+            raise
+        finally:
+            pending.finished_at = time.monotonic()
+
+    def _expire_locked(self):
+        now = time.monotonic()
+        expired = [key for key, pending in self._pending.items()
+                   if pending.finished_at is not None and now - pending.finished_at > self.ttl]
+        for key in expired:
+            del self._pending[key]
+
+
+def prefetch_upload(state, uploader, file_obj, base_url, api_key, user=DEFAULT_USER, prepare=True):
+    """图片一选中 (或 API 设置变了) 就在后台开始上传；换掉的图片放弃上传
+
+    state 为 st.session_state，记下当前这次后台上传；file_obj 为 st.file_uploader 的返回值。
+    """
+    token = (file_obj.file_id, base_url, api_key, user, prepare) if file_obj is not None else None
+    if token == state.get("prefetch_token"):
+        return
+    holder = state.setdefault("prefetch_holder", uuid.uuid4().hex)   # 本会话，放弃时不影响别的会话
+    # 先开始新的再放弃旧的：只是换了 user 等、图片没变时，同一个后台上传不会被取消又重来
+    previous = state.get("prefetch_key")
+    state["prefetch_key"] = None
+    if file_obj is not None:
+        state["prefetch_key"] = uploader.start(base_url, api_key, file_obj.getvalue(), file_obj.name, file_obj.type,
+                                               user=user, prepare=prepare, holder=holder)
+    if previous:
+        uploader.cancel(previous, holder)
+    state["prefetch_token"] = token
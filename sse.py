@@ -0,0 +1,250 @@
+"""增量式 SSE 解析器
+
+按 SSE 规范 (https://html.spec.whatwg.org/multipage/server-sent-events.html)
+直接在原始字节上分帧：
+- 支持 CRLF / LF / CR 三种换行，以及跨 chunk 被截断的行和事件
+- 支持多行 data: 字段、event: / id: / retry: 字段和注释行
+- data 保持为字节，不做整行 decode，直接交给 JSON 解码器
+
+Dify 的事件名放在 JSON 里 ({"event": "message", ...})，iter_dify_events
+会先在字节前缀上嗅探事件名，把不需要的事件在 JSON 解码之前就丢掉。
+装了 orjson 时自动使用 orjson 解码。
+"""
+import json
+import logging
+import re
+
+try:
+    import orjson
+except ImportError:  # 可选依赖
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def stdlib_loads(raw):
+    """标准库 json 解码；先自己按 UTF-8 解码，省掉 json.loads 对字节的编码探测"""
+    if not isinstance(raw, str):
+        raw = raw.decode("utf-8")
+    return json.loads(raw)
+
+
+if orjson is not None:
+    json_loads = orjson.loads
+    JSON_BACKEND = "orjson"
+else:
+    json_loads = stdlib_loads
+    JSON_BACKEND = "json"
+
+# Dify 流式回答中携带文本的事件
+ANSWER_EVENTS = frozenset({"message", "agent_message", "text_chunk"})
+
+_BOM = b"\xef\xbb\xbf"
+# 只匹配 JSON 开头的 "event" 键，避免误中正文里的同名字段
+_DIFY_EVENT_RE = re.compile(rb'\{\s*"event"\s*:\s*"([^"\\]*)"')
+
+
+class SSEEvent:
+    """一个完整的 SSE 事件"""
+
+    __slots__ = ("type", "raw", "id", "retry", "name", "payload")
+
+    def __init__(self, type, raw, id="", retry=None):
+        self.type = type        # SSE event: 字段，默认 "message"
+        self.raw = raw          # data 字段原始字节 (多行已用 \n 拼接)
+        self.id = id            # 最近一次 id: 字段
+        self.retry = retry      # 最近一次 retry: 字段 (毫秒)
+        self.name = None        # Dify 事件名 (iter_dify_events 填充)
+        self.payload = None     # JSON 解码结果 (iter_dify_events 填充)
+
+    @property
+    def data(self):
+        return self.raw.decode("utf-8", errors="replace")
+
+    def json(self, loads=None):
+        if self.payload is None:
+            self.payload = (loads or json_loads)(self.raw)
+        return self.payload
+
+    def __repr__(self):
+        return f"SSEEvent(type={self.type!r}, name={self.name!r}, id={self.id!r}, bytes={len(self.raw)})"
+
+
+class SSEDecoder:
+    """增量 SSE 解析器：feed() 喂入原始字节，返回已完整的事件"""
+
+    def __init__(self):
+        self._tail = b""          # 上一段末尾不完整的行
+        self._pending_cr = False  # 上一段以 CR 结尾，下一段开头的 LF 属于同一个换行
+        self._data = []           # 当前事件的 data 片段
+        self._event_type = None
+        self._bom_checked = False
+        self.last_event_id = ""
+        self.retry = None
+        # 统计
+        self.bytes_in = 0
+        self.events_out = 0
+
+    def feed(self, chunk):
+        """喂入一段原始字节，返回这段数据中已完整的事件列表"""
+        if not chunk:
+            return []
+        if not isinstance(chunk, bytes):
+            chunk = bytes(chunk)
+        self.bytes_in += len(chunk)
+        if self._pending_cr:
+            self._pending_cr = False
+            if chunk[:1] == b"\n":
+                chunk = chunk[1:]
+        # 只有存在半行时才拼接，常见情况下直接在收到的 chunk 上切行
+        data = self._tail + chunk if self._tail else chunk
+        if not self._bom_checked:
+            if len(data) < len(_BOM) and _BOM.startswith(data):
+                self._tail = data
+                return []
+            if data.startswith(_BOM):
+                data = data[len(_BOM):]
+            self._bom_checked = True
+        if not data:
+            self._tail = b""
+            return []
+
+        lines = data.splitlines()  # bytes.splitlines 只认 CRLF / LF / CR，正好是 SSE 的换行规则
+        last = data[-1]
+        if last == 0x0A:
+            self._tail = b""
+        elif last == 0x0D:
+            self._tail = b""
+            self._pending_cr = True
+        else:
+            self._tail = lines.pop()  # 行还没收完整
+
+        events = []
+        buffered = self._data
+        for line in lines:
+            if not line:
+                if buffered:
+                    raw = buffered[0] if len(buffered) == 1 else b"\n".join(buffered)
+                    events.append(SSEEvent(self._event_type or "message", raw, self.last_event_id, self.retry))
+                    buffered.clear()
+                self._event_type = None
+            elif line.startswith(b"data: "):  # 快速路径：Dify 几乎只发 "data: {...}"
+                buffered.append(line[6:])
+            else:
+                self._process_field(line)
+        self.events_out += len(events)
+        return events
+
+    def close(self):
+        """流结束：丢弃不完整的事件 (规范要求)，重置状态"""
+        self._tail = b""
+        self._pending_cr = False
+        self._data.clear()
+        self._event_type = None
+        return []
+
+    def _process_field(self, line):
+        if line[0] == 0x3A:  # ':' 开头是注释
+            return
+        field, sep, value = line.partition(b":")
+        if sep and value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event_type = value.decode("utf-8", errors="replace")
+        elif field == b"id":
+            if b"\x00" not in value:
+                self.last_event_id = value.decode("utf-8", errors="replace")
+        elif field == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+        # 其他字段按规范忽略
+
+
+def sniff_dify_event(raw):
+    """不解码 JSON，直接从字节前缀中取出 Dify 事件名；取不到返回 None"""
+    match = _DIFY_EVENT_RE.match(raw)
+    if match is None:
+        return None
+    return match.group(1).decode("utf-8", errors="replace")
+
+
+class DifyEventParser:
+    """在 SSEDecoder 之上解析 Dify 事件：先按事件名过滤，再做 JSON 解码
+
+    events: 需要的事件名集合；None 表示全部保留
+    loads:  JSON 解码函数，默认 orjson (已安装时) 或标准库 json
+    feed() 返回的 SSEEvent 已填好 name 和 payload。
+    """
+
+    def __init__(self, events=None, loads=None):
+        self.decoder = SSEDecoder()
+        self.events = events
+        self.loads = loads or json_loads
+        # 统计
+        self.decoded = 0    # 完成 JSON 解码的事件
+        self.skipped = 0    # 解码前被过滤掉的事件
+        self.errors = 0     # 无法解析的帧
+        self.progress = 0   # ping 以外的事件 (含被过滤掉的)，看门狗用来判断上游是否还在干活
+
+    def feed(self, chunk):
+        """喂入一段原始字节，返回其中需要的 Dify 事件列表"""
+        batch = self.decoder.feed(chunk)
+        return self._decode(batch) if batch else batch
+
+    def close(self):
+        return self._decode(self.decoder.close())
+
+    def stats(self):
+        return {
+            "bytes": self.decoder.bytes_in,
+            "events": self.decoder.events_out,
+            "decoded": self.decoded,
+            "skipped": self.skipped,
+            "errors": self.errors,
+        }
+
+    def _decode(self, batch):
+        wanted = self.events
+        loads = self.loads
+        out = []
+        for event in batch:
+            name = event.type if event.type != "message" else sniff_dify_event(event.raw)
+            if name != "ping":
+                self.progress += 1
+            if wanted is not None and name is not None and name not in wanted:
+                self.skipped += 1
+                continue
+            try:
+                payload = loads(event.raw)
+            except ValueError as e:
+                self.errors += 1
+                logger.warning("无法解析的 SSE 帧 (%s): %r", e, event.raw[:200])
+                continue
+            if not isinstance(payload, dict):
+                self.errors += 1
+                logger.warning("SSE 帧不是 JSON 对象: %r", event.raw[:200])
+                continue
+            name = payload.get("event", name)
+            if wanted is not None and name not in wanted:
+                self.skipped += 1
+                continue
+            self.decoded += 1
+            event.name = name
+            event.payload = payload
+            out.append(event)
+        return out
+
+
+def iter_dify_events(chunks, events=None, loads=None, parser=None):
+    """把原始字节块 (例如 response.iter_content(chunk_size=None)) 逐个解析成 Dify 事件"""
+    parser = parser or DifyEventParser(events=events, loads=loads)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def iter_response_events(response, events=None, loads=None, parser=None):
+    """从 requests 的流式响应中逐个读出 Dify 事件"""
+    return iter_dify_events(response.iter_content(chunk_size=None), events=events, loads=loads, parser=parser)
@@ -0,0 +1,219 @@
+"""录制 /chat-messages 的原始 SSE 字节流，离线按原速或加速回放
+
+调流式解析、链接提取、渲染这条路径时需要真实的线上流，又不想每次都重新调 Dify。
+设置 DIFY_SSE_CAPTURE_DIR 后，ChatStream / AsyncChatStream 会把收到的每一块原始字节
+和它到达的时间 (相对收到响应头) 记下来，流关闭时写成一个 gzip 压缩的录制文件：
+
+    {头部 JSON}\\n
+    [<d: 到达时间 (秒)> <I: 字节数> <原始字节>] ...
+
+写盘前先脱敏：API Key、file_id、Dify user 等调用方给的字符串，以及流里的
+upload_file_id / related_id / sys.user_id、Bearer 令牌、app- 开头的 key、
+链接里所有查询参数的值 (Dify 文件链接的 timestamp / nonce / sign，S3 / OSS 预签名链接的
+X-Amz-Signature / X-Amz-Credential / OSSAccessKeyId / Signature / Expires / token 等，
+参数名不一，干脆全部遮掉)，都原地替换成等长的 x，所以分块边界不变，JSON 也仍然合法。
+
+ReplayResponse 把录制文件伪装成 requests 的流式响应，直接交给 ChatStream，
+走的是和线上完全一样的解析代码；speed 为 1 按原速、N 为 N 倍速、0 为不等待。
+回放驱动见 benchmarks/replay_sse.py。
+"""
+import gzip
+import json
+import os
+import random
+import re
+import struct
+import time
+import uuid
+from urllib.parse import urlsplit
+
+SSE_CAPTURE_DIR = os.environ.get("DIFY_SSE_CAPTURE_DIR", "")              # 为空时不录制
+SSE_CAPTURE_RATE = float(os.environ.get("DIFY_SSE_CAPTURE_RATE", "1"))    # 录制的流所占比例 (0 ~ 1)
+SSE_CAPTURE_MAX_FILES = int(os.environ.get("DIFY_SSE_CAPTURE_MAX_FILES", "200"))  # 目录里最多留几个，多了删最旧的
+SSE_CAPTURE_MAX_BYTES = int(os.environ.get("DIFY_SSE_CAPTURE_MAX_BYTES", str(16 * 1024 * 1024)))  # 单个流的上限
+
+CAPTURE_SUFFIX = ".sse.gz"
+CAPTURE_VERSION = 1
+
+_FRAME = struct.Struct("<dI")
+
+# 流里要脱敏的内容：只替换第 1 组
+_REDACT_PATTERNS = (
+    re.compile(rb'Bearer\s+([^\s"\\]+)'),
+    re.compile(rb'\b(app-[A-Za-z0-9]{8,})'),
+    re.compile(rb'"(?:upload_file_id|related_id|file_id|sys\.user_id)"\s*:\s*"([^"\\]*)"'),
+    # 查询参数的值；JSON 里的 & 也可能写成 \u0026
+    re.compile(rb'(?:[?&]|\\u0026)[^=&#"\s\\]+=([^&#"\s\\)\]<>\x27]+)'),
+)
+
+
+def redact(data, secrets=()):
+    """把 secrets 中的字符串和 _REDACT_PATTERNS 匹配到的内容替换成等长的 x"""
+    buffer = bytearray(data)
+    for secret in secrets:
+        if not secret:
+            continue
+        needle = secret.encode("utf-8")
+        start = data.find(needle)
+        while start >= 0:
+            buffer[start:start + len(needle)] = b"x" * len(needle)
+            start = data.find(needle, start + len(needle))
+    for pattern in _REDACT_PATTERNS:
+        for match in pattern.finditer(data):
+            buffer[match.start(1):match.end(1)] = b"x" * (match.end(1) - match.start(1))
+    return bytes(buffer)
+
+
+class SSECapture:
+    """一次流的录制：收到的原始字节和到达时间先放内存，close() 时脱敏、压缩、写盘"""
+
+    def __init__(self, path, meta=None, secrets=(), max_bytes=SSE_CAPTURE_MAX_BYTES,
+                 max_files=SSE_CAPTURE_MAX_FILES, clock=time.monotonic):
+        self.path = path
+        self.meta = dict(meta or {})
+        self.secrets = [secret for secret in secrets if secret]
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.clock = clock
+        self.started = clock()
+        self.created_at = time.time()
+        self.bytes = 0
+        self.truncated = False
+        self.closed = False
+        self._chunks = []   # [(到达时间, 字节)]
+
+    def record(self, chunk):
+        if self.closed or not chunk:
+            return
+        if self.bytes + len(chunk) > self.max_bytes:
+            self.truncated = True
+            return
+        self._chunks.append((self.clock() - self.started, bytes(chunk)))
+        self.bytes += len(chunk)
+
+    def close(self, **extra):
+        """写出录制文件 (先写临时文件再改名)，返回路径；没收到数据或写失败时返回 None"""
+        if self.closed:
+            return None
+        self.closed = True
+        chunks, self._chunks = self._chunks, []
+        if not chunks:
+            return None
+        data = redact(b"".join(chunk for _, chunk in chunks), self.secrets)
+        header = {
+            "version": CAPTURE_VERSION,
+            "created_at": self.created_at,
+            "chunks": len(chunks),
+            "bytes": len(data),
+            "duration": round(chunks[-1][0], 6),
+            "truncated": self.truncated,
+            **self.meta,
+            **extra,
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp_path = os.path.join(directory, f".{os.path.basename(self.path)}.part")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with gzip.open(tmp_path, "wb") as f:
+                f.write(json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n")
+                offset = 0
+                for arrived, chunk in chunks:
+                    f.write(_FRAME.pack(arrived, len(chunk)))
+                    f.write(data[offset:offset + len(chunk)])
+                    offset += len(chunk)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"SSE 录制写入失败 {self.path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+        _prune(directory, self.max_files)
+        return self.path
+
+
+def _prune(directory, max_files):
+    """录制文件超过 max_files 个时删最旧的"""
+    try:
+        files = sorted(entry.path for entry in os.scandir(directory)
+                       if entry.is_file() and entry.name.endswith(CAPTURE_SUFFIX))
+    except OSError:
+        return
+    # 文件名以时间开头，按名字排序就是按时间排序
+    for path in files[:max(len(files) - max_files, 0)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def start_capture(base_url="", secrets=(), directory=None, rate=None):
+    """按配置开始录制一个流；没开启 (或这次没被抽中) 时返回 None"""
+    directory = SSE_CAPTURE_DIR if directory is None else directory
+    rate = SSE_CAPTURE_RATE if rate is None else rate
+    if not directory or rate <= 0 or random.random() >= rate:
+        return None
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}{CAPTURE_SUFFIX}"
+    return SSECapture(os.path.join(directory, name), meta={"host": urlsplit(base_url).netloc}, secrets=secrets)
+
+
+def read_capture(path):
+    """读录制文件，返回 (头部 dict, [(到达时间, 字节)])"""
+    with gzip.open(path, "rb") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != CAPTURE_VERSION:
+            raise ValueError(f"不支持的录制文件版本: {header.get('version')}")
+        frames = []
+        while True:
+            head = f.read(_FRAME.size)
+            if not head:
+                break
+            if len(head) < _FRAME.size:
+                raise ValueError(f"录制文件不完整: {path}")
+            arrived, size = _FRAME.unpack(head)
+            chunk = f.read(size)
+            if len(chunk) < size:
+                raise ValueError(f"录制文件不完整: {path}")
+            frames.append((arrived, chunk))
+    return header, frames
+
+
+def capture_files(paths):
+    """命令行参数 (文件或目录) -> 录制文件列表"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(CAPTURE_SUFFIX)))
+        else:
+            files.append(path)
+    return files
+
+
+class ReplayResponse:
+    """把录制的帧伪装成 requests 的流式响应 (ChatStream 只用到 iter_content / close)
+
+    speed: 1 按原来的到达时间、N 为 N 倍速、0 为不等待 (尽快)。
+    """
+
+    def __init__(self, frames, speed=1.0, sleep=time.sleep, clock=time.monotonic):
+        self.frames = frames
+        self.speed = speed
+        self.sleep = sleep
+        self.clock = clock
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        started = self.clock()
+        for arrived, chunk in self.frames:
+            if self.closed:
+                return
+            if self.speed > 0:
+                delay = started + arrived / self.speed - self.clock()
+                if delay > 0:
+                    self.sleep(delay)
+            yield chunk
+
+    def close(self):
+        self.closed = True
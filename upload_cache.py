@@ -0,0 +1,133 @@
+"""按内容寻址的上传缓存
+
+同一张图片 (字节完全相同) 在同一个 Dify 应用下只上传一次：图片字节做
+SHA-256，缓存 /files/upload 返回的 upload_file_id。缓存进程内共享，
+带 TTL (默认与 Dify 文件保留时间对齐，可配置)、LRU 淘汰和条目上限，
+可选持久化到磁盘 JSON 文件，重启后继续命中。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+UPLOAD_CACHE_TTL = float(os.environ.get("DIFY_UPLOAD_CACHE_TTL", "3600"))
+UPLOAD_CACHE_MAX_ENTRIES = int(os.environ.get("DIFY_UPLOAD_CACHE_MAX_ENTRIES", "1024"))
+
+
+def content_hash(data):
+    """图片字节的 SHA-256"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def upload_cache_key(data, base_url, api_key):
+    """缓存键：图片内容 + Dify 应用 (file_id 只在同一个应用/租户下有效)
+
+    API Key 只参与哈希，不会以明文写进缓存文件。
+    """
+    scope = hashlib.sha256(f"{base_url}\n{api_key}".encode("utf-8")).hexdigest()[:16]
+    digest = data if isinstance(data, str) else content_hash(data)
+    return f"{scope}:{digest}"
+
+
+class UploadCache:
+    """upload_file_id 的 LRU + TTL 缓存 (线程安全)"""
+
+    def __init__(self, ttl=UPLOAD_CACHE_TTL, max_entries=UPLOAD_CACHE_MAX_ENTRIES, path=None, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> {"file_id", "expires_at", "size"}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        if path:
+            self._load()
+
+    def get(self, key):
+        """命中返回 file_id，未命中或已过期返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry["expires_at"] <= self.clock():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry.get("size", 0)
+            return entry["file_id"]
+
+    def put(self, key, file_id, size=0):
+        with self._lock:
+            self._entries[key] = {"file_id": file_id, "expires_at": self.clock() + self.ttl, "size": size}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            snapshot = dict(self._entries) if self.path else None
+        if snapshot is not None:
+            self._save(snapshot)
+
+    def invalidate(self, key):
+        """Dify 不再认这个 file_id 时 (例如已被清理) 删掉对应条目"""
+        with self._lock:
+            removed = self._entries.pop(key, None) is not None
+            snapshot = dict(self._entries) if self.path and removed else None
+        if snapshot is not None:
+            self._save(snapshot)
+        return removed
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+            }
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = self.clock()
+        # 文件中按 LRU 顺序保存，跳过已过期的条目
+        for key, entry in saved.items():
+            if entry.get("expires_at", 0) > now and entry.get("file_id"):
+                self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self, snapshot):
+        """原子写入，避免多个进程/线程同时写出半截文件"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._save_lock:
+            self._write(directory, snapshot)
+
+    def _write(self, directory, snapshot):
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload_cache-")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"上传缓存保存失败: {e}")
@@ -0,0 +1,321 @@
+"""工作流执行记录 (每个节点什么时候开始、跑了多久、用了多少 token)
+
+流式对话里 Dify 会发 workflow_started / node_started / node_finished / message_end，
+原来页面只拿 node_started 显示一下节点名就丢掉了。WorkflowTrace 把一次生成的
+这些事件整理成一份紧凑的记录：
+- nodes: 每个节点执行一条 {id, node_id, title, type, index, start, end, elapsed, tokens, status}
+  start / end 为相对记录开始 (点击生成) 的秒数，按本地收到事件的时间算
+- first_event: 收到 workflow_started 的时间 (之前是上传图片、建立连接)
+- usage: message_end 里的 token 用量
+
+默认只用本来就会解码的 workflow_started / node_started / message_end (见 dify_client.TRACKED_EVENTS)，
+节点在下一个节点开始 (或整次结束) 时算结束，不多解码任何事件。
+WORKFLOW_TRACE=1 时额外解码 node_finished (带节点输出，比较大)：节点结束时间按它算，
+elapsed 用 Dify 自己报的 elapsed_time (服务端耗时)，并记下每个节点的 token 用量。
+
+TraceStore 把记录存进本地 SQLite，只保留最近 WORKFLOW_TRACE_MAX_RUNS 次；
+node_stats() 汇总最近若干次里每个节点的 p50 / p95 / 最大耗时，看哪个节点是瓶颈；
+进度模型 (progress_model.py) 也从这里取历史耗时。
+waterfall_spec() 生成瀑布图的 Vega-Lite 描述 (页面里用 st.vega_lite_chart 画)。
+
+TraceStore 应通过 st.cache_resource 在进程内共享。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+from local_db import connect
+from metrics import percentile
+
+WORKFLOW_TRACE_ENABLED = os.environ.get("WORKFLOW_TRACE", "0") == "1"   # 是否解码 node_finished 记详细耗时
+WORKFLOW_TRACE_DB_PATH = os.environ.get("WORKFLOW_TRACE_DB_PATH", "workflow_traces.sqlite3")
+WORKFLOW_TRACE_MAX_RUNS = int(os.environ.get("WORKFLOW_TRACE_MAX_RUNS", "500"))     # 最多保留几次的记录
+WORKFLOW_TRACE_STATS_RUNS = int(os.environ.get("WORKFLOW_TRACE_STATS_RUNS", "50"))  # 汇总统计看最近几次
+
+# 记录用到的事件；node_finished 只有 detailed 的记录才要 (见 WorkflowTrace)
+TRACE_EVENTS = frozenset({"workflow_started", "node_started", "message_end"})
+DETAIL_EVENTS = TRACE_EVENTS | {"node_finished"}
+
+# 瀑布图里第一个节点之前的那一段 (上传图片、建立连接、等第一个事件)
+PREPARE_TITLE = "上传 / 连接"
+
+
+def _offset(value):
+    return None if value is None else round(value, 3)
+
+
+class WorkflowTrace:
+    """一次生成的节点事件记录 (非线程安全，只在跑生成的那个线程里用)
+
+    detailed: 是否会喂入 node_finished (事件集合用 DETAIL_EVENTS)；
+    否则节点在下一个节点开始时结束，最后一个节点在整次成功结束时结束。
+    """
+
+    def __init__(self, run_id=None, detailed=WORKFLOW_TRACE_ENABLED, clock=time.monotonic):
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.detailed = detailed
+        self.clock = clock
+        self.started = clock()
+        self.created_at = time.time()
+        self.workflow_run_id = None
+        self.first_event = None
+        self.nodes = []
+        self.usage = None
+        self._open = {}     # 节点执行 id -> nodes 里的那一条
+
+    @property
+    def events(self):
+        """记录需要解码的事件"""
+        return DETAIL_EVENTS if self.detailed else TRACE_EVENTS
+
+    @property
+    def seen(self):
+        """是否收到过工作流事件 (命中结果缓存等没跑工作流的不用保存)"""
+        return self.first_event is not None
+
+    def feed(self, event):
+        """喂入一个已解码的事件；不关心的事件直接忽略"""
+        handler = self._HANDLERS.get(event.name)
+        if handler is not None:
+            handler(self, event.payload.get("data") or {}, event.payload)
+
+    def _workflow_started(self, data, payload):
+        self._mark_first_event()
+        self.workflow_run_id = data.get("id") or payload.get("workflow_run_id")
+
+    def _node_started(self, data, payload):
+        self._mark_first_event()
+        if not self.detailed:
+            self._close_open(self.clock() - self.started)
+        node = {
+            "id": data.get("id") or data.get("node_id"),
+            "node_id": data.get("node_id"),
+            "title": data.get("title") or data.get("node_id") or "未知节点",
+            "type": data.get("node_type"),
+            "index": data.get("index"),
+            "start": self.clock() - self.started,
+            "end": None,
+            "elapsed": None,
+            "tokens": None,
+            "status": "running",
+        }
+        self.nodes.append(node)
+        self._open[node["id"]] = node
+
+    def _node_finished(self, data, payload):
+        if not self.detailed:
+            return
+        self._mark_first_event()
+        node = self._open.pop(data.get("id") or data.get("node_id"), None)
+        if node is None:
+            # 没收到 node_started (例如开始记录前已经开始)：只能按 Dify 报的耗时往前推
+            node = {"id": data.get("id"), "node_id": data.get("node_id"),
+                    "title": data.get("title") or data.get("node_id") or "未知节点",
+                    "type": data.get("node_type"), "index": data.get("index"), "start": None}
+            self.nodes.append(node)
+        now = self.clock() - self.started
+        elapsed = data.get("elapsed_time")
+        node["end"] = now
+        node["elapsed"] = float(elapsed) if isinstance(elapsed, (int, float)) else (
+            now - node["start"] if node["start"] is not None else None)
+        if node["start"] is None:
+            node["start"] = max(now - (node["elapsed"] or 0.0), 0.0)
+        node["tokens"] = (data.get("execution_metadata") or {}).get("total_tokens")
+        node["status"] = data.get("status") or "succeeded"
+
+    def _message_end(self, data, payload):
+        self.usage = (payload.get("metadata") or {}).get("usage")
+
+    _HANDLERS = {
+        "workflow_started": _workflow_started,
+        "node_started": _node_started,
+        "node_finished": _node_finished,
+        "message_end": _message_end,
+    }
+
+    def _mark_first_event(self):
+        if self.first_event is None:
+            self.first_event = self.clock() - self.started
+
+    def _close_open(self, now):
+        """没有 node_finished 时：还开着的节点都在 now 结束"""
+        for node in self._open.values():
+            node["end"] = now
+            node["elapsed"] = now - node["start"]
+            node["status"] = "succeeded"
+        self._open = {}
+
+    def finish(self, status, error=None):
+        """结束记录，返回可以 JSON 序列化的 dict；还没结束的节点记为 unfinished"""
+        total = self.clock() - self.started
+        if status == "done" and not self.detailed:
+            self._close_open(total)
+        for node in self._open.values():
+            node["status"] = "unfinished"
+        self._open = {}
+        return {
+            "run_id": self.run_id,
+            "created_at": self.created_at,
+            "status": status,
+            "error": error,
+            "workflow_run_id": self.workflow_run_id,
+            "total": round(total, 3),
+            "first_event": _offset(self.first_event),
+            "usage": self.usage,
+            "nodes": [{**node, "start": _offset(node["start"]), "end": _offset(node["end"]),
+                       "elapsed": _offset(node["elapsed"])} for node in self.nodes],
+        }
+
+
+def waterfall_rows(trace):
+    """记录 -> 瀑布图的行 [{"title", "start", "end", "elapsed", "tokens", "status"}]"""
+    rows = []
+    if trace.get("first_event"):
+        rows.append({"title": PREPARE_TITLE, "start": 0.0, "end": trace["first_event"],
+                     "elapsed": trace["first_event"], "tokens": None, "status": "prepare"})
+    for i, node in enumerate(trace.get("nodes") or []):
+        end = node["end"] if node["end"] is not None else trace["total"]
+        rows.append({
+            # 同一个节点可能执行多次 (迭代)，加序号区分，也保持先后顺序
+            "title": f"{i + 1}. {node['title']}",
+            "start": node["start"],
+            "end": end,
+            "elapsed": node["elapsed"] if node["elapsed"] is not None else round(end - node["start"], 3),
+            "tokens": node["tokens"],
+            "status": node["status"],
+        })
+    return rows
+
+
+def waterfall_spec(trace):
+    """瀑布图的 Vega-Lite 描述：每个节点一行，横轴为从点击生成起的秒数"""
+    rows = waterfall_rows(trace)
+    return {
+        "data": {"values": rows},
+        "height": max(len(rows), 1) * 24,
+        "mark": {"type": "bar", "cornerRadius": 2},
+        "encoding": {
+            "y": {"field": "title", "type": "nominal", "sort": None, "title": None},
+            "x": {"field": "start", "type": "quantitative", "title": "秒"},
+            "x2": {"field": "end"},
+            "color": {"field": "status", "type": "nominal", "title": "状态"},
+            "tooltip": [
+                {"field": "title", "title": "节点"},
+                {"field": "start", "title": "开始 (秒)"},
+                {"field": "elapsed", "title": "耗时 (秒)"},
+                {"field": "tokens", "title": "tokens"},
+                {"field": "status", "title": "状态"},
+            ],
+        },
+    }
+
+
+class TraceStore:
+    """执行记录库 (SQLite，线程安全)，只保留最近 max_runs 次"""
+
+    def __init__(self, path=WORKFLOW_TRACE_DB_PATH, max_runs=WORKFLOW_TRACE_MAX_RUNS):
+        self.path = path
+        self.max_runs = max_runs
+        self._lock = threading.Lock()
+        self._db = connect(path)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS traces (
+                run_id TEXT PRIMARY KEY,
+                recorded_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                total REAL NOT NULL,
+                trace TEXT NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS traces_time ON traces (recorded_at)")
+        # 统计 (recorded 也是进度模型判断要不要重新汇总的版本号)
+        self.recorded = 0
+        self.rotated = 0
+
+    def record(self, trace):
+        """保存一次记录 (WorkflowTrace.finish() 的结果)；超出上限时删掉最旧的"""
+        body = json.dumps(trace, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.execute("INSERT OR REPLACE INTO traces (run_id, recorded_at, status, total, trace)"
+                             " VALUES (?, ?, ?, ?, ?)",
+                             (trace["run_id"], time.time(), trace["status"], trace["total"], body))
+            deleted = self._db.execute(
+                "DELETE FROM traces WHERE rowid NOT IN"
+                " (SELECT rowid FROM traces ORDER BY recorded_at DESC LIMIT ?)", (self.max_runs,)).rowcount
+            self._db.execute("COMMIT")
+            self.recorded += 1
+            self.rotated += max(deleted, 0)
+
+    def get(self, run_id):
+        with self._lock:
+            row = self._db.execute("SELECT trace FROM traces WHERE run_id = ?", (run_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def recent(self, limit=20):
+        """最近的记录摘要 [{"run_id", "recorded_at", "status", "total"}]，最新的在前"""
+        with self._lock:
+            rows = self._db.execute("SELECT run_id, recorded_at, status, total FROM traces"
+                                    " ORDER BY recorded_at DESC LIMIT ?", (limit,)).fetchall()
+        return [{"run_id": run_id, "recorded_at": recorded_at, "status": status, "total": total}
+                for run_id, recorded_at, status, total in rows]
+
+    def traces(self, limit, status=None):
+        """最近 limit 条完整记录，最新的在前；给了 status 时只取该状态的"""
+        with self._lock:
+            if status is None:
+                rows = self._db.execute("SELECT trace FROM traces ORDER BY recorded_at DESC LIMIT ?",
+                                        (limit,)).fetchall()
+            else:
+                rows = self._db.execute("SELECT trace FROM traces WHERE status = ?"
+                                        " ORDER BY recorded_at DESC LIMIT ?", (status, limit)).fetchall()
+        return [json.loads(body) for (body,) in rows]
+
+    def node_stats(self, runs=WORKFLOW_TRACE_STATS_RUNS):
+        """最近 runs 次里每个节点 (按标题) 的耗时汇总，按 p95 从慢到快排
+
+        返回 [{"title", "count", "p50", "p95", "max", "mean_tokens", "share"}]；
+        share 为该节点 p50 占各节点 p50 之和的比例。
+        """
+        samples, tokens = {}, {}
+        for trace in self.traces(runs):
+            for node in trace.get("nodes") or []:
+                if node.get("elapsed") is None:
+                    continue
+                samples.setdefault(node["title"], []).append(node["elapsed"])
+                if node.get("tokens") is not None:
+                    tokens.setdefault(node["title"], []).append(node["tokens"])
+        stats = []
+        for title, values in samples.items():
+            values.sort()
+            used = tokens.get(title)
+            stats.append({
+                "title": title,
+                "count": len(values),
+                "p50": round(percentile(values, 0.5), 3),
+                "p95": round(percentile(values, 0.95), 3),
+                "max": round(values[-1], 3),
+                "mean_tokens": round(sum(used) / len(used), 1) if used else None,
+            })
+        total_p50 = sum(item["p50"] for item in stats)
+        for item in stats:
+            item["share"] = round(item["p50"] / total_p50, 3) if total_p50 else 0.0
+        stats.sort(key=lambda item: item["p95"], reverse=True)
+        return stats
+
+    def stats(self):
+        with self._lock:
+            count, oldest = self._db.execute("SELECT COUNT(*), MIN(recorded_at) FROM traces").fetchone()
+            return {
+                "path": self.path,
+                "runs": count,
+                "max_runs": self.max_runs,
+                "oldest": oldest,
+                "recorded": self.recorded,
+                "rotated": self.rotated,
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()